@@ -11,6 +11,7 @@ logging.getLogger("transformers").setLevel(logging.WARNING)
 import click
 import torch
 
+from luke.utils.distributed import get_distributed_backend, get_local_cpu_ids, pin_threads
 from luke.utils.model_utils import ModelArchive
 
 from .utils.experiment_logger import commet_logger_args, CometLogger, NullLogger
@@ -34,7 +35,11 @@ logger = logging.getLogger(__name__)
     "--output-dir", default="exp_" + "".join(random.choice(string.ascii_letters) for m in range(8)), type=click.Path()
 )
 @click.option("--num-gpus", default=1)
+@click.option("--num-cpu-processes", default=1)
 @click.option("--experiment-logger", "--logger", type=click.Choice(["comet"]))
+@click.option("--num-nodes", default=1)
+@click.option("--node-rank", default=0)
+@click.option("--master-addr", default="127.0.0.1")
 @click.option("--master-port", default=29500)
 @click.option("--local-rank", "--local_rank", default=-1)
 @click.option("--model-file", type=click.Path(exists=True))
@@ -43,16 +48,24 @@ logger = logging.getLogger(__name__)
 def cli(ctx, **kwargs):
     args = Namespace(**kwargs)
 
-    if args.local_rank == -1 and args.num_gpus > 1:
+    if args.num_gpus == 0:
+        num_processes = args.num_cpu_processes
+    else:
+        num_processes = args.num_gpus
+
+    if args.local_rank == -1 and (num_processes > 1 or args.num_nodes > 1):
         current_env = os.environ.copy()
-        current_env["MASTER_ADDR"] = "127.0.0.1"
+        current_env["MASTER_ADDR"] = args.master_addr
         current_env["MASTER_PORT"] = str(args.master_port)
-        current_env["WORLD_SIZE"] = str(args.num_gpus)
+        current_env["WORLD_SIZE"] = str(num_processes * args.num_nodes)
+        current_env["LOCAL_WORLD_SIZE"] = str(num_processes)
+        if args.num_gpus == 0:
+            current_env["OMP_NUM_THREADS"] = str(len(get_local_cpu_ids(0, num_processes)))
 
         processes = []
 
-        for args.local_rank in range(0, args.num_gpus):
-            current_env["RANK"] = str(args.local_rank)
+        for args.local_rank in range(0, num_processes):
+            current_env["RANK"] = str(num_processes * args.node_rank + args.local_rank)
             current_env["LOCAL_RANK"] = str(args.local_rank)
 
             cmd = [sys.executable, "-u", "-m", "examples.cli", "--local-rank={}".format(args.local_rank)]
@@ -82,12 +95,16 @@ def cli(ctx, **kwargs):
 
         if args.num_gpus == 0:
             ctx.obj["device"] = torch.device("cpu")
+            if args.local_rank != -1:
+                pin_threads(args.local_rank, num_processes)
         elif args.local_rank == -1:
             ctx.obj["device"] = torch.device("cuda")
         else:
             torch.cuda.set_device(args.local_rank)
             ctx.obj["device"] = torch.device("cuda", args.local_rank)
-            torch.distributed.init_process_group(backend="nccl")
+
+        if args.local_rank != -1:
+            torch.distributed.init_process_group(backend=get_distributed_backend(ctx.obj["device"]))
 
         experiment_logger = NullLogger()
 
@@ -127,6 +144,9 @@ cli.add_command(relation_classification_cli)
 from .utils.mention_db import cli as mention_db_cli
 
 cli.add_command(mention_db_cli)
+from .utils.wikipedia_artifacts import build_wikipedia_artifacts
+
+cli.add_command(build_wikipedia_artifacts)
 from .entity_span_qa.main import cli as entity_span_qa_cli
 
 cli.add_command(entity_span_qa_cli)
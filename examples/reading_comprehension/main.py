@@ -14,6 +14,8 @@ from tqdm import tqdm
 from transformers import WEIGHTS_NAME, BertTokenizer
 from wikipedia2vec.dump_db import DumpDB
 
+from luke.utils.link_index import LinkIndex
+
 from ..utils import set_seed
 from ..utils.mention_db import MentionDB
 from ..utils.trainer import Trainer, trainer_args
@@ -39,11 +41,14 @@ def cli():
 @click.argument("out_file", type=click.Path())
 @click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--chunk-size", default=100)
+@click.option("--link-index", type=click.Path(exists=True, file_okay=False), default=None)
 @click.pass_obj
-def build_wiki_link_db(common_args, dump_db_file, mention_db_file, **kwargs):
+def build_wiki_link_db(common_args, dump_db_file, mention_db_file, link_index, **kwargs):
     dump_db = DumpDB(dump_db_file)
     mention_db = MentionDB(mention_db_file)
-    WikiLinkDB.build(dump_db, mention_db, **kwargs)
+    if link_index is not None:
+        link_index = LinkIndex(link_index)
+    WikiLinkDB.build(dump_db, mention_db, link_index=link_index, **kwargs)
 
 
 @cli.command()
@@ -1,10 +1,9 @@
 import logging
-from contextlib import closing
-from multiprocessing.pool import Pool
 
 import joblib
 import marisa_trie
-from tqdm import tqdm
+
+from luke.utils.wikipedia_scan import PageConsumer, scan_wikipedia
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +17,6 @@ class WikiLink(object):
         self.link_prob = link_prob
 
 
-_dump_db = _mention_db = _title_trie = None
-
-
 class WikiLinkDB(object):
     def __init__(self, wiki_link_db_file):
         self._wiki_link_db_file = wiki_link_db_file
@@ -50,52 +46,58 @@ class WikiLinkDB(object):
         )
 
     @staticmethod
-    def build(dump_db, mention_db, out_file, pool_size, chunk_size):
+    def build(dump_db, mention_db, out_file, pool_size, chunk_size, link_index=None):
         title_trie = marisa_trie.Trie(dump_db.titles())
-        data = {}
+        results = scan_wikipedia(
+            dump_db,
+            [WikiLinkExtractor(title_trie)],
+            titles=title_trie,
+            pool_size=pool_size,
+            chunk_size=chunk_size,
+            link_index=link_index,
+        )
+        WikiLinkDB.build_from_links(title_trie, results["wiki_links"], mention_db, out_file)
 
-        with tqdm(total=dump_db.page_size(), mininterval=0.5) as pbar:
-            initargs = (dump_db, mention_db, title_trie)
-            with closing(Pool(pool_size, initializer=WikiLinkDB._initialize_worker, initargs=initargs)) as pool:
-                for title, links in pool.imap_unordered(
-                    WikiLinkDB._extract_wiki_links, title_trie, chunksize=chunk_size
-                ):
-                    data[title] = links
-                    pbar.update()
+    @staticmethod
+    def build_from_links(title_trie, links_dict, mention_db, out_file):
+        # the link probabilities are looked up once for each text
+        link_probs = {}
+        for links in links_dict.values():
+            for text, _ in links:
+                if text not in link_probs:
+                    mentions = mention_db.query(text)
+                    link_probs[text] = mentions[0].link_prob if mentions else 0.0
 
-        mention_trie = marisa_trie.Trie(text for links in data.values() for text, _, _ in links)
+        mention_trie = marisa_trie.Trie(link_probs.keys())
 
         def item_generator():
-            for title, links in data.items():
-                for mention_text, link_title_id, link_prob in links:
-                    yield title, (mention_trie[mention_text], link_title_id, link_prob)
+            for title, links in links_dict.items():
+                for mention_text, link_title_id in links:
+                    yield title, (mention_trie[mention_text], link_title_id, link_probs[mention_text])
 
         data_trie = marisa_trie.RecordTrie("<IIf", item_generator())
 
         joblib.dump(dict(title_trie=title_trie, mention_trie=mention_trie, data_trie=data_trie), out_file)
 
-    @staticmethod
-    def _initialize_worker(dump_db, mention_db, title_trie):
-        global _dump_db, _mention_db, _title_trie
-        _dump_db = dump_db
-        _mention_db = mention_db
-        _title_trie = title_trie
 
-    @staticmethod
-    def _extract_wiki_links(title):
-        links = []
-        for paragraph in _dump_db.get_paragraphs(title):
-            for wiki_link in paragraph.wiki_links:
-                link_title = _dump_db.resolve_redirect(wiki_link.title)
-                if link_title not in _title_trie:
-                    continue
-
-                mentions = _mention_db.query(wiki_link.text)
-                if mentions:
-                    link_prob = mentions[0].link_prob
-                else:
-                    link_prob = 0.0
-
-                links.append((wiki_link.text, _title_trie[link_title], link_prob))
-
-        return title, links
+class WikiLinkExtractor(PageConsumer):
+    name = "wiki_links"
+    requires_text = False
+
+    def __init__(self, title_trie):
+        self._title_trie = title_trie
+        self._links_dict = {}
+
+    def process_page(self, title, paragraphs):
+        return [
+            (wiki_link.text, self._title_trie[wiki_link.title])
+            for paragraph in paragraphs
+            for wiki_link in paragraph.wiki_links
+            if wiki_link.title in self._title_trie
+        ]
+
+    def merge(self, title, result):
+        self._links_dict[title] = result
+
+    def finish(self):
+        return self._links_dict
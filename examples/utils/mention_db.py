@@ -1,8 +1,6 @@
 import logging
 from collections import defaultdict, Counter
-from contextlib import closing
 import multiprocessing
-from multiprocessing.pool import Pool
 import click
 import joblib
 import marisa_trie
@@ -10,6 +8,9 @@ from tqdm import tqdm
 from transformers.tokenization_bert import BasicTokenizer
 from wikipedia2vec.dump_db import DumpDB
 
+from luke.utils.link_index import LinkIndex
+from luke.utils.wikipedia_scan import PageConsumer, scan_wikipedia
+
 SEP_CHAR = "\u2581"
 REP_CHAR = "_"
 
@@ -30,11 +31,14 @@ def cli():
 @click.option("--max-mention-length", default=20)
 @click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--chunk-size", default=100)
-def build_from_wikipedia(dump_db_file, **kwargs):
+@click.option("--link-index", type=click.Path(exists=True, file_okay=False), default=None)
+def build_from_wikipedia(dump_db_file, link_index, **kwargs):
     dump_db = DumpDB(dump_db_file)
     tokenizer = BasicTokenizer(do_lower_case=False)
     normalizer = BertLowercaseNormalizer()
-    MentionDB.build_from_wikipedia(dump_db, tokenizer, normalizer, **kwargs)
+    if link_index is not None:
+        link_index = LinkIndex(link_index)
+    MentionDB.build_from_wikipedia(dump_db, tokenizer, normalizer, link_index=link_index, **kwargs)
 
 
 @cli.command()
@@ -97,10 +101,6 @@ class BertLowercaseNormalizer(object):
         return token
 
 
-# global variables used in pool workers
-_dump_db = _tokenizer = _normalizer = _max_mention_length = _name_trie = None
-
-
 class MentionDB(object):
     def __init__(self, mention_db_file):
         self.mention_db_file = mention_db_file
@@ -156,32 +156,45 @@ class MentionDB(object):
         max_mention_length,
         pool_size,
         chunk_size,
+        link_index=None,
     ):
-        logger.info("Iteration 1/2: Extracting all entity names...")
+        name_entity_pair_extractor = NameEntityPairExtractor(tokenizer, normalizer, max_mention_length)
+        consumers = [NameOccurrenceCounter(tokenizer, normalizer, max_mention_length)]
+        if link_index is None:
+            consumers.append(name_entity_pair_extractor)
+            results = None
+        else:
+            # the names of the entities are read from the anchor texts in the link index without reading the pages
+            link_index.check_dump_db(dump_db)
+            results = dict(name_entity_pairs=name_entity_pair_extractor.extract_from_link_index(link_index))
 
-        name_dict = defaultdict(Counter)
-        with tqdm(total=dump_db.page_size(), mininterval=0.5) as pbar:
-            initargs = (dump_db, tokenizer, normalizer, max_mention_length)
-            with closing(Pool(pool_size, initializer=MentionDB._initialize_worker, initargs=initargs)) as pool:
-                for ret in pool.imap_unordered(
-                    MentionDB._extract_name_entity_pairs, dump_db.titles(), chunksize=chunk_size
-                ):
-                    for (name, title) in ret:
-                        name_dict[name][title] += 1
-                    pbar.update()
-
-        logger.info("Iteration 2/2: Counting occurrences of entity names...")
-
-        with tqdm(total=dump_db.page_size(), mininterval=0.5) as pbar:
-            name_doc_counter = Counter()
-            initargs = (dump_db, tokenizer, normalizer, max_mention_length, marisa_trie.Trie(name_dict.keys()))
-            with closing(Pool(pool_size, initializer=MentionDB._initialize_worker, initargs=initargs)) as pool:
-                for names in pool.imap_unordered(
-                    MentionDB._extract_name_occurrences, dump_db.titles(), chunksize=chunk_size
-                ):
-                    name_doc_counter.update(names)
-                    pbar.update()
+        results = scan_wikipedia(
+            dump_db, consumers, pool_size=pool_size, chunk_size=chunk_size, link_index=link_index, results=results
+        )
+        MentionDB.build_from_counts(
+            results["name_entity_pairs"],
+            results["name_occurrences"],
+            tokenizer,
+            normalizer,
+            out_file,
+            min_link_prob,
+            max_candidate_size,
+            min_link_count,
+            max_mention_length,
+        )
 
+    @staticmethod
+    def build_from_counts(
+        name_dict,
+        name_doc_counter,
+        tokenizer,
+        normalizer,
+        out_file,
+        min_link_prob,
+        max_candidate_size,
+        min_link_count,
+        max_mention_length,
+    ):
         logger.info("Building DB...")
 
         titles = frozenset([title for entity_counter in name_dict.values() for title in entity_counter.keys()])
@@ -273,36 +286,83 @@ class MentionDB(object):
             out_file,
         )
 
-    @staticmethod
-    def _initialize_worker(dump_db, tokenizer, normalizer, max_mention_length, name_trie=None):
-        global _dump_db, _tokenizer, _normalizer, _max_mention_length, _name_trie
-        _dump_db = dump_db
-        _tokenizer = tokenizer
-        _normalizer = normalizer
-        _max_mention_length = max_mention_length
-        _name_trie = name_trie
 
-    @staticmethod
-    def _extract_name_entity_pairs(title):
+class NameEntityPairExtractor(PageConsumer):
+    name = "name_entity_pairs"
+    requires_text = False
+
+    def __init__(self, tokenizer, normalizer, max_mention_length):
+        self._tokenizer = tokenizer
+        self._normalizer = normalizer
+        self._max_mention_length = max_mention_length
+        self._name_dict = defaultdict(Counter)
+
+    def process_page(self, title, paragraphs):
         ret = []
-        for paragraph in _dump_db.get_paragraphs(title):
+        for paragraph in paragraphs:
             for wiki_link in paragraph.wiki_links:
-                title = _dump_db.resolve_redirect(wiki_link.title)
-                text = wiki_link.text.replace(SEP_CHAR, REP_CHAR)
-                tokens = [_normalizer.normalize(t) for t in _tokenizer.tokenize(text)]
-                if len(tokens) <= _max_mention_length:
-                    ret.append((SEP_CHAR.join(tokens), title))
+                name = self._get_name(wiki_link.text)
+                if name is not None:
+                    ret.append((name, wiki_link.title))
         return ret
 
-    @staticmethod
-    def _extract_name_occurrences(title):
+    def extract_from_link_index(self, link_index):
+        """
+        Return the same result as scanning the pages using the distinct pairs of the anchor texts and the targets in
+        the link index. Each anchor text is tokenized only once.
+        """
+        name_dict = defaultdict(Counter)
+        names = {}
+        for (anchor_id, target_id, count) in tqdm(link_index.count_anchor_targets(), mininterval=0.5):
+            if anchor_id not in names:
+                names[anchor_id] = self._get_name(link_index.anchor_trie.restore_key(anchor_id))
+            if names[anchor_id] is not None:
+                name_dict[names[anchor_id]][link_index.title_trie.restore_key(target_id)] += count
+        return name_dict
+
+    def _get_name(self, text):
+        text = text.replace(SEP_CHAR, REP_CHAR)
+        tokens = [self._normalizer.normalize(t) for t in self._tokenizer.tokenize(text)]
+        if len(tokens) <= self._max_mention_length:
+            return SEP_CHAR.join(tokens)
+        return None
+
+    def merge(self, title, result):
+        for (name, link_title) in result:
+            self._name_dict[name][link_title] += 1
+
+    def finish(self):
+        return self._name_dict
+
+
+class NameOccurrenceCounter(PageConsumer):
+    name = "name_occurrences"
+    requires = ("name_entity_pairs",)
+
+    def __init__(self, tokenizer, normalizer, max_mention_length):
+        self._tokenizer = tokenizer
+        self._normalizer = normalizer
+        self._max_mention_length = max_mention_length
+        self._name_trie = None
+        self._name_doc_counter = Counter()
+
+    def prepare(self, results):
+        self._name_trie = marisa_trie.Trie(results["name_entity_pairs"].keys())
+
+    def process_page(self, title, paragraphs):
         ret = []
-        for paragraph in _dump_db.get_paragraphs(title):
+        for paragraph in paragraphs:
             text = paragraph.text.replace(SEP_CHAR, REP_CHAR)
-            tokens = [_normalizer.normalize(t) for t in _tokenizer.tokenize(text)]
+            tokens = [self._normalizer.normalize(t) for t in self._tokenizer.tokenize(text)]
             for n in range(len(tokens)):
-                target_text = SEP_CHAR.join(tokens[n : n + _max_mention_length])
-                for name in _name_trie.prefixes(target_text):
+                target_text = SEP_CHAR.join(tokens[n : n + self._max_mention_length])
+                for name in self._name_trie.prefixes(target_text):
                     if len(target_text) == len(name) or target_text[len(name)] == SEP_CHAR:
                         ret.append(name)
         return frozenset(ret)
+
+    def merge(self, title, result):
+        self._name_doc_counter.update(result)
+
+    def finish(self):
+        return self._name_doc_counter
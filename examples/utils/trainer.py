@@ -5,9 +5,15 @@ import os
 
 import click
 import torch
+from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from transformers import WEIGHTS_NAME, AdamW, get_constant_schedule_with_warmup, get_linear_schedule_with_warmup
 
+from luke.utils.batch_splitting import get_batch_size, run_with_oom_recovery
+from luke.utils.distributed import COMM_HOOKS, register_comm_hook
+from luke.utils.profiling import StepProfiler
+from luke.utils.telemetry import TrainingTelemetry
+
 logger = logging.getLogger(__name__)
 
 
@@ -27,6 +33,19 @@ def trainer_args(func):
     @click.option("--fp16-min-loss-scale", default=1)
     @click.option("--fp16-max-loss-scale", default=4)
     @click.option("--save-steps", default=0)
+    @click.option("--comm-hook", type=click.Choice(COMM_HOOKS), default="none")
+    @click.option("--powersgd-rank", default=4)
+    @click.option("--powersgd-start-iteration", default=1000)
+    @click.option("--telemetry", is_flag=True)
+    @click.option("--profile-steps", default=None)
+    @click.option("--profile-on-signal", is_flag=True)
+    @click.option("--profile-signal-steps", default=10)
+    @click.option(
+        "--oom-recovery",
+        is_flag=True,
+        help="Split micro-batches running out of memory. An out-of-memory error in the backward pass discards the "
+        "gradients of the earlier micro-batches of the step, and is not recovered in distributed training.",
+    )
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
@@ -61,62 +80,124 @@ class Trainer(object):
             )
 
         if self.args.local_rank != -1:
-            model = torch.nn.parallel.DistributedDataParallel(
-                model,
-                device_ids=[self.args.local_rank],
-                output_device=self.args.local_rank,
-                find_unused_parameters=True,
-            )
+            if self.args.device.type == "cuda":
+                device_kwargs = dict(device_ids=[self.args.local_rank], output_device=self.args.local_rank)
+            else:
+                device_kwargs = {}
+            # the pooler and some of the encoder outputs are not used by the task-specific heads
+            model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True, **device_kwargs)
+            register_comm_hook(model, self.args.comm_hook, self.args.powersgd_rank, self.args.powersgd_start_iteration)
 
         epoch = 0
         global_step = 0
         tr_loss = 0.0
+        num_oom_splits = 0
+        total_num_oom_splits = 0
 
-        num_workers = torch.cuda.device_count()
+        if self.args.local_rank == -1:
+            num_workers = 1
+        else:
+            num_workers = torch.distributed.get_world_size()
 
-        def maybe_no_sync(step):
+        def maybe_no_sync(step, is_last_part=True):
             if (
                 hasattr(model, "no_sync")
                 and num_workers > 1
-                and (step + 1) % self.args.gradient_accumulation_steps != 0
+                and ((step + 1) % self.args.gradient_accumulation_steps != 0 or not is_last_part)
             ):
                 return model.no_sync()
             else:
                 return contextlib.ExitStack()
 
+        if self.args.telemetry and self.args.output_dir and self.args.local_rank in (-1, 0):
+            summary_writer = SummaryWriter(os.path.join(self.args.output_dir, "tensorboard"))
+            telemetry = TrainingTelemetry(
+                self.args.device, os.path.join(self.args.output_dir, "telemetry.jsonl"), summary_writer
+            )
+        else:
+            summary_writer = None
+            telemetry = TrainingTelemetry(self.args.device, enabled=False)
+
+        profiler = StepProfiler(
+            self.args.output_dir,
+            model,
+            self.args.device,
+            profile_steps=self.args.profile_steps,
+            profile_on_signal=self.args.profile_on_signal,
+            num_signal_steps=self.args.profile_signal_steps,
+            rank=None if self.args.local_rank == -1 else torch.distributed.get_rank(),
+        )
+        profiler.step(global_step)
+
         model.train()
 
         with tqdm(total=self.num_train_steps, disable=self.args.local_rank not in (-1, 0)) as pbar:
             while True:
-                for step, batch in enumerate(self.dataloader):
-                    inputs = {k: v.to(self.args.device) for k, v in self._create_model_arguments(batch).items()}
-                    outputs = model(**inputs)
-                    loss = outputs[0]
-                    if self.args.gradient_accumulation_steps > 1:
-                        loss = loss / self.args.gradient_accumulation_steps
-
-                    with maybe_no_sync(step):
-                        if self.args.fp16:
-                            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                                scaled_loss.backward()
-                        else:
-                            loss.backward()
-
-                    tr_loss += loss.item()
-                    if (step + 1) % self.args.gradient_accumulation_steps == 0:
-                        if self.args.max_grad_norm != 0.0:
+                for step, batch in enumerate(telemetry.iterate(self.dataloader)):
+                    with telemetry.phase("transfer"):
+                        inputs = {k: v.to(self.args.device) for k, v in self._create_model_arguments(batch).items()}
+                    telemetry.add_batch(inputs)
+
+                    def forward(micro_batch, is_last_part):
+                        # DistributedDataParallel prepares the synchronization of the gradients in the forward pass
+                        with maybe_no_sync(step, is_last_part), telemetry.phase("forward"):
+                            outputs = model(**micro_batch)
+                        loss = outputs[0]
+                        if micro_batch is not inputs:
+                            # the loss is assumed to be averaged over the examples in the batch
+                            loss = loss * get_batch_size(micro_batch) / get_batch_size(inputs)
+                        if self.args.gradient_accumulation_steps > 1:
+                            loss = loss / self.args.gradient_accumulation_steps
+                        return loss, loss.detach()
+
+                    def backward(loss, is_last_part):
+                        with maybe_no_sync(step, is_last_part), telemetry.phase("backward"):
                             if self.args.fp16:
-                                torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.max_grad_norm)
+                                with amp.scale_loss(loss, optimizer) as scaled_loss:
+                                    scaled_loss.backward()
                             else:
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+                                loss.backward()
+
+                    losses, num_splits, gradients_reset = run_with_oom_recovery(
+                        inputs,
+                        forward,
+                        backward,
+                        model.zero_grad,
+                        enabled=self.args.oom_recovery,
+                        split_backward=num_workers == 1,
+                    )
+                    if gradients_reset:
+                        logger.warning("Discarded the gradients of the previous micro-batches in this step")
+                    num_oom_splits += num_splits
+                    loss = sum(losses)
 
-                        self.optimizer.step()
-                        self.scheduler.step()
-                        model.zero_grad()
+                    tr_loss += loss.item()
+                    if (step + 1) % self.args.gradient_accumulation_steps == 0:
+                        with telemetry.phase("optimizer"):
+                            if self.args.max_grad_norm != 0.0:
+                                if self.args.fp16:
+                                    torch.nn.utils.clip_grad_norm_(
+                                        amp.master_params(optimizer), self.args.max_grad_norm
+                                    )
+                                else:
+                                    torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+
+                            self.optimizer.step()
+                            self.scheduler.step()
+                            model.zero_grad()
 
                         pbar.set_description("epoch: %d loss: %.7f" % (epoch, loss.item()))
                         pbar.update()
                         global_step += 1
+                        profiler.step(global_step)
+
+                        # the time spent in the callback and saving the checkpoint is reported in the next step
+                        telemetry.end_step(global_step)
+                        if self.args.oom_recovery and summary_writer is not None:
+                            summary_writer.add_scalar("oom_splits", num_oom_splits, global_step)
+                        # the splits are reported per step as in pretraining
+                        total_num_oom_splits += num_oom_splits
+                        num_oom_splits = 0
 
                         if self.step_callback is not None:
                             self.step_callback(model, global_step)
@@ -129,10 +210,11 @@ class Trainer(object):
                         ):
                             output_dir = os.path.join(self.args.output_dir, "checkpoint-{}".format(global_step))
 
-                            if hasattr(model, "module"):
-                                torch.save(model.module.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
-                            else:
-                                torch.save(model.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
+                            with telemetry.phase("checkpoint", on_device=False):
+                                if hasattr(model, "module"):
+                                    torch.save(model.module.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
+                                else:
+                                    torch.save(model.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
 
                         if global_step == self.num_train_steps:
                             break
@@ -141,7 +223,16 @@ class Trainer(object):
                     break
                 epoch += 1
 
+        telemetry.close()
+        profiler.close()
+        if summary_writer is not None:
+            summary_writer.close()
         logger.info("global_step = %s, average loss = %s", global_step, tr_loss / global_step)
+        if self.args.oom_recovery:
+            logger.info(
+                "The micro-batches have been split %d times to recover from out-of-memory errors",
+                total_num_oom_splits + num_oom_splits,
+            )
 
         return model, global_step, tr_loss / global_step
 
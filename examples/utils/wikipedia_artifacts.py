@@ -0,0 +1,139 @@
+import logging
+import multiprocessing
+import os
+import random
+
+import click
+import marisa_trie
+from transformers.tokenization_bert import BasicTokenizer
+from wikipedia2vec.dump_db import DumpDB
+
+from luke.pretraining.dataset import PretrainingExampleWriter
+from luke.utils.entity_vocab import EntityVocabBuilder
+from luke.utils.link_index import LinkIndex
+from luke.utils.sentence_tokenizer import SentenceTokenizer
+from luke.utils.wikipedia_scan import scan_wikipedia
+from luke.utils.word_tokenizer import AutoTokenizer
+
+from ..reading_comprehension.utils.wiki_link_db import WikiLinkDB, WikiLinkExtractor
+from .mention_db import BertLowercaseNormalizer, MentionDB, NameEntityPairExtractor, NameOccurrenceCounter
+
+ENTITY_VOCAB_FILE = "entity_vocab.jsonl"
+DATASET_DIR = "pretraining_dataset"
+MENTION_DB_FILE = "mention_db.pkl"
+WIKI_LINK_DB_FILE = "wiki_link_db.pkl"
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument("dump_db_file", type=click.Path(exists=True))
+@click.argument("tokenizer_name")
+@click.argument("output_dir", type=click.Path(file_okay=False))
+@click.option("--sentence-tokenizer", default="en")
+@click.option("--vocab-size", default=1000000)
+@click.option("--max-seq-length", default=512)
+@click.option("--max-entity-length", default=128)
+@click.option("--max-mention-length", default=30)
+@click.option("--min-sentence-length", default=5)
+@click.option("--include-sentences-without-entities", is_flag=True)
+@click.option("--include-unk-entities/--skip-unk-entities", default=False)
+@click.option("--min-link-prob", default=0.01)
+@click.option("--max-candidate-size", default=100)
+@click.option("--min-link-count", default=1)
+@click.option("--max-name-length", default=20)
+@click.option("--pool-size", default=multiprocessing.cpu_count())
+@click.option("--chunk-size", default=100)
+@click.option("--seed", default=0)
+@click.option("--link-index", type=click.Path(exists=True, file_okay=False), default=None)
+def build_wikipedia_artifacts(
+    dump_db_file: str, tokenizer_name: str, output_dir: str, sentence_tokenizer: str, link_index: str, **kwargs,
+):
+    """
+    Build the entity vocabulary, the pretraining dataset, the mention DB, and the wiki link DB of a Wikipedia dump in
+    two passes over the pages.
+    """
+    dump_db = DumpDB(dump_db_file)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    sentence_tokenizer = SentenceTokenizer.from_name(sentence_tokenizer)
+    if link_index is not None:
+        link_index = LinkIndex(link_index)
+    build_artifacts(dump_db, tokenizer, sentence_tokenizer, output_dir, link_index=link_index, **kwargs)
+
+
+def build_artifacts(
+    dump_db,
+    tokenizer,
+    sentence_tokenizer,
+    output_dir,
+    vocab_size,
+    max_seq_length,
+    max_entity_length,
+    max_mention_length,
+    min_sentence_length,
+    include_sentences_without_entities,
+    include_unk_entities,
+    min_link_prob,
+    max_candidate_size,
+    min_link_count,
+    max_name_length,
+    pool_size,
+    chunk_size,
+    seed,
+    link_index=None,
+):
+    """
+    The entity vocabulary, the names of the entities, and the wiki links are extracted in the first pass, and the
+    pretraining examples, which depend on the entity vocabulary, and the occurrences of the names are extracted in the
+    second pass. The pages are scanned in a random order so that the pretraining examples are shuffled. The shards of
+    the pretraining dataset completed by an interrupted build are reused when the build is restarted with the same seed.
+    """
+    dataset_dir = os.path.join(output_dir, DATASET_DIR)
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    title_trie = marisa_trie.Trie(dump_db.titles())
+    titles = list(title_trie)
+    random.Random(seed).shuffle(titles)
+
+    name_tokenizer = BasicTokenizer(do_lower_case=False)
+    normalizer = BertLowercaseNormalizer()
+    consumers = [
+        EntityVocabBuilder(os.path.join(output_dir, ENTITY_VOCAB_FILE), dump_db.language, vocab_size),
+        PretrainingExampleWriter(
+            dataset_dir,
+            tokenizer,
+            sentence_tokenizer,
+            None,
+            max_seq_length,
+            max_entity_length,
+            max_mention_length,
+            min_sentence_length,
+            include_sentences_without_entities,
+            include_unk_entities,
+            dump_db.language,
+            dump_db_uuid=dump_db.uuid,
+        ),
+        NameEntityPairExtractor(name_tokenizer, normalizer, max_name_length),
+        NameOccurrenceCounter(name_tokenizer, normalizer, max_name_length),
+        WikiLinkExtractor(title_trie),
+    ]
+    results = scan_wikipedia(
+        dump_db, consumers, titles=titles, pool_size=pool_size, chunk_size=chunk_size, link_index=link_index
+    )
+    logger.info("Wrote %d pretraining examples", results["pretraining_dataset"])
+
+    mention_db_file = os.path.join(output_dir, MENTION_DB_FILE)
+    MentionDB.build_from_counts(
+        results["name_entity_pairs"],
+        results["name_occurrences"],
+        name_tokenizer,
+        normalizer,
+        mention_db_file,
+        min_link_prob,
+        max_candidate_size,
+        min_link_count,
+        max_name_length,
+    )
+    WikiLinkDB.build_from_links(
+        title_trie, results["wiki_links"], MentionDB(mention_db_file), os.path.join(output_dir, WIKI_LINK_DB_FILE)
+    )
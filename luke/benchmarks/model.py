@@ -0,0 +1,222 @@
+import contextlib
+import itertools
+import json
+import logging
+import time
+from typing import List, Optional
+
+import click
+import torch
+
+from luke.benchmarks.utils import get_environment, save_results, summarize_times
+from luke.model import EntityEmbeddings, LukeConfig, LukeEntityAwareAttentionModel, LukeModel
+
+logger = logging.getLogger(__name__)
+
+MODEL_CLASSES = dict(
+    luke=LukeModel, entity_aware_attention=LukeEntityAwareAttentionModel, entity_embeddings=EntityEmbeddings
+)
+SHAPE_KEYS = ("batch_size", "word_length", "entity_length", "max_mention_length")
+
+
+def _parse_int_list(ctx, param, value: str) -> List[int]:
+    try:
+        return [int(v) for v in value.split(",")]
+    except ValueError:
+        raise click.BadParameter(f"Invalid comma-separated integers: {value}")
+
+
+@click.command()
+@click.argument("output_file", type=click.Path())
+@click.option("--models", default=",".join(MODEL_CLASSES.keys()))
+@click.option("--word-lengths", default="64,128,256,512", callback=_parse_int_list)
+@click.option("--entity-lengths", default="2,16,64,256", callback=_parse_int_list)
+@click.option("--max-mention-lengths", default="30", callback=_parse_int_list)
+@click.option("--batch-sizes", default="1,8", callback=_parse_int_list)
+@click.option("--mode", type=click.Choice(["inference", "train"]), default="inference")
+@click.option("--hidden-size", default=256)
+@click.option("--num-hidden-layers", default=2)
+@click.option("--num-attention-heads", default=4)
+@click.option("--num-iterations", default=20)
+@click.option("--num-warmup-iterations", default=3)
+@click.option("--num-threads", default=None, type=int)
+@click.option("--baseline-file", type=click.Path(exists=True), default=None)
+@click.option("--seed", default=0)
+def benchmark_model(output_file: str, models: str, num_threads: Optional[int], baseline_file: Optional[str], **kwargs):
+    """
+    Benchmark LukeModel, LukeEntityAwareAttentionModel, and EntityEmbeddings over the input shapes on CPU and save the
+    results as JSON.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    results = run_model_benchmark(models.split(","), **kwargs)
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            compare_with_baseline(results, json.load(f))
+    save_results(results, output_file)
+
+    for record in results["results"]:
+        logger.info(
+            "%s %s: p50 %.2f ms, %.1f sequences/sec, peak memory %.1f MB%s",
+            record["model"],
+            " ".join(f"{key}={record[key]}" for key in SHAPE_KEYS if record[key] is not None),
+            record["latency_seconds"]["p50"] * 1000,
+            record["sequences_per_sec"],
+            record["peak_memory_mb"],
+            f", p50 {record['p50_change']:+.1%} from the baseline" if "p50_change" in record else "",
+        )
+
+
+def run_model_benchmark(
+    models: List[str],
+    word_lengths: List[int],
+    entity_lengths: List[int],
+    max_mention_lengths: List[int],
+    batch_sizes: List[int],
+    mode: str = "inference",
+    hidden_size: int = 256,
+    num_hidden_layers: int = 2,
+    num_attention_heads: int = 4,
+    num_iterations: int = 20,
+    num_warmup_iterations: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Measure the latency, the throughput, and the peak memory of the models for each combination of the input shapes.
+    EntityEmbeddings does not depend on the word length, so it is measured once for each of the other shapes.
+    """
+    config = dict(locals())
+    for model_name in models:
+        if model_name not in MODEL_CLASSES:
+            raise ValueError(f"Unknown model: {model_name}")
+
+    model_config = LukeConfig(
+        vocab_size=1000,
+        entity_vocab_size=1000,
+        bert_model_name="bert-base-uncased",
+        hidden_size=hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=num_attention_heads,
+        intermediate_size=hidden_size * 4,
+        max_position_embeddings=max(word_lengths),
+        type_vocab_size=2,
+    )
+
+    records = []
+    for model_name in models:
+        torch.manual_seed(seed)
+        model = MODEL_CLASSES[model_name](model_config)
+        model.train(mode == "train")
+
+        word_length_list = [None] if model_name == "entity_embeddings" else word_lengths
+        for batch_size, word_length, entity_length, max_mention_length in itertools.product(
+            batch_sizes, word_length_list, entity_lengths, max_mention_lengths
+        ):
+            inputs = create_inputs(
+                batch_size, word_length or max(word_lengths), entity_length, max_mention_length, seed=seed
+            )
+            if model_name == "entity_embeddings":
+                inputs = dict(
+                    entity_ids=inputs["entity_ids"],
+                    position_ids=inputs["entity_position_ids"],
+                    token_type_ids=inputs["entity_segment_ids"],
+                )
+
+            def run():
+                with contextlib.ExitStack() as stack:
+                    if mode == "inference":
+                        stack.enter_context(torch.no_grad())
+                    outputs = model(**inputs)
+                    if mode == "train":
+                        outputs = outputs if isinstance(outputs, torch.Tensor) else outputs[0]
+                        outputs.float().mean().backward()
+                        model.zero_grad()
+
+            times = []
+            for n in range(num_warmup_iterations + num_iterations):
+                start_time = time.perf_counter()
+                run()
+                if n >= num_warmup_iterations:
+                    times.append(time.perf_counter() - start_time)
+
+            latency = summarize_times(times)
+            num_tokens = entity_length + (word_length or 0)
+            records.append(
+                dict(
+                    model=model_name,
+                    batch_size=batch_size,
+                    word_length=word_length,
+                    entity_length=entity_length,
+                    max_mention_length=max_mention_length,
+                    latency_seconds=latency,
+                    sequences_per_sec=batch_size / latency["mean"],
+                    tokens_per_sec=batch_size * num_tokens / latency["mean"],
+                    peak_memory_mb=measure_peak_memory(run) / 2 ** 20,
+                )
+            )
+
+    return dict(benchmark="model", environment=get_environment(), config=config, results=records)
+
+
+def create_inputs(
+    batch_size: int, word_length: int, entity_length: int, max_mention_length: int, seed: int = 0
+) -> dict:
+    """
+    Create random inputs in which each entity has a mention of up to max_mention_length consecutive words.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    mention_length = min(max_mention_length, word_length)
+    starts = torch.randint(0, word_length - mention_length + 1, (batch_size, entity_length), generator=generator)
+    lengths = torch.randint(1, mention_length + 1, (batch_size, entity_length), generator=generator)
+    offsets = torch.arange(max_mention_length)
+    entity_position_ids = starts.unsqueeze(-1) + offsets
+    entity_position_ids[offsets.expand_as(entity_position_ids) >= lengths.unsqueeze(-1)] = -1
+
+    return dict(
+        word_ids=torch.randint(1, 1000, (batch_size, word_length), generator=generator),
+        word_segment_ids=torch.zeros(batch_size, word_length, dtype=torch.long),
+        word_attention_mask=torch.ones(batch_size, word_length, dtype=torch.long),
+        entity_ids=torch.randint(1, 1000, (batch_size, entity_length), generator=generator),
+        entity_position_ids=entity_position_ids,
+        entity_segment_ids=torch.zeros(batch_size, entity_length, dtype=torch.long),
+        entity_attention_mask=torch.ones(batch_size, entity_length, dtype=torch.long),
+    )
+
+
+def measure_peak_memory(func) -> int:
+    """
+    Return the peak memory in bytes allocated by PyTorch operators while running func, relative to the memory
+    allocated before running it. On CPU, the memory is tracked at the granularity of the operators using the profiler.
+    """
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        func()
+
+    memory = peak_memory = 0
+    for _, usage in sorted((e.time_range.start, e.self_cpu_memory_usage) for e in prof.events()):
+        memory += usage
+        peak_memory = max(peak_memory, memory)
+    return peak_memory
+
+
+def compare_with_baseline(results: dict, baseline: dict):
+    """
+    Add the relative change of the median latency from the baseline to each record measured with the same shape.
+    """
+    if baseline["config"]["mode"] != results["config"]["mode"]:
+        logger.warning("The baseline is measured in the %s mode and is not compared", baseline["config"]["mode"])
+        return
+
+    baseline_records = {_get_record_key(record): record for record in baseline["results"]}
+    for record in results["results"]:
+        baseline_record = baseline_records.get(_get_record_key(record))
+        if baseline_record is not None:
+            baseline_p50 = baseline_record["latency_seconds"]["p50"]
+            record["baseline_latency_seconds"] = baseline_record["latency_seconds"]
+            record["p50_change"] = record["latency_seconds"]["p50"] / baseline_p50 - 1.0
+
+
+def _get_record_key(record: dict) -> tuple:
+    return (record["model"],) + tuple(record[key] for key in SHAPE_KEYS)
@@ -0,0 +1,199 @@
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+
+import click
+import numpy as np
+import torch
+from wikipedia2vec.dump_db import DumpDB
+
+from luke.benchmarks.synthetic import LANGUAGE, build_synthetic_resources
+from luke.benchmarks.utils import get_environment, save_results, summarize_times
+from luke.model import LukeConfig
+from luke.pretraining.batch_generator import LukePretrainingBatchWorker
+from luke.pretraining.dataset import WikipediaPretrainingDataset
+from luke.pretraining.model import LukePretrainingModel
+from luke.utils.entity_vocab import EntityVocab
+from luke.utils.sentence_tokenizer import SentenceTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument("output_file", type=click.Path())
+@click.option("--work-dir", type=click.Path(file_okay=False), default=None)
+@click.option("--num-pages", default=200)
+@click.option("--max-seq-length", default=128)
+@click.option("--max-entity-length", default=32)
+@click.option("--max-mention-length", default=16)
+@click.option("--pool-size", default=1)
+@click.option("--num-records", default=1000)
+@click.option("--batch-size", default=8)
+@click.option("--num-batches", default=50)
+@click.option("--num-steps", default=10)
+@click.option("--num-warmup-steps", default=2)
+@click.option("--hidden-size", default=64)
+@click.option("--num-hidden-layers", default=2)
+@click.option("--seed", default=0)
+def benchmark_pipeline(output_file: str, work_dir: str, **kwargs):
+    """
+    Benchmark the pretraining pipeline on synthetic Wikipedia pages and save the results as JSON.
+    """
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_pipeline_benchmark(work_dir, **kwargs)
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+        results = run_pipeline_benchmark(work_dir, **kwargs)
+
+    save_results(results, output_file)
+    for name, result in results["results"].items():
+        logger.info("%s: %s", name, result)
+
+
+def run_pipeline_benchmark(
+    work_dir: str,
+    num_pages: int = 200,
+    max_seq_length: int = 128,
+    max_entity_length: int = 32,
+    max_mention_length: int = 16,
+    pool_size: int = 1,
+    num_records: int = 1000,
+    batch_size: int = 8,
+    num_batches: int = 50,
+    num_steps: int = 10,
+    num_warmup_steps: int = 2,
+    hidden_size: int = 64,
+    num_hidden_layers: int = 2,
+    seed: int = 0,
+) -> dict:
+    """
+    Measure the throughput of each stage of the pretraining pipeline: building the dataset from a DumpDB, reading the
+    records of the dataset, generating masked batches in the batch worker, and the forward and backward passes of a
+    tiny LukePretrainingModel. Only the CPU is used.
+    """
+    import tensorflow as tf
+
+    # datasets are read using the graph mode of TensorFlow 1.x
+    if tf.executing_eagerly():
+        tf.compat.v1.disable_eager_execution()
+
+    config = dict(locals())
+    del config["work_dir"], config["tf"]
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    dump_db_file, tokenizer, entity_vocab_file = build_synthetic_resources(work_dir, num_pages, seed=seed)
+    results = {}
+
+    dataset_dir = os.path.join(work_dir, "dataset")
+    os.makedirs(dataset_dir, exist_ok=True)
+    dump_db = DumpDB(dump_db_file)
+    start_time = time.perf_counter()
+    WikipediaPretrainingDataset.build(
+        dump_db,
+        tokenizer,
+        SentenceTokenizer.from_name(LANGUAGE),
+        EntityVocab(entity_vocab_file),
+        dataset_dir,
+        max_seq_length=max_seq_length,
+        max_entity_length=max_entity_length,
+        max_mention_length=max_mention_length,
+        min_sentence_length=5,
+        include_sentences_without_entities=True,
+        include_unk_entities=False,
+        pool_size=pool_size,
+        chunk_size=10,
+        max_num_documents=None,
+    )
+    elapsed_time = time.perf_counter() - start_time
+    dump_db.close()
+    dataset = WikipediaPretrainingDataset(dataset_dir)
+    results["dataset_build"] = dict(
+        pages=num_pages, items=len(dataset), seconds=elapsed_time, pages_per_sec=num_pages / elapsed_time
+    )
+
+    # the dataset is repeated, so the records can be read more than once
+    iterator = dataset.create_iterator(shuffle_buffer_size=1000, shuffle_seed=seed)
+    next(iterator)  # exclude the time to start the TensorFlow session
+    start_time = time.perf_counter()
+    for _ in itertools.islice(iterator, num_records):
+        pass
+    elapsed_time = time.perf_counter() - start_time
+    iterator.close()
+    results["create_iterator"] = dict(
+        records=num_records, seconds=elapsed_time, records_per_sec=num_records / elapsed_time
+    )
+
+    batch_worker = LukePretrainingBatchWorker(
+        None,
+        dataset_dir,
+        batch_size=batch_size,
+        masked_lm_prob=0.15,
+        masked_entity_prob=0.15,
+        whole_word_masking=True,
+        unmasked_word_prob=0.1,
+        random_word_prob=0.1,
+        unmasked_entity_prob=0.0,
+        random_entity_prob=0.0,
+        mask_words_in_entity_span=False,
+        shuffle_seed=seed,
+    )
+    batch_iterator = batch_worker.generate_batches()
+    batches = [next(batch_iterator)]
+    start_time = time.perf_counter()
+    batches += list(itertools.islice(batch_iterator, num_batches))
+    elapsed_time = time.perf_counter() - start_time
+    batch_iterator.close()
+    results["batch_worker"] = dict(
+        batches=num_batches,
+        batch_size=batch_size,
+        seconds=elapsed_time,
+        batches_per_sec=num_batches / elapsed_time,
+        items_per_sec=num_batches * batch_size / elapsed_time,
+    )
+
+    model_config = LukeConfig(
+        vocab_size=tokenizer.vocab_size,
+        entity_vocab_size=dataset.entity_vocab.size,
+        bert_model_name="bert-base-uncased",
+        entity_emb_size=hidden_size // 2,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=max(1, hidden_size // 32),
+        intermediate_size=hidden_size * 4,
+        max_position_embeddings=max_seq_length,
+        type_vocab_size=2,
+    )
+    model = LukePretrainingModel(model_config)
+    model.train()
+    forward_times = []
+    backward_times = []
+    for batch in itertools.islice(itertools.cycle(batches), num_warmup_steps + num_steps):
+        inputs = {k: torch.from_numpy(v) for k, v in batch.items()}
+        start_time = time.perf_counter()
+        loss = model(**inputs)["loss"]
+        forward_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        loss.backward()
+        backward_times.append(time.perf_counter() - start_time)
+        model.zero_grad()
+
+    forward_times = forward_times[num_warmup_steps:]
+    backward_times = backward_times[num_warmup_steps:]
+    results["train_step"] = dict(
+        steps=num_steps,
+        batch_size=batch_size,
+        num_parameters=sum(p.numel() for p in model.parameters()),
+        forward_seconds=summarize_times(forward_times),
+        backward_seconds=summarize_times(backward_times),
+        step_seconds=summarize_times([f + b for f, b in zip(forward_times, backward_times)]),
+    )
+
+    return dict(benchmark="pipeline", environment=get_environment(), config=config, results=results)
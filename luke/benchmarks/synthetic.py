@@ -0,0 +1,89 @@
+import json
+import os
+import random
+from typing import List
+
+from transformers import BertTokenizer
+from wikipedia2vec.dump_db import DumpDB
+from wikipedia2vec.utils.wiki_page import WikiPage
+
+from luke.utils.entity_vocab import MASK_TOKEN, PAD_TOKEN, UNK_TOKEN
+
+LANGUAGE = "en"
+DUMP_DB_FILE = "synthetic.db"
+TOKENIZER_DIR = "tokenizer"
+ENTITY_VOCAB_FILE = "entity_vocab.jsonl"
+
+
+class SyntheticDumpReader(object):
+    """
+    Generate Wikipedia pages consisting of random words and links to the other pages. The pages are identical for the
+    same seed, so the benchmark results are comparable across commits.
+    """
+
+    dump_file = "synthetic-pages-articles.xml.bz2"
+    language = LANGUAGE
+
+    def __init__(self, num_pages: int, vocab_size: int = 1000, seed: int = 0):
+        self.num_pages = num_pages
+        self.words = [f"word{i}" for i in range(vocab_size)]
+        self.titles = [f"Topic{i}" for i in range(num_pages)]
+        self._seed = seed
+
+    def __iter__(self):
+        rnd = random.Random(self._seed)
+        for title in self.titles:
+            paragraphs = [self._generate_paragraph(rnd) for _ in range(rnd.randint(2, 4))]
+            yield WikiPage(title, self.language, "\n\n".join(paragraphs), None)
+        # redirects to the first pages
+        for title in self.titles[: max(1, self.num_pages // 10)]:
+            yield WikiPage("Alias" + title, self.language, "", title)
+
+    def _generate_paragraph(self, rnd: random.Random) -> str:
+        sentences = []
+        for _ in range(rnd.randint(2, 5)):
+            words = rnd.choices(self.words, k=rnd.randint(8, 20))
+            for _ in range(rnd.randint(0, 2)):
+                index = rnd.randrange(len(words))
+                target = rnd.choice(self.titles)
+                if rnd.random() < 0.5:
+                    words[index] = f"[[{target}]]"
+                else:
+                    words[index] = f"[[{target}|{words[index]} {rnd.choice(self.words)}]]"
+            sentence = " ".join(words)
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        return " ".join(sentences)
+
+
+def build_synthetic_resources(output_dir: str, num_pages: int, seed: int = 0):
+    """
+    Build a DumpDB, a BERT tokenizer, and an entity vocabulary of synthetic pages in output_dir, and return the
+    DumpDB file, the tokenizer, and the entity vocabulary file.
+    """
+    dump_reader = SyntheticDumpReader(num_pages, seed=seed)
+    dump_db_file = os.path.join(output_dir, DUMP_DB_FILE)
+    if os.path.exists(dump_db_file):
+        os.remove(dump_db_file)
+    DumpDB.build(dump_reader, dump_db_file, pool_size=1, chunk_size=100)
+
+    tokenizer_dir = os.path.join(output_dir, TOKENIZER_DIR)
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    vocab_file = os.path.join(tokenizer_dir, "vocab.txt")
+    tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", ":"]
+    tokens += dump_reader.words + [title.lower() for title in dump_reader.titles]
+    with open(vocab_file, "w") as f:
+        for token in tokens:
+            f.write(token + "\n")
+    tokenizer = BertTokenizer(vocab_file)
+
+    entity_vocab_file = os.path.join(output_dir, ENTITY_VOCAB_FILE)
+    _write_entity_vocab(entity_vocab_file, [PAD_TOKEN, UNK_TOKEN, MASK_TOKEN] + dump_reader.titles)
+
+    return dump_db_file, tokenizer, entity_vocab_file
+
+
+def _write_entity_vocab(entity_vocab_file: str, titles: List[str]):
+    with open(entity_vocab_file, "w") as f:
+        for n, title in enumerate(titles):
+            json.dump({"id": n, "entities": [[title, LANGUAGE]], "count": len(titles) - n}, f)
+            f.write("\n")
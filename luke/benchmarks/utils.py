@@ -0,0 +1,59 @@
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import transformers
+
+
+def get_environment() -> dict:
+    """
+    Return the information needed to compare the benchmark results across commits and machines.
+    """
+    return dict(
+        commit=_get_git_commit(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        python_version=platform.python_version(),
+        numpy_version=np.__version__,
+        torch_version=torch.__version__,
+        transformers_version=transformers.__version__,
+        num_threads=torch.get_num_threads(),
+    )
+
+
+def summarize_times(times: List[float]) -> Dict[str, float]:
+    """
+    Return the statistics of the measured times in seconds.
+    """
+    times = np.array(times, dtype=np.float64)
+    return dict(
+        mean=float(times.mean()),
+        std=float(times.std()),
+        min=float(times.min()),
+        p50=float(np.percentile(times, 50)),
+        p90=float(np.percentile(times, 90)),
+        p99=float(np.percentile(times, 99)),
+        max=float(times.max()),
+    )
+
+
+def save_results(results: dict, output_file: str):
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def _get_git_commit() -> Optional[str]:
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf-8").strip()
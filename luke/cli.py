@@ -17,10 +17,14 @@ try:
 except ImportError:
     pass
 
+import luke.benchmarks.model
+import luke.benchmarks.pipeline
+import luke.pretraining.checkpoint
 import luke.pretraining.dataset
 import luke.pretraining.train
 import luke.utils.entity_vocab
 import luke.utils.interwiki_db
+import luke.utils.link_index
 import luke.utils.model_utils
 
 
@@ -53,14 +57,21 @@ def build_dump_db(dump_file: str, out_file: str, **kwargs):
     DumpDB.build(dump_reader, out_file, **kwargs)
 
 
+cli.add_command(luke.utils.link_index.build_link_index)
 cli.add_command(luke.utils.entity_vocab.build_entity_vocab)
+cli.add_command(luke.utils.entity_vocab.merge_entity_vocabs)
 cli.add_command(luke.pretraining.dataset.build_wikipedia_pretraining_dataset)
+cli.add_command(luke.pretraining.dataset.merge_wikipedia_pretraining_datasets)
 cli.add_command(luke.pretraining.train.pretrain)
 cli.add_command(luke.pretraining.train.resume_pretraining)
 cli.add_command(luke.pretraining.train.start_pretraining_worker)
+cli.add_command(luke.pretraining.checkpoint.convert_checkpoint)
 cli.add_command(luke.utils.interwiki_db.build_interwiki_db)
 cli.add_command(luke.utils.entity_vocab.build_multilingual_entity_vocab)
+cli.add_command(luke.utils.entity_vocab.convert_entity_vocab)
 cli.add_command(luke.utils.model_utils.create_model_archive)
+cli.add_command(luke.benchmarks.model.benchmark_model)
+cli.add_command(luke.benchmarks.pipeline.benchmark_pipeline)
 
 
 if __name__ == "__main__":
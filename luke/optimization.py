@@ -1,10 +1,15 @@
 # This code is based on the Transformers' AdamW
 # https://github.com/huggingface/transformers/blob/6be7cdda66f3f4bd3ba4073274bf73be0843c5f9/src/transformers/optimization.py
 
-from typing import Callable, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.optim import Optimizer
 from transformers.optimization import AdamW
 
+from luke.utils.distributed import is_vocab_parallel
+
 
 class LukeAdamW(AdamW):
     def __init__(self, params, *args, grad_avg_device=None, **kwargs):
@@ -73,3 +78,273 @@ class LukeAdamW(AdamW):
             if "exp_avg" in state:
                 state["exp_avg"] = state["exp_avg"].to(self.grad_avg_device)
                 state["exp_avg_sq"] = state["exp_avg_sq"].to(self.grad_avg_device)
+
+
+class ShardedLukeAdamW(Optimizer):
+    """
+    LukeAdamW that partitions the optimizer states across the ranks of the default process group.
+
+    Each rank holds the states of and updates only the parameters assigned to it, and broadcasts the updated
+    parameters to the other ranks after each step. If shard_gradients is enabled, the gradients are not expected to
+    be all-reduced in advance (i.e., the model must not be wrapped with DistributedDataParallel); instead, they are
+    summed on the rank owning the parameter and released on the other ranks. Parameters that do not require
+    gradients are not assigned to any rank, and vocabulary-parallel parameters are always updated locally.
+
+    The state dict of this optimizer contains only the states of the local parameters, indexed in the same way as
+    LukeAdamW. consolidated_state_dict() gathers the states of all ranks into a state dict loadable by LukeAdamW.
+    """
+
+    def __init__(
+        self,
+        params,
+        lr: float = 1e-3,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-6,
+        weight_decay: float = 0.0,
+        grad_avg_device: torch.device = None,
+        shard_gradients: bool = False,
+        bucket_size: int = 2 ** 24,
+    ):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=True)
+        super(ShardedLukeAdamW, self).__init__(params, defaults)
+
+        self.shard_gradients = shard_gradients
+        self._rank = dist.get_rank()
+        self._world_size = dist.get_world_size()
+        self._gradients_reduced = False
+
+        all_params = [p for group in self.param_groups for p in group["params"]]
+        replicated_params = [p for p in all_params if p.requires_grad and not is_vocab_parallel(p)]
+        self._param_owners = self._partition_parameters(replicated_params, self._world_size)
+        self._buckets = self._create_buckets(replicated_params, self._param_owners, self._world_size, bucket_size)
+        # the parameters partitioned across the ranks (e.g., vocabulary-parallel embeddings) are updated locally
+        for param in all_params:
+            if param.requires_grad and is_vocab_parallel(param):
+                self._param_owners[param] = self._rank
+
+        # indices of the local parameters in the state dict
+        self._local_param_indices = []
+        local_param_groups = []
+        index = 0
+        for group in self.param_groups:
+            local_params = []
+            for param in group["params"]:
+                if self._param_owners.get(param) == self._rank:
+                    local_params.append(param)
+                    self._local_param_indices.append(index)
+                index += 1
+            local_param_groups.append(dict(group, params=local_params))
+
+        self._device = all_params[0].device
+        if grad_avg_device is None:
+            grad_avg_device = self._device
+        self._optimizer = LukeAdamW(local_param_groups, grad_avg_device=grad_avg_device)
+
+    @property
+    def local_parameters(self) -> List[torch.nn.Parameter]:
+        return [p for group in self._optimizer.param_groups for p in group["params"]]
+
+    def reduce_gradients(self):
+        """
+        Sum the gradients on the rank owning the parameters. This is performed automatically in step() if
+        shard_gradients is enabled.
+        """
+        if self._gradients_reduced:
+            return
+
+        # the parameters without gradients on all ranks are skipped by the optimizer as in LukeAdamW
+        bucket_params = [p for _, params in self._buckets for p in params]
+        has_grads = torch.tensor([p.grad is not None for p in bucket_params], dtype=torch.int32, device=self._device)
+        dist.all_reduce(has_grads)
+        has_grads = dict(zip(bucket_params, has_grads.tolist()))
+
+        for owner, params in self._buckets:
+            grads = [p.grad.data if p.grad is not None else torch.zeros_like(p.data) for p in params]
+            flat_grads = grads[0] if len(grads) == 1 else _flatten_dense_tensors(grads)
+            dist.reduce(flat_grads, dst=owner)
+            if owner == self._rank:
+                flat_grads.div_(self._world_size)
+                if len(grads) != 1:
+                    grads = _unflatten_dense_tensors(flat_grads, grads)
+                for param, grad in zip(params, grads):
+                    if not has_grads[param]:
+                        param.grad = None
+                    elif param.grad is None:
+                        param.grad = grad
+                    else:
+                        param.grad.data.copy_(grad)
+            else:
+                for param in params:
+                    param.grad = None
+
+        self._gradients_reduced = True
+
+    def clip_grad_norm_(self, max_norm: float) -> torch.Tensor:
+        """
+        Clip the norm of the gradients of all parameters in the process group. This must be called on all ranks.
+        """
+        if self.shard_gradients:
+            self.reduce_gradients()
+
+        grads = [p.grad.data for p in self.local_parameters if p.grad is not None]
+        total_norm = torch.zeros(1, dtype=torch.float32, device=self._device)
+        for grad in grads:
+            total_norm += grad.float().norm() ** 2
+        dist.all_reduce(total_norm)
+        total_norm = total_norm.sqrt()
+
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coef.to(grad.dtype))
+
+        return total_norm
+
+    def step(self, closure: Callable = None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        if self.shard_gradients:
+            self.reduce_gradients()
+
+        # the hyperparameters (e.g., the learning rate) may be modified by the scheduler
+        for group, local_group in zip(self.param_groups, self._optimizer.param_groups):
+            for key, value in group.items():
+                if key != "params":
+                    local_group[key] = value
+
+        self._optimizer.step()
+        self._broadcast_parameters()
+        self._gradients_reduced = False
+
+        return loss
+
+    def state_dict(self) -> Dict[str, Any]:
+        local_state_dict = self._optimizer.state_dict()
+        state = {self._local_param_indices[i]: s for i, s in local_state_dict["state"].items()}
+
+        param_groups = []
+        index = 0
+        for group in self.param_groups:
+            param_group = {k: v for k, v in group.items() if k != "params"}
+            param_group["params"] = list(range(index, index + len(group["params"])))
+            index += len(group["params"])
+            param_groups.append(param_group)
+
+        return dict(state=state, param_groups=param_groups)
+
+    def consolidated_state_dict(self, dst: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Gather the states of all ranks on the rank dst. This must be called on all ranks, and returns None on the ranks
+        other than dst.
+        """
+        state_dict = self.state_dict()
+        state_dict["state"] = {
+            index: {k: v.cpu() if torch.is_tensor(v) else v for k, v in s.items()}
+            for index, s in state_dict["state"].items()
+        }
+        if self._rank == dst:
+            state_dicts = [None] * self._world_size
+            dist.gather_object(state_dict, state_dicts, dst=dst)
+            return merge_optimizer_state_dicts(state_dicts)
+        else:
+            dist.gather_object(state_dict, None, dst=dst)
+            return None
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        """
+        Load either a consolidated state dict or the state dicts of one or more ranks merged by
+        merge_optimizer_state_dicts(). Only the states of the local parameters are retained.
+        """
+        if len(state_dict["param_groups"]) != len(self.param_groups):
+            raise ValueError("loaded state dict has a different number of parameter groups")
+
+        for group, saved_group in zip(self.param_groups, state_dict["param_groups"]):
+            group.update({k: v for k, v in saved_group.items() if k != "params"})
+
+        local_state = {}
+        for local_index, index in enumerate(self._local_param_indices):
+            if index in state_dict["state"]:
+                local_state[local_index] = state_dict["state"][index]
+
+        local_param_groups = []
+        local_index = 0
+        for local_group in self._optimizer.param_groups:
+            param_group = {k: v for k, v in local_group.items() if k != "params"}
+            param_group["params"] = list(range(local_index, local_index + len(local_group["params"])))
+            local_index += len(local_group["params"])
+            local_param_groups.append(param_group)
+
+        self._optimizer.load_state_dict(dict(state=local_state, param_groups=local_param_groups))
+
+    def _broadcast_parameters(self):
+        for owner, params in self._buckets:
+            tensors = [p.data for p in params]
+            if len(tensors) == 1:
+                dist.broadcast(tensors[0], src=owner)
+            else:
+                flat_tensors = _flatten_dense_tensors(tensors)
+                dist.broadcast(flat_tensors, src=owner)
+                if owner != self._rank:
+                    for tensor, synced_tensor in zip(tensors, _unflatten_dense_tensors(flat_tensors, tensors)):
+                        tensor.copy_(synced_tensor)
+
+    @staticmethod
+    def _partition_parameters(params: List[torch.nn.Parameter], world_size: int) -> Dict[torch.nn.Parameter, int]:
+        # greedily assign the largest remaining parameter to the rank with the smallest number of elements
+        sizes = [0] * world_size
+        owners = {}
+        for param in sorted(params, key=lambda p: p.numel(), reverse=True):
+            rank = sizes.index(min(sizes))
+            owners[param] = rank
+            sizes[rank] += param.numel()
+
+        return owners
+
+    @staticmethod
+    def _create_buckets(
+        params: List[torch.nn.Parameter], owners: Dict[torch.nn.Parameter, int], world_size: int, bucket_size: int
+    ) -> List[Tuple[int, List[torch.nn.Parameter]]]:
+        buckets = []
+        for rank in range(world_size):
+            bucket = []
+            bucket_numel = 0
+            for param in params:
+                if owners.get(param) != rank:
+                    continue
+                if bucket and (bucket_numel + param.numel() > bucket_size or param.dtype != bucket[0].dtype):
+                    buckets.append((rank, bucket))
+                    bucket = []
+                    bucket_numel = 0
+                bucket.append(param)
+                bucket_numel += param.numel()
+
+            if bucket:
+                buckets.append((rank, bucket))
+
+        return buckets
+
+
+def merge_optimizer_state_dicts(state_dicts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the state dicts saved by ShardedLukeAdamW on different ranks into a single state dict.
+    """
+    state = {}
+    for state_dict in state_dicts:
+        state.update(state_dict["state"])
+
+    return dict(state=state, param_groups=state_dicts[0]["param_groups"])
+
+
+def split_optimizer_state_dict(state_dict: Dict[str, Any], num_shards: int) -> List[Dict[str, Any]]:
+    """
+    Split the state dict of LukeAdamW into num_shards state dicts by assigning the parameter states in a round-robin
+    fashion. The resulting state dicts can be merged back using merge_optimizer_state_dicts().
+    """
+    return [
+        dict(
+            state={i: s for i, s in state_dict["state"].items() if i % num_shards == shard_index},
+            param_groups=state_dict["param_groups"],
+        )
+        for shard_index in range(num_shards)
+    ]
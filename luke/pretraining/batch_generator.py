@@ -1,4 +1,5 @@
-from typing import List, Iterator
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import atexit
 import functools
 import logging
 import multiprocessing
@@ -32,7 +33,10 @@ class LukePretrainingBatchGenerator(object):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
-        **dataset_kwargs
+        seq_length_schedule: Optional[List[List[int]]] = None,
+        start_step: int = 0,
+        batches_per_step: int = 1,
+        **dataset_kwargs,
     ):
         self._worker_func = functools.partial(
             LukePretrainingBatchWorker,
@@ -46,14 +50,17 @@ class LukePretrainingBatchGenerator(object):
             unmasked_entity_prob=unmasked_entity_prob,
             random_entity_prob=random_entity_prob,
             mask_words_in_entity_span=mask_words_in_entity_span,
-            **dataset_kwargs
+            seq_length_schedule=seq_length_schedule,
+            start_step=start_step,
+            batches_per_step=batches_per_step,
+            **dataset_kwargs,
         )
+        self._online = WikipediaPretrainingDataset(dataset_dir).online
 
     def generate_batches(self, queue_size: int = 10000):
         output_queue = multiprocessing.Queue(queue_size)
         worker = self._worker_func(output_queue)
-        worker.daemon = True
-        worker.start()
+        _start_worker(worker, self._online)
 
         try:
             while True:
@@ -64,7 +71,7 @@ class LukePretrainingBatchGenerator(object):
                     if not worker.is_alive():
                         raise RuntimeError("Worker exited unexpectedly")
         finally:
-            worker.terminate()
+            _terminate_worker(worker)
             output_queue.close()
 
 
@@ -82,7 +89,10 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
-        **dataset_kwargs
+        seq_length_schedule: Optional[List[List[int]]] = None,
+        start_step: int = 0,
+        batches_per_step: int = 1,
+        **dataset_kwargs,
     ):
         super(LukePretrainingBatchWorker, self).__init__()
 
@@ -97,12 +107,23 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         self._unmasked_entity_prob = unmasked_entity_prob
         self._random_entity_prob = random_entity_prob
         self._mask_words_in_entity_span = mask_words_in_entity_span
+        self._seq_length_schedule = seq_length_schedule
+        self._start_step = start_step
+        self._batches_per_step = batches_per_step
         self._dataset_kwargs = dataset_kwargs
 
+        # the training step in which the next batch is used
+        self.current_step = start_step
+
         if "shuffle_buffer_size" not in self._dataset_kwargs:
             self._dataset_kwargs["shuffle_buffer_size"] = batch_size * 1000
 
     def run(self):
+        for num_batches, batch in enumerate(self.generate_batches(), 1):
+            self._output_queue.put(batch, True)
+            self.current_step = self._start_step + num_batches // self._batches_per_step
+
+    def generate_batches(self) -> Iterator[Dict[str, np.ndarray]]:
         self._pretraining_dataset = WikipediaPretrainingDataset(self._dataset_dir)
         self._tokenizer = self._pretraining_dataset.tokenizer
         self._entity_vocab = self._pretraining_dataset.entity_vocab
@@ -121,7 +142,24 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         buf = []
         max_word_len = 1
         max_entity_len = 1
+        max_lengths = None
         for item in self._pretraining_dataset.create_iterator(**self._dataset_kwargs):
+            if self._seq_length_schedule is not None:
+                if not buf:
+                    # the lengths are updated only at the start of each batch
+                    new_max_lengths = get_scheduled_max_lengths(
+                        self._seq_length_schedule, self.current_step, self._max_seq_length, self._max_entity_length
+                    )
+                    if new_max_lengths != max_lengths:
+                        logger.info(
+                            "Truncating the sequences to %d words and %d entities from step %d",
+                            new_max_lengths[0],
+                            new_max_lengths[1],
+                            self.current_step,
+                        )
+                        max_lengths = new_max_lengths
+                item = truncate_item(item, *max_lengths)
+
             entity_feat, masked_entity_positions = self._create_entity_features(
                 item["entity_ids"], item["entity_position_ids"]
             )
@@ -135,7 +173,7 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
                 batch = {}
                 batch.update({k: np.stack([o[0][k][:max_word_len] for o in buf]) for k in buf[0][0].keys()})
                 batch.update({k: np.stack([o[1][k][:max_entity_len] for o in buf]) for k in buf[0][1].keys()})
-                self._output_queue.put(batch, True)
+                yield batch
 
                 buf = []
                 max_word_len = 1
@@ -273,7 +311,12 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
 
 class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
     """
-    Launch a new process in order to avoid data processing being a bottleneck during training.
+    Generate batches from multiple datasets using a pool of worker processes shared across the datasets.
+
+    Each batch is requested from a dataset randomly chosen according to the sampling rate, and the total number of
+    requested but not yet consumed batches is bounded by ``queue_size`` regardless of the number of datasets. The
+    datasets are distributed over the worker processes, and each worker starts reading a dataset only when the first
+    batch of the dataset is requested.
     """
 
     def __init__(
@@ -290,12 +333,16 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
-        **dataset_kwargs
+        seq_length_schedule: Optional[List[List[int]]] = None,
+        start_step: int = 0,
+        batches_per_step: int = 1,
+        num_processes: int = 4,
+        **dataset_kwargs,
     ):
-
-        self.batch_generator_list = [
-            LukePretrainingBatchGenerator(
-                dataset_dir,
+        self._worker_func_list = [
+            functools.partial(
+                LukePretrainingBatchWorker,
+                dataset_dir=dataset_dir,
                 batch_size=batch_size,
                 masked_lm_prob=masked_lm_prob,
                 masked_entity_prob=masked_entity_prob,
@@ -305,15 +352,67 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
                 unmasked_entity_prob=unmasked_entity_prob,
                 random_entity_prob=random_entity_prob,
                 mask_words_in_entity_span=mask_words_in_entity_span,
-                **dataset_kwargs
+                seq_length_schedule=seq_length_schedule,
+                **dataset_kwargs,
             )
             for dataset_dir in dataset_dir_list
         ]
+        self._start_step = start_step
+        self._batches_per_step = batches_per_step
+        self._num_processes = max(1, min(num_processes, len(dataset_dir_list)))
+        self._online = any(WikipediaPretrainingDataset(dataset_dir).online for dataset_dir in dataset_dir_list)
         self.sampling_rate = self.get_sampling_rate(dataset_size_list, sampling_smoothing_factor)
 
     def generate_batches(self, queue_size: int = 10000):
-        batch_iterators = [g.generate_batches(queue_size) for g in self.batch_generator_list]
-        yield from self.sampling_from_iterators(batch_iterators, sampling_rate=self.sampling_rate)
+        process_assignments = self.assign_datasets_to_processes(self.sampling_rate, self._num_processes)
+        output_queue = multiprocessing.Queue(queue_size)
+        request_queues = []
+        workers = []
+        dataset_process_indices = {}
+        for process_index, dataset_indices in enumerate(process_assignments):
+            request_queue = multiprocessing.Queue()
+            worker = MultilingualBatchWorker(
+                request_queue, output_queue, {i: self._worker_func_list[i] for i in dataset_indices}
+            )
+            _start_worker(worker, self._online)
+            request_queues.append(request_queue)
+            workers.append(worker)
+            for dataset_index in dataset_indices:
+                dataset_process_indices[dataset_index] = process_index
+
+        # the batches are generated roughly in the order of the requests, so the training step in which each batch is
+        # used is estimated from the number of preceding requests
+        num_requested_batches = 0
+
+        def request_batches(num_batches: int):
+            nonlocal num_requested_batches
+            for dataset_index in np.random.choice(len(self.sampling_rate), num_batches, p=self.sampling_rate):
+                step = self._start_step + num_requested_batches // self._batches_per_step
+                request_queues[dataset_process_indices[dataset_index]].put((int(dataset_index), step))
+                num_requested_batches += 1
+
+        try:
+            request_batches(queue_size)
+            while True:
+                try:
+                    batch = output_queue.get(True, 1)
+                except queue.Empty:
+                    logger.debug("Queue is empty")
+                    if not all(worker.is_alive() for worker in workers):
+                        raise RuntimeError("Worker exited unexpectedly")
+                    continue
+
+                if batch is None:
+                    break
+                request_batches(1)
+                yield batch
+
+        finally:
+            for worker in workers:
+                _terminate_worker(worker)
+            for request_queue in request_queues:
+                request_queue.close()
+            output_queue.close()
 
     @staticmethod
     def get_sampling_rate(data_size_list: List[int], smoothing_factor: float = 0.7) -> List[float]:
@@ -327,13 +426,120 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
         return [size / size_sum for size in data_size_list]
 
     @staticmethod
-    def sampling_from_iterators(iterators: List[Iterator], sampling_rate: List[float]):
+    def assign_datasets_to_processes(sampling_rate: List[float], num_processes: int) -> List[List[int]]:
         """
-        Randomly choose an iterator according to ``sampling_rate``, and yield an element from it.
+        Greedily assign each dataset to the least loaded process, in descending order of the sampling rate, so that
+        each process receives roughly the same number of batch requests.
         """
+        assignments = [[] for _ in range(num_processes)]
+        loads = [0.0] * num_processes
+        for dataset_index in sorted(range(len(sampling_rate)), key=lambda i: -sampling_rate[i]):
+            process_index = loads.index(min(loads))
+            assignments[process_index].append(dataset_index)
+            loads[process_index] += sampling_rate[dataset_index]
+
+        return [sorted(dataset_indices) for dataset_indices in assignments if dataset_indices]
+
+
+class MultilingualBatchWorker(multiprocessing.Process):
+    def __init__(
+        self,
+        request_queue: multiprocessing.Queue,
+        output_queue: multiprocessing.Queue,
+        worker_funcs: Dict[int, Callable[..., LukePretrainingBatchWorker]],
+    ):
+        super(MultilingualBatchWorker, self).__init__()
+
+        self._request_queue = request_queue
+        self._output_queue = output_queue
+        self._worker_funcs = worker_funcs
+
+    def run(self):
+        batch_workers = {}
+        batch_iterators = {}
         while True:
-            g = np.random.choice(iterators, p=sampling_rate)
+            dataset_index, step = self._request_queue.get()
+            if dataset_index not in batch_iterators:
+                # the batch worker is only used to generate batches in this process and is never started
+                batch_workers[dataset_index] = self._worker_funcs[dataset_index](None)
+                batch_iterators[dataset_index] = batch_workers[dataset_index].generate_batches()
+
+            batch_workers[dataset_index].current_step = step
             try:
-                yield next(g)
+                self._output_queue.put(next(batch_iterators[dataset_index]), True)
             except StopIteration:
-                break
+                self._output_queue.put(None, True)
+                return
+
+
+def parse_seq_length_schedule(schedule: str, num_train_steps: int) -> List[List[int]]:
+    """
+    Parse a sequence length schedule specified as comma-separated phases in the form of
+    end_proportion:max_seq_length[:max_entity_length]. Each phase caps the lengths of the sequences until the given
+    proportion of the training steps, and the lengths are not capped after the last phase. The phases are returned as
+    lists of the end step, the maximum sequence length, and the maximum entity length, or -1 if it is not capped.
+    """
+    phases = []
+    for phase in schedule.split(","):
+        values = phase.split(":")
+        if len(values) not in (2, 3):
+            raise ValueError(f"Invalid phase of the sequence length schedule: {phase}")
+        end_step = int(round(float(values[0]) * num_train_steps))
+        max_seq_length = int(values[1])
+        max_entity_length = int(values[2]) if len(values) == 3 else -1
+        if max_seq_length < 5:
+            # at least three words are needed to mask words
+            raise ValueError(f"The maximum sequence length needs to be at least 5: {phase}")
+        if phases and end_step <= phases[-1][0]:
+            raise ValueError(f"The phases of the sequence length schedule need to be in ascending order: {schedule}")
+        phases.append([end_step, max_seq_length, max_entity_length])
+
+    return phases
+
+
+def get_scheduled_max_lengths(
+    schedule: List[List[int]], step: int, max_seq_length: int, max_entity_length: int
+) -> Tuple[int, int]:
+    """
+    Return the maximum sequence length and the maximum entity length in the given step.
+    """
+    for end_step, phase_max_seq_length, phase_max_entity_length in schedule:
+        if step < end_step:
+            if phase_max_entity_length != -1:
+                max_entity_length = min(max_entity_length, phase_max_entity_length)
+            return min(max_seq_length, phase_max_seq_length), max_entity_length
+
+    return max_seq_length, max_entity_length
+
+
+def truncate_item(item: dict, max_seq_length: int, max_entity_length: int) -> dict:
+    """
+    Truncate the words of the item to fit in max_seq_length including [CLS] and [SEP]. The entities whose mentions do
+    not fit in the truncated words are removed, and the remaining entities are truncated to max_entity_length.
+    """
+    max_num_words = max_seq_length - 2  # 2 for [CLS] and [SEP]
+    if item["word_ids"].size <= max_num_words and item["entity_ids"].size <= max_entity_length:
+        return item
+
+    entity_position_ids = item["entity_position_ids"]
+    entity_indices = np.nonzero((entity_position_ids < max_num_words).all(axis=1))[0][:max_entity_length]
+    ret = dict(item)
+    ret["word_ids"] = item["word_ids"][:max_num_words]
+    ret["entity_ids"] = item["entity_ids"][entity_indices]
+    ret["entity_position_ids"] = entity_position_ids[entity_indices]
+    return ret
+
+
+def _start_worker(worker: multiprocessing.Process, online: bool):
+    # The worker of online datasets processes Wikipedia pages using a pool of child processes, which daemonic
+    # processes are not allowed to create. Instead, the worker is terminated when the main process exits.
+    worker.daemon = not online
+    worker.start()
+    if online:
+        atexit.register(worker.terminate)
+
+
+def _terminate_worker(worker: multiprocessing.Process):
+    worker.terminate()
+    if not worker.daemon:
+        atexit.unregister(worker.terminate)
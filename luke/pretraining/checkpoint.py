@@ -0,0 +1,260 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import click
+import torch
+
+from luke.optimization import merge_optimizer_state_dicts, split_optimizer_state_dict
+from luke.utils.tensor_file import TENSOR_FILE_EXTENSION, is_tensor_file, load_tensor_file, save_tensor_file
+
+logger = logging.getLogger(__name__)
+
+TEMP_FILE_SUFFIX = ".tmp"
+STEP_METADATA_PREFIX = "metadata_step"
+
+
+def copy_to_host(obj):
+    """
+    Return a copy of the object in which all tensors are copied to the host memory. The returned object is not
+    affected by subsequent in-place updates of the original tensors.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        ret = obj.__class__((key, copy_to_host(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):
+            # the version information used by Module.load_state_dict
+            ret._metadata = obj._metadata
+        return ret
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(copy_to_host(value) for value in obj)
+    return obj
+
+
+@contextlib.contextmanager
+def open_atomic(path: str, mode: str):
+    """
+    Open a temporary file which replaces the file at the path once it is successfully written and flushed to disk.
+    """
+    temp_path = path + TEMP_FILE_SUFFIX
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+
+def save_checkpoint_file(state, path: str):
+    """
+    Save the state using the safetensors format if the path has its extension, and using torch.save otherwise.
+    """
+    with open_atomic(path, "wb") as f:
+        if is_tensor_file(path):
+            save_tensor_file(state, f)
+        else:
+            torch.save(state, f)
+
+
+def load_checkpoint_file(path: str):
+    """
+    Load the state saved by save_checkpoint_file. The tensors in safetensors files are lazily memory-mapped.
+    """
+    if is_tensor_file(path):
+        return load_tensor_file(path)
+    return torch.load(path, map_location="cpu")
+
+
+def get_checkpoint_files(metadata: dict) -> List[str]:
+    files = [value for key, value in metadata.items() if key.endswith("_file")]
+    return files + metadata.get("optimizer_files", [])
+
+
+def load_checkpoint_metadata(output_dir: str) -> List[dict]:
+    """
+    Return the metadata of the checkpoints in the output directory sorted by the global step. The metadata file name
+    is stored in the metadata_file key.
+    """
+    ret = []
+    for file_name in os.listdir(output_dir):
+        if file_name.startswith("metadata_") and file_name.endswith(".json") and file_name != "metadata.json":
+            with open(os.path.join(output_dir, file_name)) as f:
+                metadata = json.load(f)
+            metadata["metadata_file"] = file_name
+            ret.append(metadata)
+
+    return sorted(ret, key=lambda m: (m["global_step"], m["metadata_file"]))
+
+
+def remove_old_checkpoints(output_dir: str, keep_last_checkpoints: int):
+    """
+    Remove the checkpoints saved at fixed intervals except the last keep_last_checkpoints ones. The checkpoints saved
+    at the end of each epoch are always kept.
+    """
+    step_metadata_list = [
+        m for m in load_checkpoint_metadata(output_dir) if m["metadata_file"].startswith(STEP_METADATA_PREFIX)
+    ]
+    for metadata in step_metadata_list[: max(len(step_metadata_list) - keep_last_checkpoints, 0)]:
+        # the metadata file is removed first so that it never refers to missing files
+        os.remove(os.path.join(output_dir, metadata["metadata_file"]))
+        for file_name in get_checkpoint_files(metadata):
+            file_path = os.path.join(output_dir, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        logger.info("Removed the checkpoint %s", metadata["metadata_file"])
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints using a background thread.
+
+    The states are copied to the host memory when save is called, so the training can continue while the files are
+    written. Each file is written to a temporary file which is atomically renamed once complete, and the metadata file
+    is written after all the files of the checkpoint, including the ones written by the other ranks, are in place. A
+    metadata file therefore never refers to an incomplete checkpoint. At most one checkpoint is written at a time.
+
+    If the files of the other ranks do not appear within wait_timeout seconds, the checkpoint is abandoned and the
+    error is raised by the next call to save or close.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        keep_last_checkpoints: Optional[int] = None,
+        poll_interval: float = 1.0,
+        wait_timeout: Optional[float] = 3600.0,
+    ):
+        self._output_dir = output_dir
+        self._keep_last_checkpoints = keep_last_checkpoints
+        self._poll_interval = poll_interval
+        self._wait_timeout = wait_timeout
+        self._thread = None
+        self._error = None
+
+    def save(
+        self,
+        states: Dict[str, object],
+        metadata_file: Optional[str] = None,
+        metadata: Optional[dict] = None,
+        wait_for_files: Iterable[str] = (),
+    ):
+        """
+        Write the states to the files specified by the keys of the states argument. If metadata_file is specified, the
+        metadata is written to it after the states and the files in wait_for_files are written.
+        """
+        self.wait()
+        states = {file_name: copy_to_host(state) for file_name, state in states.items()}
+        self._thread = threading.Thread(
+            target=self._write, args=(states, metadata_file, metadata, list(wait_for_files))
+        )
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError("Failed to write the checkpoint") from error
+
+    def close(self):
+        self.wait()
+
+    def _write(
+        self, states: Dict[str, object], metadata_file: Optional[str], metadata: dict, wait_for_files: List[str]
+    ):
+        try:
+            for file_name, state in states.items():
+                save_checkpoint_file(state, os.path.join(self._output_dir, file_name))
+
+            if metadata_file is None:
+                return
+
+            start_time = time.time()
+            for file_name in wait_for_files:
+                while not os.path.exists(os.path.join(self._output_dir, file_name)):
+                    if self._wait_timeout is not None and time.time() - start_time > self._wait_timeout:
+                        raise TimeoutError(f"{file_name} was not written within {self._wait_timeout} seconds")
+                    time.sleep(self._poll_interval)
+
+            with open_atomic(os.path.join(self._output_dir, metadata_file), "w") as f:
+                json.dump(metadata, f, indent=2, sort_keys=True)
+            logger.info("Saved the checkpoint %s", metadata_file)
+
+            if self._keep_last_checkpoints is not None:
+                remove_old_checkpoints(self._output_dir, self._keep_last_checkpoints)
+
+        except Exception as e:
+            self._error = e
+
+
+@click.command()
+@click.argument("output_dir", type=click.Path(exists=True))
+@click.option("--suffix", default=None)
+@click.option("--format", "checkpoint_format", type=click.Choice(["torch", "safetensors"]), default="safetensors")
+@click.option("--num-optimizer-shards", default=1)
+@click.option("--remove-source-files", is_flag=True)
+def convert_checkpoint(
+    output_dir: str, suffix: str, checkpoint_format: str, num_optimizer_shards: int, remove_source_files: bool
+):
+    """
+    Convert the model and optimizer files of the checkpoints saved by pretraining to the specified format.
+    """
+    extension = TENSOR_FILE_EXTENSION if checkpoint_format == "safetensors" else ".bin"
+    with open(os.path.join(output_dir, "metadata.json")) as f:
+        vocab_parallel_entities = json.load(f)["arguments"].get("vocab_parallel_entities", False)
+
+    for metadata in load_checkpoint_metadata(output_dir):
+        metadata_file = metadata.pop("metadata_file")
+        checkpoint_suffix = metadata_file[len("metadata_") : -len(".json")]
+        if suffix is not None and checkpoint_suffix != suffix:
+            continue
+
+        source_files = []
+        model_file = f"model_{checkpoint_suffix}{extension}"
+        if metadata["model_file"] != model_file:
+            source_files.append(metadata["model_file"])
+            save_checkpoint_file(
+                load_checkpoint_file(os.path.join(output_dir, metadata["model_file"])),
+                os.path.join(output_dir, model_file),
+            )
+            metadata["model_file"] = model_file
+
+        optimizer_files = metadata.pop("optimizer_files", [metadata.pop("optimizer_file", None)])
+        optimizer_state_dicts = [load_checkpoint_file(os.path.join(output_dir, f)) for f in optimizer_files]
+        if not vocab_parallel_entities:
+            # the states of the partitioned entity embeddings cannot be redistributed across a different number of ranks
+            optimizer_state_dicts = split_optimizer_state_dict(
+                merge_optimizer_state_dicts(optimizer_state_dicts), num_optimizer_shards
+            )
+        num_shards = len(optimizer_state_dicts)
+        if num_shards == 1 and checkpoint_format == "torch":
+            new_optimizer_files = [f"optimizer_{checkpoint_suffix}{extension}"]
+            metadata["optimizer_file"] = new_optimizer_files[0]
+        else:
+            new_optimizer_files = [
+                f"optimizer_{checkpoint_suffix}_{i:05d}-of-{num_shards:05d}{extension}" for i in range(num_shards)
+            ]
+            metadata["optimizer_files"] = new_optimizer_files
+        for state_dict, file_name in zip(optimizer_state_dicts, new_optimizer_files):
+            save_checkpoint_file(state_dict, os.path.join(output_dir, file_name))
+        source_files += [f for f in optimizer_files if f not in new_optimizer_files]
+
+        with open_atomic(os.path.join(output_dir, metadata_file), "w") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        logger.info("Converted the checkpoint %s", metadata_file)
+
+        if remove_source_files:
+            for file_name in source_files:
+                os.remove(os.path.join(output_dir, file_name))
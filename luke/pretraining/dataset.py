@@ -1,31 +1,56 @@
+import bisect
 import functools
+import hashlib
 import itertools
 import json
+import logging
 import multiprocessing
 import os
 import random
 import re
+import shutil
+import time
 from contextlib import closing
 from multiprocessing.pool import Pool
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
 
 import click
+import numpy as np
 import tensorflow as tf
 from tensorflow.io import TFRecordWriter
 from tensorflow.train import Int64List
-from transformers import PreTrainedTokenizer, RobertaTokenizer
 from tqdm import tqdm
-from wikipedia2vec.dump_db import DumpDB
+from transformers import PreTrainedTokenizer, RobertaTokenizer
+from wikipedia2vec.dump_db import DumpDB, Paragraph
 
 from luke.utils.entity_vocab import UNK_TOKEN, EntityVocab
+from luke.utils.link_index import LinkIndex
 from luke.utils.sentence_tokenizer import SentenceTokenizer
-from luke.utils.model_utils import METADATA_FILE, ENTITY_VOCAB_FILE, get_entity_vocab_file_path
+from luke.utils.model_utils import (
+    BINARY_ENTITY_VOCAB_DIR,
+    METADATA_FILE,
+    ENTITY_VOCAB_FILE,
+    get_entity_vocab_file_path,
+)
+from luke.utils.wikipedia_scan import PageConsumer, partition_titles, scan_page
 from luke.utils.word_tokenizer import AutoTokenizer
 
+logger = logging.getLogger(__name__)
+
 DATASET_FILE = "dataset.tf"
+MANIFEST_FILE = "manifest.json"
+SHARD_FILE_FORMAT = "dataset-{:05d}.tf"
+SHARD_PAGES_FILE_FORMAT = "dataset-{:05d}.pages.json"
+MERGED_SHARD_FILE_FORMAT = "dataset-{:05d}-{:05d}.tf"
+MERGED_SHARD_PAGES_FILE_FORMAT = "dataset-{:05d}-{:05d}.pages.json"
+# the interval in seconds between the saves of the manifest of a dataset written by PretrainingExampleWriter
+MANIFEST_SAVE_INTERVAL = 60
+ONLINE_CACHE_DIR = "online_cache"
 
 # global variables used in pool workers
 _dump_db = _tokenizer = _sentence_tokenizer = _entity_vocab = _max_num_tokens = _max_entity_length = None
 _max_mention_length = _min_sentence_length = _include_sentences_without_entities = _include_unk_entities = None
+_link_index = _previous_dump_db = None
 
 
 @click.command()
@@ -43,18 +68,78 @@ _max_mention_length = _min_sentence_length = _include_sentences_without_entities
 @click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--chunk-size", default=100)
 @click.option("--max-num-documents", default=None, type=int)
+@click.option("--online", is_flag=True)
+@click.option("--online-cache", is_flag=True)
+@click.option("--num-sample-pages", default=1000)
+@click.option("--link-index", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--shard-size", default=1000)
+@click.option("--previous-dataset-dir", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--previous-dump-db-file", type=click.Path(exists=True), default=None)
+@click.option("--num-shards", default=1)
+@click.option("--shard-index", default=0)
 def build_wikipedia_pretraining_dataset(
-    dump_db_file: str, tokenizer_name: str, entity_vocab_file: str, output_dir: str, sentence_tokenizer: str, **kwargs
+    dump_db_file: str,
+    tokenizer_name: str,
+    entity_vocab_file: str,
+    output_dir: str,
+    sentence_tokenizer: str,
+    online: bool,
+    online_cache: bool,
+    num_sample_pages: int,
+    link_index: Optional[str],
+    shard_size: int,
+    previous_dataset_dir: Optional[str],
+    previous_dump_db_file: Optional[str],
+    num_shards: int,
+    shard_index: int,
+    **kwargs,
 ):
-    dump_db = DumpDB(dump_db_file)
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
-    sentence_tokenizer = SentenceTokenizer.from_name(sentence_tokenizer)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     entity_vocab = EntityVocab(entity_vocab_file)
-    WikipediaPretrainingDataset.build(dump_db, tokenizer, sentence_tokenizer, entity_vocab, output_dir, **kwargs)
+    if online:
+        WikipediaPretrainingDataset.build_online(
+            os.path.abspath(dump_db_file),
+            tokenizer,
+            sentence_tokenizer,
+            entity_vocab,
+            output_dir,
+            cache=online_cache,
+            num_sample_pages=num_sample_pages,
+            **kwargs,
+        )
+    else:
+        dump_db = DumpDB(dump_db_file)
+        sentence_tokenizer = SentenceTokenizer.from_name(sentence_tokenizer)
+        if link_index is not None:
+            link_index = LinkIndex(link_index)
+        previous_dump_db = None
+        if previous_dump_db_file is not None:
+            previous_dump_db = DumpDB(previous_dump_db_file)
+        WikipediaPretrainingDataset.build(
+            dump_db,
+            tokenizer,
+            sentence_tokenizer,
+            entity_vocab,
+            output_dir,
+            link_index=link_index,
+            shard_size=shard_size,
+            previous_dataset_dir=previous_dataset_dir,
+            previous_dump_db=previous_dump_db,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            **kwargs,
+        )
+
+
+@click.command()
+@click.argument("output_dir", type=click.Path(file_okay=False))
+@click.argument("dataset_dirs", type=click.Path(exists=True, file_okay=False), nargs=-1, required=True)
+def merge_wikipedia_pretraining_datasets(output_dir: str, dataset_dirs: List[str]):
+    WikipediaPretrainingDataset.merge_datasets(list(dataset_dirs), output_dir)
 
 
 class WikipediaPretrainingDataset(object):
@@ -97,6 +182,10 @@ class WikipediaPretrainingDataset(object):
         vocab_file_path = get_entity_vocab_file_path(self._dataset_dir)
         return EntityVocab(vocab_file_path)
 
+    @property
+    def online(self):
+        return self.metadata.get("online", False)
+
     def create_iterator(
         self,
         skip: int = 0,
@@ -105,6 +194,29 @@ class WikipediaPretrainingDataset(object):
         shuffle_buffer_size: int = 1000,
         shuffle_seed: int = 0,
         num_parallel_reads: int = 10,
+    ):
+        if self.online:
+            yield from self._create_online_iterator(skip, num_workers, worker_index, shuffle_buffer_size, shuffle_seed)
+        else:
+            # the shards are read in a random order as each shard contains the pages in a range of titles
+            dataset_files = [
+                os.path.join(self._dataset_dir, file_name)
+                for file_name in self.metadata.get("dataset_files", [DATASET_FILE])
+            ]
+            random.Random(shuffle_seed).shuffle(dataset_files)
+            yield from self._create_tfrecord_iterator(
+                dataset_files, skip, num_workers, worker_index, shuffle_buffer_size, shuffle_seed, num_parallel_reads,
+            )
+
+    def _create_tfrecord_iterator(
+        self,
+        dataset_files: List[str],
+        skip: int,
+        num_workers: int,
+        worker_index: int,
+        shuffle_buffer_size: int,
+        shuffle_seed: int,
+        num_parallel_reads: int,
     ):
         features = dict(
             word_ids=tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
@@ -113,9 +225,7 @@ class WikipediaPretrainingDataset(object):
             page_id=tf.io.FixedLenFeature([1], tf.int64),
         )
         dataset = tf.data.TFRecordDataset(
-            [os.path.join(self._dataset_dir, DATASET_FILE)],
-            compression_type="GZIP",
-            num_parallel_reads=num_parallel_reads,
+            dataset_files, compression_type="GZIP", num_parallel_reads=num_parallel_reads,
         )
         dataset = dataset.repeat()
         dataset = dataset.shuffle(shuffle_buffer_size, seed=shuffle_seed)
@@ -138,6 +248,124 @@ class WikipediaPretrainingDataset(object):
             except tf.errors.OutOfRangeError:
                 pass
 
+    def _create_online_iterator(
+        self, skip: int, num_workers: int, worker_index: int, shuffle_buffer_size: int, shuffle_seed: int
+    ):
+        """
+        Generate items by processing the pages of the Wikipedia dump on the fly. The pages are partitioned across
+        workers and shuffled in each epoch. If the cache is enabled, the items generated in the first complete epoch
+        are written to a TFRecord file, which is used in the subsequent epochs.
+        """
+        dump_db = DumpDB(self.metadata["dump_db_file"])
+        target_titles = self._get_target_titles(
+            dump_db, self.metadata["max_num_documents"], random.Random(shuffle_seed)
+        )
+        target_titles = target_titles[worker_index::num_workers]
+
+        cache_file = None
+        if self.metadata["online_cache"]:
+            cache_dir = os.path.join(self._dataset_dir, ONLINE_CACHE_DIR)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            cache_file = os.path.join(cache_dir, f"dataset-{worker_index:05d}-of-{num_workers:05d}.tf")
+            if os.path.exists(cache_file):
+                yield from self._create_tfrecord_iterator(
+                    [cache_file], skip // num_workers, 1, 0, shuffle_buffer_size, shuffle_seed, 1
+                )
+                return
+
+        # the items are skipped at the page level based on the average number of items per page
+        items_per_page = len(self) / max(1, self.metadata["number_of_target_pages"])
+        num_skipped_pages = int(skip / num_workers / items_per_page) if items_per_page > 0 else 0
+        epoch, offset = divmod(num_skipped_pages, max(1, len(target_titles)))
+
+        initargs = (
+            dump_db,
+            self.tokenizer,
+            SentenceTokenizer.from_name(self.metadata["sentence_tokenizer"]),
+            self.entity_vocab,
+            self.max_seq_length - 2,  # 2 for [CLS] and [SEP]
+            self.max_entity_length,
+            self.max_mention_length,
+            self.metadata["min_sentence_length"],
+            self.metadata["include_sentences_without_entities"],
+            self.metadata["include_unk_entities"],
+        )
+        pool_size = max(1, self.metadata["pool_size"] // num_workers)
+        rnd = random.Random(shuffle_seed)
+        with closing(
+            Pool(pool_size, initializer=WikipediaPretrainingDataset._initialize_worker, initargs=initargs)
+        ) as pool:
+            while True:
+                epoch_titles = list(target_titles)
+                random.Random(shuffle_seed + epoch).shuffle(epoch_titles)
+
+                writer = None
+                if cache_file is not None and offset == 0:
+                    options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+                    writer = TFRecordWriter(cache_file + ".tmp", options=options)
+
+                def generate_items():
+                    for ret in pool.imap_unordered(
+                        WikipediaPretrainingDataset._process_page,
+                        epoch_titles[offset:],
+                        chunksize=self.metadata["chunk_size"],
+                    ):
+                        for data in ret:
+                            if writer is not None:
+                                writer.write(data)
+                            yield self._parse_example(data)
+
+                yield from _shuffle(generate_items(), shuffle_buffer_size, rnd)
+
+                if writer is not None:
+                    writer.close()
+                    os.replace(cache_file + ".tmp", cache_file)
+                    logger.info("Cached the generated items in %s", cache_file)
+                    yield from self._create_tfrecord_iterator(
+                        [cache_file], 0, 1, 0, shuffle_buffer_size, shuffle_seed + epoch + 1, 1
+                    )
+                    return
+
+                epoch += 1
+                offset = 0
+
+    def _parse_example(self, data: bytes) -> dict:
+        feature = tf.train.Example.FromString(data).features.feature
+        return dict(
+            page_id=feature["page_id"].int64_list.value[0],
+            word_ids=np.array(feature["word_ids"].int64_list.value, dtype=np.int64),
+            entity_ids=np.array(feature["entity_ids"].int64_list.value, dtype=np.int64),
+            entity_position_ids=np.array(feature["entity_position_ids"].int64_list.value, dtype=np.int64).reshape(
+                -1, self.max_mention_length
+            ),
+        )
+
+    @staticmethod
+    def _get_target_titles(dump_db: DumpDB, max_num_documents: int, rnd: random.Random = random) -> List[str]:
+        target_titles = [title for title in dump_db.titles() if WikipediaPretrainingDataset._is_target_title(title)]
+        rnd.shuffle(target_titles)
+
+        if max_num_documents is not None:
+            target_titles = target_titles[:max_num_documents]
+
+        return target_titles
+
+    @staticmethod
+    def _is_target_title(title: str) -> bool:
+        return not (":" in title and title.lower().split(":")[0] in ("image", "file", "category"))
+
+    @staticmethod
+    def _get_sorted_target_titles(dump_db: DumpDB, max_num_documents: int) -> List[str]:
+        target_titles = [title for title in dump_db.titles() if WikipediaPretrainingDataset._is_target_title(title)]
+        if max_num_documents is not None:
+            # the pages are selected based on the hashes of the titles so that the same pages are selected when the
+            # build is resumed
+            target_titles.sort(key=lambda title: hashlib.md5(title.encode("utf-8")).digest())
+            target_titles = target_titles[:max_num_documents]
+
+        return sorted(target_titles)
+
     @classmethod
     def build(
         cls,
@@ -155,59 +383,374 @@ class WikipediaPretrainingDataset(object):
         pool_size: int,
         chunk_size: int,
         max_num_documents: int,
+        link_index: LinkIndex = None,
+        shard_size: int = 1000,
+        previous_dataset_dir: str = None,
+        previous_dump_db: DumpDB = None,
+        num_shards: int = 1,
+        shard_index: int = 0,
     ):
+        """
+        Write the examples to shards each of which contains the pages in a range of titles. The completed shards are
+        recorded in the manifest file in output_dir, and the build is resumed from the manifest if it is restarted with
+        the same dump and settings.
 
-        target_titles = [
-            title
-            for title in dump_db.titles()
-            if not (":" in title and title.lower().split(":")[0] in ("image", "file", "category"))
-        ]
-        random.shuffle(target_titles)
+        If the previous dataset and the DumpDB it is built from are specified, the shards are split at the same titles
+        as the previous dataset, and only the pages whose text or links are changed from the previous DumpDB are
+        processed. The examples of the other pages are copied from the previous shards, and the shards whose pages are
+        all unchanged are reused as they are. Smaller shards are reused more often.
 
-        if max_num_documents is not None:
-            target_titles = target_titles[:max_num_documents]
+        Each shard is written directly by a pool worker, and the shards are processed in parallel. chunk_size is not
+        used as the shards are the units of the work assigned to the workers.
 
-        max_num_tokens = max_seq_length - 2  # 2 for [CLS] and [SEP]
+        If num_shards is larger than one, only the pages in the shard_index-th partition of the titles are processed so
+        that a build can be distributed across machines. The datasets of the partitions are combined using
+        merge_datasets. A merged dataset can be used as the previous dataset of the builds of the partitions with the
+        same number of partitions.
+        """
+        if (previous_dataset_dir is None) != (previous_dump_db is None):
+            raise ValueError("Both previous_dataset_dir and previous_dump_db need to be specified")
+        if link_index is not None:
+            link_index.check_dump_db(dump_db)
 
         tokenizer.save_pretrained(output_dir)
-
         entity_vocab.save(os.path.join(output_dir, ENTITY_VOCAB_FILE))
-        number_of_items = 0
-        tf_file = os.path.join(output_dir, DATASET_FILE)
+        if entity_vocab.binary:
+            entity_vocab.save_binary(os.path.join(output_dir, BINARY_ENTITY_VOCAB_DIR))
+
+        metadata = dict(
+            max_seq_length=max_seq_length,
+            max_entity_length=max_entity_length,
+            max_mention_length=max_mention_length,
+            min_sentence_length=min_sentence_length,
+            include_sentences_without_entities=include_sentences_without_entities,
+            include_unk_entities=include_unk_entities,
+            tokenizer_class=tokenizer.__class__.__name__,
+            language=dump_db.language,
+        )
+        # the examples of two datasets are interchangeable only if they are built with the same entity vocabulary
+        settings = dict(metadata, entity_vocab_md5=_get_file_md5(os.path.join(output_dir, ENTITY_VOCAB_FILE)))
+
+        previous_shards = {}
+        if previous_dataset_dir is not None:
+            previous_manifest = _load_manifest(previous_dataset_dir)
+            if previous_manifest is None:
+                raise ValueError(f"{previous_dataset_dir} does not contain a manifest file")
+            if previous_manifest["settings"] != settings:
+                raise ValueError(f"The dataset in {previous_dataset_dir} is built with different settings")
+            previous_shard_list = previous_manifest["shards"]
+            if any("start" not in shard for shard in previous_shard_list):
+                raise ValueError(f"The shards of the dataset in {previous_dataset_dir} are not split at titles")
+            if "shard_index" not in previous_manifest["build_args"]:
+                # the shards of a merged dataset are only ordered within each partition of the titles
+                if previous_manifest["build_args"]["num_shards"] != num_shards:
+                    raise ValueError(
+                        f"The merged dataset in {previous_dataset_dir} is built from "
+                        f"{previous_manifest['build_args']['num_shards']} partitions, but {num_shards} are specified"
+                    )
+                previous_shard_list = [shard for shard in previous_shard_list if shard["shard_index"] == shard_index]
+            previous_shards = {shard["start"]: shard for shard in previous_shard_list}
+
+        target_titles = cls._get_sorted_target_titles(dump_db, max_num_documents)
+        target_titles = partition_titles(target_titles, num_shards, shard_index)
+        build_args = dict(
+            dump_db_uuid=dump_db.uuid,
+            max_num_documents=max_num_documents,
+            shard_size=shard_size,
+            num_shards=num_shards,
+            shard_index=shard_index,
+        )
+        manifest = _load_manifest(output_dir)
+        if manifest is not None and manifest["build_args"] == build_args and manifest["settings"] == settings:
+            logger.info(
+                "Resuming the build: %d of %d shards are completed",
+                sum(shard["completed"] for shard in manifest["shards"]),
+                len(manifest["shards"]),
+            )
+        else:
+            if manifest is not None:
+                logger.warning("The existing manifest in %s is built with different settings and ignored", output_dir)
+            if previous_shards:
+                starts = sorted(previous_shards.keys())
+            else:
+                starts = [""] + target_titles[shard_size::shard_size]
+            shards = []
+            for (index, start) in enumerate(starts):
+                end = starts[index + 1] if index + 1 < len(starts) else None
+                shards.append(
+                    dict(
+                        start=start,
+                        end=end,
+                        file=SHARD_FILE_FORMAT.format(index),
+                        pages_file=SHARD_PAGES_FILE_FORMAT.format(index),
+                        completed=False,
+                        number_of_pages=None,
+                        number_of_items=None,
+                    )
+                )
+            manifest = dict(build_args=build_args, settings=settings, shards=shards)
+            _save_manifest(output_dir, manifest)
+
+        # the pages in a shard are shuffled so that the examples of the pages with similar titles are not consecutive
+        shards = manifest["shards"]
+        starts = [shard["start"] for shard in shards]
+        shard_titles = [[] for _ in shards]
+        for title in target_titles:
+            shard_titles[bisect.bisect_right(starts, title) - 1].append(title)
+        for (shard, titles) in zip(shards, shard_titles):
+            random.Random(shard["start"]).shuffle(titles)
+
+        initargs = (
+            dump_db,
+            tokenizer,
+            sentence_tokenizer,
+            entity_vocab,
+            max_seq_length - 2,  # 2 for [CLS] and [SEP]
+            max_entity_length,
+            max_mention_length,
+            min_sentence_length,
+            include_sentences_without_entities,
+            include_unk_entities,
+            link_index,
+            previous_dump_db,
+        )
+        # each shard is written by a single worker, and the parent only records the numbers of the items of the shards
+        tasks = [
+            (index, output_dir, shard, titles, previous_dataset_dir, previous_shards.get(shard["start"]))
+            for (index, (shard, titles)) in enumerate(zip(shards, shard_titles))
+            if not shard["completed"]
+        ]
+        with tqdm(total=len(target_titles), mininterval=0.5) as pbar:
+            pbar.update(sum(shard["number_of_pages"] for shard in shards if shard["completed"]))
+            with closing(Pool(pool_size, initializer=cls._initialize_worker, initargs=initargs)) as pool:
+                for (index, number_of_items) in pool.imap_unordered(cls._build_shard, tasks):
+                    shards[index].update(
+                        completed=True, number_of_pages=len(shard_titles[index]), number_of_items=number_of_items
+                    )
+                    _save_manifest(output_dir, manifest)
+                    pbar.update(len(shard_titles[index]))
+
+        with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_file:
+            json.dump(
+                dict(
+                    number_of_items=sum(shard["number_of_items"] for shard in shards),
+                    dataset_files=[shard["file"] for shard in shards],
+                    **metadata,
+                ),
+                metadata_file,
+                indent=2,
+            )
+
+    @staticmethod
+    def _build_shard(args: tuple) -> Tuple[int, int]:
+        index, *write_args = args
+        return index, WikipediaPretrainingDataset._write_shard(*write_args)
+
+    @staticmethod
+    def _write_shard(
+        output_dir: str,
+        shard: dict,
+        titles: List[str],
+        previous_dataset_dir: Optional[str],
+        previous_shard: Optional[dict],
+    ) -> int:
+        """
+        Write the examples of the pages to the shard and return the number of the examples. The examples of the pages
+        that are unchanged from the previous dataset are copied from the previous shard.
+        """
+        shard_file = os.path.join(output_dir, shard["file"])
+        pages_file = os.path.join(output_dir, shard["pages_file"])
+
+        previous_items = {}
+        if previous_shard is not None and previous_shard["completed"]:
+            with open(os.path.join(previous_dataset_dir, previous_shard["pages_file"])) as f:
+                previous_pages = json.load(f)
+            previous_titles = [title for title, _ in previous_pages]
+            previous_title_set = frozenset(previous_titles)
+            candidate_titles = [title for title in titles if title in previous_title_set]
+            unchanged_titles = frozenset(
+                title for title in candidate_titles if not WikipediaPretrainingDataset._is_page_changed(title)
+            )
+
+            if previous_titles == titles and len(unchanged_titles) == len(titles):
+                shutil.copyfile(os.path.join(previous_dataset_dir, previous_shard["file"]), shard_file)
+                shutil.copyfile(os.path.join(previous_dataset_dir, previous_shard["pages_file"]), pages_file)
+                return previous_shard["number_of_items"]
+
+            options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+            records = tf.compat.v1.io.tf_record_iterator(
+                os.path.join(previous_dataset_dir, previous_shard["file"]), options=options
+            )
+            for (title, number_of_items) in previous_pages:
+                items = list(itertools.islice(records, number_of_items))
+                if title in unchanged_titles:
+                    previous_items[title] = items
+
+        pages = []
         options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
-        with TFRecordWriter(tf_file, options=options) as writer:
-            with tqdm(total=len(target_titles)) as pbar:
-                initargs = (
-                    dump_db,
-                    tokenizer,
-                    sentence_tokenizer,
-                    entity_vocab,
-                    max_num_tokens,
-                    max_entity_length,
-                    max_mention_length,
-                    min_sentence_length,
-                    include_sentences_without_entities,
-                    include_unk_entities,
+        # the shard is written to a temporary file so that an incomplete shard is not left if the build is interrupted
+        writer = TFRecordWriter(shard_file + ".tmp", options=options)
+        for title in titles:
+            if title in previous_items:
+                items = previous_items[title]
+            else:
+                items = WikipediaPretrainingDataset._process_page(title)
+            for data in items:
+                writer.write(data)
+            pages.append((title, len(items)))
+        writer.close()
+
+        with open(pages_file, "w") as f:
+            json.dump(pages, f)
+        os.replace(shard_file + ".tmp", shard_file)
+
+        return sum(number_of_items for _, number_of_items in pages)
+
+    @staticmethod
+    def merge_datasets(dataset_dirs: List[str], output_dir: str):
+        """
+        Combine the datasets built from all the partitions of the titles into a dataset in output_dir. The shards are
+        hard-linked into output_dir if possible, and copied otherwise. The manifest of the merged dataset records the
+        partition of each shard so that the dataset can be used as the previous dataset of incremental builds.
+        """
+        manifests = [_load_manifest(dataset_dir) for dataset_dir in dataset_dirs]
+        for (dataset_dir, manifest) in zip(dataset_dirs, manifests):
+            if manifest is None or not all(shard["completed"] for shard in manifest["shards"]):
+                raise ValueError(f"The build of the dataset in {dataset_dir} is not completed")
+            if manifest["settings"] != manifests[0]["settings"]:
+                raise ValueError(f"The dataset in {dataset_dir} is built with different settings")
+
+        def get_common_build_args(manifest: dict) -> dict:
+            return {k: v for k, v in manifest["build_args"].items() if k != "shard_index"}
+
+        build_args = get_common_build_args(manifests[0])
+        shard_indices = sorted(manifest["build_args"]["shard_index"] for manifest in manifests)
+        if any(get_common_build_args(manifest) != build_args for manifest in manifests) or shard_indices != list(
+            range(build_args["num_shards"])
+        ):
+            raise ValueError("The datasets are not built from all the partitions of the same dump")
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        datasets = [WikipediaPretrainingDataset(dataset_dir) for dataset_dir in dataset_dirs]
+        datasets[0].tokenizer.save_pretrained(output_dir)
+        datasets[0].entity_vocab.save(os.path.join(output_dir, ENTITY_VOCAB_FILE))
+        binary_entity_vocab_dir = os.path.join(dataset_dirs[0], BINARY_ENTITY_VOCAB_DIR)
+        if os.path.isdir(binary_entity_vocab_dir):
+            EntityVocab(binary_entity_vocab_dir).save_binary(os.path.join(output_dir, BINARY_ENTITY_VOCAB_DIR))
+
+        def link_file(source_file: str, target_file: str):
+            if os.path.exists(target_file):
+                os.remove(target_file)
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                shutil.copyfile(source_file, target_file)
+
+        merged_shards = []
+        for (dataset_dir, manifest) in sorted(
+            zip(dataset_dirs, manifests), key=lambda x: x[1]["build_args"]["shard_index"]
+        ):
+            shard_index = manifest["build_args"]["shard_index"]
+            for (index, shard) in enumerate(manifest["shards"]):
+                merged_shard = dict(
+                    shard,
+                    file=MERGED_SHARD_FILE_FORMAT.format(shard_index, index),
+                    pages_file=MERGED_SHARD_PAGES_FILE_FORMAT.format(shard_index, index),
+                    shard_index=shard_index,
                 )
-                with closing(
-                    Pool(pool_size, initializer=WikipediaPretrainingDataset._initialize_worker, initargs=initargs)
-                ) as pool:
-                    for ret in pool.imap(
-                        WikipediaPretrainingDataset._process_page, target_titles, chunksize=chunk_size
-                    ):
-                        for data in ret:
-                            writer.write(data)
-                            number_of_items += 1
-                        pbar.update()
+                for key in ("file", "pages_file"):
+                    link_file(os.path.join(dataset_dir, shard[key]), os.path.join(output_dir, merged_shard[key]))
+                merged_shards.append(merged_shard)
+
+        _save_manifest(output_dir, dict(build_args=build_args, settings=manifests[0]["settings"], shards=merged_shards))
 
         with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_file:
             json.dump(
                 dict(
+                    datasets[0].metadata,
+                    number_of_items=sum(len(dataset) for dataset in datasets),
+                    dataset_files=[shard["file"] for shard in merged_shards],
+                ),
+                metadata_file,
+                indent=2,
+            )
+
+    @classmethod
+    def build_online(
+        cls,
+        dump_db_file: str,
+        tokenizer: PreTrainedTokenizer,
+        sentence_tokenizer_name: str,
+        entity_vocab: EntityVocab,
+        output_dir: str,
+        max_seq_length: int,
+        max_entity_length: int,
+        max_mention_length: int,
+        min_sentence_length: int,
+        include_sentences_without_entities: bool,
+        include_unk_entities: bool,
+        pool_size: int,
+        chunk_size: int,
+        max_num_documents: int,
+        cache: bool,
+        num_sample_pages: int,
+    ):
+        """
+        Create a dataset whose items are generated from the Wikipedia dump during training. Only the tokenizer, the
+        entity vocabulary, and the metadata are written here. The number of items is estimated from a random sample
+        of pages.
+        """
+        dump_db = DumpDB(dump_db_file)
+        target_titles = cls._get_target_titles(dump_db, max_num_documents)
+
+        tokenizer.save_pretrained(output_dir)
+        entity_vocab.save(os.path.join(output_dir, ENTITY_VOCAB_FILE))
+        if entity_vocab.binary:
+            entity_vocab.save_binary(os.path.join(output_dir, BINARY_ENTITY_VOCAB_DIR))
+
+        sample_titles = target_titles[:num_sample_pages]
+        initargs = (
+            dump_db,
+            tokenizer,
+            SentenceTokenizer.from_name(sentence_tokenizer_name),
+            entity_vocab,
+            max_seq_length - 2,  # 2 for [CLS] and [SEP]
+            max_entity_length,
+            max_mention_length,
+            min_sentence_length,
+            include_sentences_without_entities,
+            include_unk_entities,
+        )
+        num_sample_items = 0
+        with closing(
+            Pool(pool_size, initializer=WikipediaPretrainingDataset._initialize_worker, initargs=initargs)
+        ) as pool:
+            for ret in pool.imap_unordered(
+                WikipediaPretrainingDataset._process_page, sample_titles, chunksize=chunk_size
+            ):
+                num_sample_items += len(ret)
+
+        number_of_items = int(round(num_sample_items / max(1, len(sample_titles)) * len(target_titles)))
+
+        with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_file:
+            json.dump(
+                dict(
+                    online=True,
+                    online_cache=cache,
+                    dump_db_file=dump_db_file,
+                    sentence_tokenizer=sentence_tokenizer_name,
                     number_of_items=number_of_items,
+                    number_of_target_pages=len(target_titles),
+                    max_num_documents=max_num_documents,
                     max_seq_length=max_seq_length,
                     max_entity_length=max_entity_length,
                     max_mention_length=max_mention_length,
                     min_sentence_length=min_sentence_length,
+                    include_sentences_without_entities=include_sentences_without_entities,
+                    include_unk_entities=include_unk_entities,
+                    pool_size=pool_size,
+                    chunk_size=chunk_size,
                     tokenizer_class=tokenizer.__class__.__name__,
                     language=dump_db.language,
                 ),
@@ -227,10 +770,12 @@ class WikipediaPretrainingDataset(object):
         min_sentence_length: int,
         include_sentences_without_entities: bool,
         include_unk_entities: bool,
+        link_index: LinkIndex = None,
+        previous_dump_db: DumpDB = None,
     ):
         global _dump_db, _tokenizer, _sentence_tokenizer, _entity_vocab, _max_num_tokens, _max_entity_length
         global _max_mention_length, _min_sentence_length, _include_sentences_without_entities, _include_unk_entities
-        global _language
+        global _language, _link_index, _previous_dump_db
 
         _dump_db = dump_db
         _tokenizer = tokenizer
@@ -243,9 +788,26 @@ class WikipediaPretrainingDataset(object):
         _include_sentences_without_entities = include_sentences_without_entities
         _include_unk_entities = include_unk_entities
         _language = dump_db.language
+        _link_index = link_index
+        _previous_dump_db = previous_dump_db
 
     @staticmethod
     def _process_page(page_title: str):
+        return WikipediaPretrainingDataset._create_examples(page_title, scan_page(_dump_db, page_title, _link_index))
+
+    @staticmethod
+    def _is_page_changed(page_title: str) -> bool:
+        def get_contents(paragraphs: List[Paragraph]) -> list:
+            return [
+                (paragraph.text, [(link.title, link.start, link.end) for link in paragraph.wiki_links])
+                for paragraph in paragraphs
+            ]
+
+        paragraphs = scan_page(_dump_db, page_title, _link_index)
+        return get_contents(paragraphs) != get_contents(scan_page(_previous_dump_db, page_title))
+
+    @staticmethod
+    def _create_examples(page_title: str, paragraphs: List[Paragraph]) -> List[bytes]:
         if _entity_vocab.contains(page_title, _language):
             page_id = _entity_vocab.get_id(page_title, _language)
         else:
@@ -262,7 +824,7 @@ class WikipediaPretrainingDataset(object):
             else:
                 return _tokenizer.tokenize(text)
 
-        for paragraph in _dump_db.get_paragraphs(page_title):
+        for paragraph in paragraphs:
 
             paragraph_text = paragraph.text
 
@@ -271,7 +833,7 @@ class WikipediaPretrainingDataset(object):
             # (link_start, link_end).
             paragraph_links = []
             for link in paragraph.wiki_links:
-                link_title = _dump_db.resolve_redirect(link.title)
+                link_title = link.title
                 # remove category links
                 if link_title.startswith("Category:") and link.text.lower().startswith("category:"):
                     paragraph_text = (
@@ -357,3 +919,259 @@ class WikipediaPretrainingDataset(object):
                 words = []
                 links = []
         return ret
+
+
+class PretrainingExampleWriter(PageConsumer):
+    """
+    A consumer of scan_wikipedia that writes the pretraining examples of the pages to a dataset in output_dir. If
+    entity_vocab is None, the entity vocabulary built by the consumer named entity_vocab is used. Only the pages in
+    target_titles are used if specified, and the pages of images, files, and categories are skipped otherwise.
+
+    The examples of each chunk of the scanned pages are written to a shard by the pool worker processing the chunk, and
+    the completed shards are recorded in the manifest file in output_dir. If dump_db_uuid is specified, the scan is
+    resumed from the manifest if it is restarted with the same dump, titles, and settings. If num_shards is larger than
+    one, only the pages in the shard_index-th partition of the titles are used, and the datasets of the partitions are
+    combined using WikipediaPretrainingDataset.merge_datasets. The shards are not split at titles, and the dataset
+    cannot be used as the previous dataset of WikipediaPretrainingDataset.build.
+    """
+
+    name = "pretraining_dataset"
+
+    def __init__(
+        self,
+        output_dir: str,
+        tokenizer: PreTrainedTokenizer,
+        sentence_tokenizer: SentenceTokenizer,
+        entity_vocab: Optional[EntityVocab],
+        max_seq_length: int,
+        max_entity_length: int,
+        max_mention_length: int,
+        min_sentence_length: int,
+        include_sentences_without_entities: bool,
+        include_unk_entities: bool,
+        language: str,
+        target_titles: FrozenSet[str] = None,
+        dump_db_uuid: str = None,
+        num_shards: int = 1,
+        shard_index: int = 0,
+    ):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"Invalid shard index {shard_index} for {num_shards} shards")
+
+        self._output_dir = output_dir
+        self._tokenizer = tokenizer
+        self._sentence_tokenizer = sentence_tokenizer
+        self._entity_vocab = entity_vocab
+        self._max_seq_length = max_seq_length
+        self._max_entity_length = max_entity_length
+        self._max_mention_length = max_mention_length
+        self._min_sentence_length = min_sentence_length
+        self._include_sentences_without_entities = include_sentences_without_entities
+        self._include_unk_entities = include_unk_entities
+        self._language = language
+        self._target_titles = target_titles
+        self._dump_db_uuid = dump_db_uuid
+        self._num_shards = num_shards
+        self._shard_index = shard_index
+
+        self._metadata = None
+        self._manifest = None
+        self._num_chunks = 0
+        self._last_save_time = None
+        # the titles of the completed shards that are reused, keyed by the indices of their chunks
+        self._completed_shard_titles = {}
+        self._skip_chunk = False
+
+        if entity_vocab is None:
+            self.requires = ("entity_vocab",)
+
+    def prepare(self, results: Dict[str, Any]):
+        if self._entity_vocab is None:
+            self._entity_vocab = results["entity_vocab"]
+
+        self._tokenizer.save_pretrained(self._output_dir)
+        self._entity_vocab.save(os.path.join(self._output_dir, ENTITY_VOCAB_FILE))
+        if self._entity_vocab.binary:
+            self._entity_vocab.save_binary(os.path.join(self._output_dir, BINARY_ENTITY_VOCAB_DIR))
+
+        self._metadata = dict(
+            max_seq_length=self._max_seq_length,
+            max_entity_length=self._max_entity_length,
+            max_mention_length=self._max_mention_length,
+            min_sentence_length=self._min_sentence_length,
+            include_sentences_without_entities=self._include_sentences_without_entities,
+            include_unk_entities=self._include_unk_entities,
+            tokenizer_class=self._tokenizer.__class__.__name__,
+            language=self._language,
+        )
+        settings = dict(
+            self._metadata, entity_vocab_md5=_get_file_md5(os.path.join(self._output_dir, ENTITY_VOCAB_FILE))
+        )
+        target_titles_md5 = None
+        if self._target_titles is not None:
+            target_titles_md5 = hashlib.md5("\n".join(sorted(self._target_titles)).encode("utf-8")).hexdigest()
+        build_args = dict(
+            dump_db_uuid=self._dump_db_uuid,
+            target_titles_md5=target_titles_md5,
+            num_shards=self._num_shards,
+            shard_index=self._shard_index,
+        )
+
+        manifest = _load_manifest(self._output_dir)
+        if (
+            self._dump_db_uuid is not None
+            and manifest is not None
+            and manifest["build_args"] == build_args
+            and manifest["settings"] == settings
+        ):
+            # the pages files of the shards list all the titles of their chunks
+            for (index, shard) in enumerate(manifest["shards"]):
+                pages_file = os.path.join(self._output_dir, shard["pages_file"])
+                if shard["completed"] and os.path.exists(pages_file):
+                    with open(pages_file) as f:
+                        self._completed_shard_titles[index] = [title for title, _ in json.load(f)]
+            logger.info(
+                "Resuming the scan: %d of %d shards are completed",
+                len(self._completed_shard_titles),
+                len(manifest["shards"]),
+            )
+        else:
+            if manifest is not None:
+                logger.warning(
+                    "The existing manifest in %s is built with different settings and ignored", self._output_dir
+                )
+            manifest = dict(build_args=build_args, settings=settings, shards=[])
+        self._manifest = manifest
+        _save_manifest(self._output_dir, manifest)
+        self._last_save_time = time.time()
+
+    def initialize_worker(self, dump_db: DumpDB):
+        WikipediaPretrainingDataset._initialize_worker(
+            dump_db,
+            self._tokenizer,
+            self._sentence_tokenizer,
+            self._entity_vocab,
+            self._max_seq_length - 2,  # 2 for [CLS] and [SEP]
+            self._max_entity_length,
+            self._max_mention_length,
+            self._min_sentence_length,
+            self._include_sentences_without_entities,
+            self._include_unk_entities,
+        )
+
+    def start_chunk(self, chunk_index: int, titles: List[str]):
+        # the shard of the chunk is reused only if the chunk consists of the same titles
+        self._skip_chunk = self._completed_shard_titles.get(chunk_index) == titles
+
+    def process_page(self, title: str, paragraphs: List[Paragraph]) -> List[bytes]:
+        if self._skip_chunk:
+            return []
+        if self._target_titles is None:
+            if not WikipediaPretrainingDataset._is_target_title(title):
+                return []
+        elif title not in self._target_titles:
+            return []
+        if self._num_shards > 1 and not partition_titles([title], self._num_shards, self._shard_index):
+            return []
+        return WikipediaPretrainingDataset._create_examples(title, paragraphs)
+
+    def finish_chunk(self, chunk_index: int, results: List[Tuple[str, List[bytes]]]) -> dict:
+        shard = dict(
+            file=SHARD_FILE_FORMAT.format(chunk_index),
+            pages_file=SHARD_PAGES_FILE_FORMAT.format(chunk_index),
+            completed=True,
+            number_of_pages=len(results),
+        )
+        if self._skip_chunk:
+            return dict(shard, number_of_items=self._manifest["shards"][chunk_index]["number_of_items"])
+
+        shard_file = os.path.join(self._output_dir, shard["file"])
+        pages_file = os.path.join(self._output_dir, shard["pages_file"])
+        # the pages file is written after the shard so that a shard is reused only if its pages file is consistent
+        if os.path.exists(pages_file):
+            os.remove(pages_file)
+        options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+        # the shard is written to a temporary file so that an incomplete shard is not left if the scan is interrupted
+        writer = TFRecordWriter(shard_file + ".tmp", options=options)
+        pages = []
+        for (title, items) in results:
+            for data in items:
+                writer.write(data)
+            pages.append((title, len(items)))
+        writer.close()
+        os.replace(shard_file + ".tmp", shard_file)
+
+        with open(pages_file, "w") as f:
+            json.dump(pages, f)
+
+        return dict(shard, number_of_items=sum(number_of_items for _, number_of_items in pages))
+
+    def merge_chunk(self, chunk_index: int, result: dict):
+        shards = self._manifest["shards"]
+        if chunk_index < len(shards):
+            shards[chunk_index] = result
+        else:
+            shards.append(result)
+        self._num_chunks = chunk_index + 1
+
+        # the manifest is saved periodically as it grows with the number of the chunks
+        if time.time() - self._last_save_time >= MANIFEST_SAVE_INTERVAL:
+            _save_manifest(self._output_dir, self._manifest)
+            self._last_save_time = time.time()
+
+    def finish(self) -> int:
+        shards = self._manifest["shards"][: self._num_chunks]
+        self._manifest["shards"] = shards
+        _save_manifest(self._output_dir, self._manifest)
+
+        number_of_items = sum(shard["number_of_items"] for shard in shards)
+        with open(os.path.join(self._output_dir, METADATA_FILE), "w") as metadata_file:
+            json.dump(
+                dict(
+                    number_of_items=number_of_items,
+                    dataset_files=[shard["file"] for shard in shards],
+                    **self._metadata,
+                ),
+                metadata_file,
+                indent=2,
+            )
+
+        return number_of_items
+
+
+def _shuffle(items: Iterable, buffer_size: int, rnd: random.Random) -> Iterator:
+    buf = []
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        index = rnd.randrange(buffer_size)
+        yield buf[index]
+        buf[index] = item
+
+    rnd.shuffle(buf)
+    yield from buf
+
+
+def _get_file_md5(file_path: str) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _load_manifest(dataset_dir: str) -> Optional[dict]:
+    manifest_file = os.path.join(dataset_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def _save_manifest(dataset_dir: str, manifest: dict):
+    # the manifest is replaced atomically so that it is not corrupted if the build is interrupted
+    manifest_file = os.path.join(dataset_dir, MANIFEST_FILE)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
@@ -6,6 +6,7 @@ from transformers.modeling_bert import ACT2FN, BertLayerNorm, BertPreTrainingHea
 from transformers.modeling_roberta import RobertaLMHead
 
 from luke.model import LukeModel, LukeConfig
+from luke.pretraining.vocab_parallel import VocabParallelEmbedding, VocabParallelEntityPredictionHead
 
 
 class EntityPredictionHeadTransform(nn.Module):
@@ -51,8 +52,17 @@ class LukePretrainingModel(LukeModel):
             self.cls = BertPreTrainingHeads(config)
             self.cls.predictions.decoder.weight = self.embeddings.word_embeddings.weight
 
-        self.entity_predictions = EntityPredictionHead(config)
-        self.entity_predictions.decoder.weight = self.entity_embeddings.entity_embeddings.weight
+        if getattr(config, "vocab_parallel_entities", False):
+            # the entity embeddings and the decoder of the entity prediction head are partitioned across the ranks
+            self.entity_embeddings.entity_embeddings = VocabParallelEmbedding(
+                config.entity_vocab_size, config.entity_emb_size, padding_idx=0, init_std=config.initializer_range
+            )
+            self.entity_predictions = VocabParallelEntityPredictionHead(
+                EntityPredictionHeadTransform(config), self.entity_embeddings.entity_embeddings
+            )
+        else:
+            self.entity_predictions = EntityPredictionHead(config)
+            self.entity_predictions.decoder.weight = self.entity_embeddings.entity_embeddings.weight
 
         self.apply(self.init_weights)
 
@@ -82,48 +92,46 @@ class LukePretrainingModel(LukeModel):
         )
         word_sequence_output, entity_sequence_output = output[:2]
 
-        loss_fn = CrossEntropyLoss(ignore_index=-1)
+        # the prediction heads are applied even if no token is masked so that the parameters receiving gradients do
+        # not depend on the batch, which allows DistributedDataParallel to skip searching for unused parameters.
+        # the losses are summed in fp32 to avoid overflows in fp16 training
+        loss_fn = CrossEntropyLoss(ignore_index=-1, reduction="sum")
         ret = dict(loss=word_ids.new_tensor(0.0, dtype=model_dtype))
 
         if masked_entity_labels is not None:
             entity_mask = masked_entity_labels != -1
-            if entity_mask.sum() > 0:
-                target_entity_sequence_output = torch.masked_select(entity_sequence_output, entity_mask.unsqueeze(-1))
-                target_entity_sequence_output = target_entity_sequence_output.view(-1, self.config.hidden_size)
-                target_entity_labels = torch.masked_select(masked_entity_labels, entity_mask)
-
+            target_entity_sequence_output = entity_sequence_output[entity_mask]
+            target_entity_labels = masked_entity_labels[entity_mask]
+
+            num_entities = entity_mask.sum()
+            if isinstance(self.entity_predictions, VocabParallelEntityPredictionHead):
+                ret["masked_entity_loss"], ret["masked_entity_correct"] = self.entity_predictions(
+                    target_entity_sequence_output, target_entity_labels
+                )
+            else:
                 entity_scores = self.entity_predictions(target_entity_sequence_output)
                 entity_scores = entity_scores.view(-1, self.config.entity_vocab_size)
-
-                ret["masked_entity_loss"] = loss_fn(entity_scores, target_entity_labels)
+                entity_loss = loss_fn(entity_scores.float(), target_entity_labels)
+                ret["masked_entity_loss"] = entity_loss / num_entities.clamp(min=1)
                 ret["masked_entity_correct"] = (torch.argmax(entity_scores, 1).data == target_entity_labels.data).sum()
-                ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
-                ret["loss"] += ret["masked_entity_loss"]
-            else:
-                ret["masked_entity_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
-                ret["masked_entity_correct"] = word_ids.new_tensor(0, dtype=torch.long)
-                ret["masked_entity_total"] = word_ids.new_tensor(0, dtype=torch.long)
+            ret["masked_entity_total"] = num_entities
+            ret["loss"] += ret["masked_entity_loss"]
 
         if masked_lm_labels is not None:
             masked_lm_mask = masked_lm_labels != -1
-            if masked_lm_mask.sum() > 0:
-                masked_word_sequence_output = torch.masked_select(word_sequence_output, masked_lm_mask.unsqueeze(-1))
-                masked_word_sequence_output = masked_word_sequence_output.view(-1, self.config.hidden_size)
-
-                if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
-                    masked_lm_scores = self.lm_head(masked_word_sequence_output)
-                else:
-                    masked_lm_scores = self.cls.predictions(masked_word_sequence_output)
-                masked_lm_scores = masked_lm_scores.view(-1, self.config.vocab_size)
-                masked_lm_labels = torch.masked_select(masked_lm_labels, masked_lm_mask)
-
-                ret["masked_lm_loss"] = loss_fn(masked_lm_scores, masked_lm_labels)
-                ret["masked_lm_correct"] = (torch.argmax(masked_lm_scores, 1).data == masked_lm_labels.data).sum()
-                ret["masked_lm_total"] = masked_lm_labels.ne(-1).sum()
-                ret["loss"] += ret["masked_lm_loss"]
+            masked_word_sequence_output = word_sequence_output[masked_lm_mask]
+
+            if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
+                masked_lm_scores = self.lm_head(masked_word_sequence_output)
             else:
-                ret["masked_lm_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
-                ret["masked_lm_correct"] = word_ids.new_tensor(0, dtype=torch.long)
-                ret["masked_lm_total"] = word_ids.new_tensor(0, dtype=torch.long)
+                masked_lm_scores = self.cls.predictions(masked_word_sequence_output)
+            masked_lm_scores = masked_lm_scores.view(-1, self.config.vocab_size)
+            masked_lm_labels = masked_lm_labels[masked_lm_mask]
+
+            num_words = masked_lm_mask.sum()
+            ret["masked_lm_loss"] = loss_fn(masked_lm_scores.float(), masked_lm_labels) / num_words.clamp(min=1)
+            ret["masked_lm_correct"] = (torch.argmax(masked_lm_scores, 1).data == masked_lm_labels.data).sum()
+            ret["masked_lm_total"] = num_words
+            ret["loss"] += ret["masked_lm_loss"]
 
         return ret
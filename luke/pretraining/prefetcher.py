@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+
+import numpy as np
+import torch
+
+from luke.utils.telemetry import TrainingTelemetry
+
+logger = logging.getLogger(__name__)
+
+_END_OF_BATCHES = object()
+
+
+class BatchPrefetcher(object):
+    """
+    Transfer the next batch to the device while the model is processing the current one.
+
+    Batches are converted into tensors by a background thread. On CUDA devices, the tensors are also pinned by the
+    thread and copied to the device using non-blocking copies issued on a side stream. On CPU, the thread alone
+    hides the latency of receiving and converting the batches.
+
+    If telemetry is given, the time spent waiting for the batches and transferring them is recorded as the data_wait
+    and transfer phases.
+    """
+
+    def __init__(
+        self,
+        batches: Iterable[Dict[str, np.ndarray]],
+        device: torch.device,
+        queue_size: int = 4,
+        telemetry: Optional[TrainingTelemetry] = None,
+    ):
+        self._batches = batches
+        self._device = device
+        self._telemetry = telemetry or TrainingTelemetry(device, enabled=False)
+        self._queue = queue.Queue(queue_size)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._load_batches, daemon=True)
+
+        if device.type == "cuda":
+            self._stream = torch.cuda.Stream(device=device)
+        else:
+            self._stream = None
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        self._thread.start()
+        try:
+            next_batch = self._transfer(self._get())
+            while next_batch is not None:
+                batch = next_batch
+                if self._stream is not None:
+                    current_stream = torch.cuda.current_stream(self._device)
+                    current_stream.wait_stream(self._stream)
+                    for tensor in batch.values():
+                        # prevent the memory from being reused by the side stream before the computation finishes
+                        tensor.record_stream(current_stream)
+
+                next_batch = self._transfer(self._get())
+                yield batch
+        finally:
+            self.close()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._stop_event.set()
+
+    def _get(self):
+        with self._telemetry.phase("data_wait", on_device=False):
+            item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is _END_OF_BATCHES:
+            return None
+        return item
+
+    def _transfer(self, batch):
+        if batch is None:
+            return None
+        if self._stream is None:
+            return batch
+
+        with torch.cuda.stream(self._stream), self._telemetry.phase("transfer"):
+            return {k: v.to(self._device, non_blocking=True) for k, v in batch.items()}
+
+    def _load_batches(self):
+        batch_iterator = iter(self._batches)
+        try:
+            for batch in batch_iterator:
+                batch = {k: torch.from_numpy(v) for k, v in batch.items()}
+                if self._stream is not None:
+                    batch = {k: v.pin_memory() for k, v in batch.items()}
+                if not self._put(batch):
+                    return
+            self._put(_END_OF_BATCHES)
+
+        except Exception as e:
+            logger.exception("An error has occurred while loading batches")
+            self._put(e)
+
+        finally:
+            if hasattr(batch_iterator, "close"):
+                batch_iterator.close()
+
+    def _put(self, item) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, True, 1)
+                return True
+            except queue.Full:
+                continue
+        return False
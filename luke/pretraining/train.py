@@ -1,5 +1,6 @@
 import contextlib
 import datetime
+import inspect
 import json
 import logging
 import math
@@ -9,7 +10,6 @@ import time
 from argparse import Namespace
 
 import click
-import numpy as np
 import torch
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
@@ -21,11 +21,35 @@ from transformers import (
 )
 
 from luke.model import LukeConfig
-from luke.optimization import LukeAdamW
-from luke.pretraining.batch_generator import LukePretrainingBatchGenerator, MultilingualBatchGenerator
+from luke.optimization import (
+    LukeAdamW,
+    ShardedLukeAdamW,
+    merge_optimizer_state_dicts,
+    split_optimizer_state_dict,
+)
+from luke.pretraining.batch_generator import (
+    LukePretrainingBatchGenerator,
+    MultilingualBatchGenerator,
+    parse_seq_length_schedule,
+)
+from luke.pretraining.checkpoint import CheckpointWriter, load_checkpoint_file, load_checkpoint_metadata
 from luke.pretraining.dataset import WikipediaPretrainingDataset
 from luke.pretraining.model import LukePretrainingModel
-from luke.utils.model_utils import ENTITY_VOCAB_FILE
+from luke.pretraining.prefetcher import BatchPrefetcher
+from luke.pretraining.vocab_parallel import clip_vocab_parallel_grad_norm_, get_vocab_parallel_parameter_names
+from luke.utils.batch_splitting import run_with_oom_recovery
+from luke.utils.distributed import (
+    COMM_HOOKS,
+    broadcast_module,
+    get_distributed_backend,
+    get_local_cpu_ids,
+    pin_threads,
+    register_comm_hook,
+)
+from luke.utils.model_utils import BINARY_ENTITY_VOCAB_DIR, ENTITY_VOCAB_FILE
+from luke.utils.profiling import StepProfiler
+from luke.utils.telemetry import TrainingTelemetry
+from luke.utils.tensor_file import TENSOR_FILE_EXTENSION
 
 logger = logging.getLogger(__name__)
 
@@ -35,8 +59,11 @@ logger = logging.getLogger(__name__)
 @click.argument("output_dir", type=click.Path())
 @click.option("--multilingual", is_flag=True)
 @click.option("--sampling-smoothing", default=0.7)
+@click.option("--num-batch-workers", default=4)
 @click.option("--parallel", is_flag=True)
 @click.option("--cpu", is_flag=True)
+@click.option("--num-processes", default=None, type=int)
+@click.option("--num-threads-per-process", default=None, type=int)
 @click.option("--bert-model-name", default="roberta-large")
 @click.option("--entity-emb-size", default=256, type=int)
 @click.option("--batch-size", default=2048)
@@ -59,6 +86,14 @@ logger = logging.getLogger(__name__)
 @click.option("--mask-words-in-entity-span", is_flag=True)
 @click.option("--fix-bert-weights", is_flag=True)
 @click.option("--grad-avg-on-cpu/--grad-avg-on-gpu", default=False)
+@click.option("--shard-optimizer", is_flag=True)
+@click.option("--shard-gradients", is_flag=True)
+@click.option("--sharded-optimizer-checkpoint", is_flag=True)
+@click.option("--vocab-parallel-entities", is_flag=True)
+@click.option("--comm-hook", type=click.Choice(COMM_HOOKS), default="none")
+@click.option("--powersgd-rank", default=4)
+@click.option("--powersgd-start-iteration", default=1000)
+@click.option("--static-graph", is_flag=True)
 @click.option("--num-epochs", default=20)
 @click.option("--global-step", default=0)
 @click.option("--fp16", is_flag=True)
@@ -78,6 +113,19 @@ logger = logging.getLogger(__name__)
 @click.option("--amp-file", type=click.Path(exists=True), default=None)
 @click.option("--save-interval-sec", default=None, type=int)
 @click.option("--save-interval-steps", default=None, type=int)
+@click.option("--keep-last-checkpoints", default=None, type=int)
+@click.option("--checkpoint-format", type=click.Choice(["torch", "safetensors"]), default="torch")
+@click.option("--telemetry/--no-telemetry", default=True)
+@click.option("--profile-steps", default=None)
+@click.option("--profile-on-signal", is_flag=True)
+@click.option("--profile-signal-steps", default=10)
+@click.option(
+    "--oom-recovery",
+    is_flag=True,
+    help="Split micro-batches running out of memory. An out-of-memory error in the backward pass discards the "
+    "gradients of the earlier micro-batches of the step, and is not recovered in distributed training.",
+)
+@click.option("--seq-length-schedule", default=None)
 def pretrain(**kwargs):
     run_pretraining(Namespace(**kwargs))
 
@@ -87,6 +135,11 @@ def pretrain(**kwargs):
 @click.option("--batch-size", default=None, type=int)
 @click.option("--gradient-accumulation-steps", default=None, type=int)
 @click.option("--grad-avg-on-cpu", is_flag=True, default=None)
+@click.option("--num-processes", default=None, type=int)
+@click.option("--num-threads-per-process", default=None, type=int)
+@click.option("--checkpoint-format", type=click.Choice(["torch", "safetensors"]), default=None)
+@click.option("--profile-steps", default=None)
+@click.option("--profile-on-signal", is_flag=True, default=None)
 @click.option("--num-nodes", default=1)
 @click.option("--node-rank", default=0)
 @click.option("--master-addr", default="127.0.0.1")
@@ -108,21 +161,43 @@ def resume_pretraining(output_dir: str, **kwargs):
         args["unmasked_entity_prob"] = 0.0
         args["random_entity_prob"] = 0.0
         args["mask_words_in_entity_span"] = False
-
-    step_metadata_file = sorted(
-        [f for f in os.listdir(output_dir) if f.startswith("metadata_") and f.endswith(".json")]
-    )[-1]
-    with open(os.path.join(output_dir, step_metadata_file)) as f:
-        step_metadata = json.load(f)
+    args.setdefault("num_batch_workers", 4)
+    args.setdefault("num_processes", None)
+    args.setdefault("num_threads_per_process", None)
+    args.setdefault("shard_optimizer", False)
+    args.setdefault("shard_gradients", False)
+    args.setdefault("sharded_optimizer_checkpoint", False)
+    args.setdefault("vocab_parallel_entities", False)
+    args.setdefault("comm_hook", "none")
+    args.setdefault("powersgd_rank", 4)
+    args.setdefault("powersgd_start_iteration", 1000)
+    args.setdefault("static_graph", False)
+    args.setdefault("keep_last_checkpoints", None)
+    args.setdefault("checkpoint_format", "torch")
+    args.setdefault("telemetry", True)
+    args.setdefault("profile_steps", None)
+    args.setdefault("profile_on_signal", False)
+    args.setdefault("profile_signal_steps", 10)
+    args.setdefault("oom_recovery", False)
+    args.setdefault("seq_length_schedule", None)
+
+    # the checkpoint with the largest global step is resumed
+    step_metadata = load_checkpoint_metadata(output_dir)[-1]
 
     args["model_file"] = os.path.join(output_dir, step_metadata["model_file"])
-    args["optimizer_file"] = os.path.join(output_dir, step_metadata["optimizer_file"])
+    if "optimizer_files" in step_metadata:
+        args["optimizer_file"] = [os.path.join(output_dir, f) for f in step_metadata["optimizer_files"]]
+    else:
+        args["optimizer_file"] = os.path.join(output_dir, step_metadata["optimizer_file"])
     args["scheduler_file"] = os.path.join(output_dir, step_metadata["scheduler_file"])
     if "amp_file" in step_metadata:
         args["amp_file"] = os.path.join(output_dir, step_metadata["amp_file"])
     else:
         args["amp_file"] = None
     args["global_step"] = step_metadata["global_step"]
+    # the phases of the schedule are kept at the same steps even if the number of training steps changes
+    args["seq_length_phases"] = step_metadata.get("seq_length_schedule")
+    args["powersgd_iteration"] = step_metadata.get("powersgd_iteration", 0)
     args["local_rank"] = -1
 
     for key, value in kwargs.items():
@@ -154,9 +229,14 @@ def run_pretraining(args):
         num_workers = 1
         worker_index = 0
     else:
-        torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend="nccl")
-        device = torch.device("cuda", args.local_rank)
+        if args.cpu:
+            device = torch.device("cpu")
+            num_local_workers = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            pin_threads(args.local_rank, num_local_workers, args.num_threads_per_process)
+        else:
+            torch.cuda.set_device(args.local_rank)
+            device = torch.device("cuda", args.local_rank)
+        torch.distributed.init_process_group(backend=get_distributed_backend(device))
         num_workers = torch.distributed.get_world_size()
         worker_index = torch.distributed.get_rank()
 
@@ -180,17 +260,37 @@ def run_pretraining(args):
     num_train_steps = math.ceil(dataset_size / args.batch_size * args.num_epochs)
     train_batch_size = int(args.batch_size / args.gradient_accumulation_steps / num_workers)
 
+    if args.vocab_parallel_entities and args.local_rank == -1:
+        raise RuntimeError("Vocabulary-parallel entity embeddings are only supported in distributed training")
+    if args.vocab_parallel_entities and args.fp16:
+        raise RuntimeError("Vocabulary-parallel entity embeddings are not supported in fp16 training")
+    if args.comm_hook != "none" and args.shard_gradients:
+        raise RuntimeError("Communication hooks are not supported when the gradients are sharded")
+    if args.oom_recovery and args.vocab_parallel_entities:
+        # the forward passes of the vocabulary-parallel entity prediction head need to be run on all ranks together
+        raise RuntimeError("OOM recovery is not supported with vocabulary-parallel entity embeddings")
+    if args.static_graph and args.oom_recovery:
+        # the micro-batches split by OOM recovery run extra forward and backward passes
+        raise RuntimeError("OOM recovery is not supported with the static graph of DistributedDataParallel")
+
     entity_vocab = dataset_list[0].entity_vocab
     config = LukeConfig(
         entity_vocab_size=entity_vocab.size,
         bert_model_name=args.bert_model_name,
         entity_emb_size=args.entity_emb_size,
+        vocab_parallel_entities=args.vocab_parallel_entities,
         **bert_config.to_dict(),
     )
     model = LukePretrainingModel(config)
 
     global_step = args.global_step
 
+    seq_length_schedule = getattr(args, "seq_length_phases", None)
+    if seq_length_schedule is None and args.seq_length_schedule:
+        seq_length_schedule = parse_seq_length_schedule(args.seq_length_schedule, num_train_steps)
+    if seq_length_schedule is not None:
+        logger.info("Sequence length schedule: %s", seq_length_schedule)
+
     batch_generator_args = dict(
         batch_size=train_batch_size,
         masked_lm_prob=args.masked_lm_prob,
@@ -204,12 +304,19 @@ def run_pretraining(args):
         num_workers=num_workers,
         worker_index=worker_index,
         skip=global_step * args.batch_size,
+        seq_length_schedule=seq_length_schedule,
+        start_step=global_step,
+        batches_per_step=args.gradient_accumulation_steps,
     )
 
     if args.multilingual:
         data_size_list = [len(d) for d in dataset_list]
         batch_generator = MultilingualBatchGenerator(
-            dataset_dir_list, data_size_list, args.sampling_smoothing, **batch_generator_args,
+            dataset_dir_list,
+            data_size_list,
+            args.sampling_smoothing,
+            num_processes=args.num_batch_workers,
+            **batch_generator_args,
         )
 
     else:
@@ -225,6 +332,11 @@ def run_pretraining(args):
         for param in model.entity_predictions.parameters():
             param.requires_grad = True
 
+    # the pooler and the next sentence prediction head do not contribute to the pretraining loss
+    for name, param in model.named_parameters():
+        if name.startswith(("pooler.", "cls.seq_relationship.")):
+            param.requires_grad = False
+
     model.to(device)
 
     param_optimizer = list(model.named_parameters())
@@ -237,13 +349,19 @@ def run_pretraining(args):
         {"params": [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
     ]
 
-    optimizer = LukeAdamW(
-        optimizer_parameters,
+    optimizer_kwargs = dict(
         lr=args.learning_rate,
         betas=(args.adam_b1, args.adam_b2),
         eps=args.adam_eps,
         grad_avg_device=torch.device("cpu") if args.grad_avg_on_cpu else device,
     )
+    sharded_optimizer = args.local_rank != -1 and (args.shard_optimizer or args.shard_gradients)
+    if sharded_optimizer:
+        if args.fp16:
+            raise RuntimeError("Sharding the optimizer states is not supported in fp16 training")
+        optimizer = ShardedLukeAdamW(optimizer_parameters, shard_gradients=args.shard_gradients, **optimizer_kwargs)
+    else:
+        optimizer = LukeAdamW(optimizer_parameters, **optimizer_kwargs)
 
     if args.fp16:
         from apex import amp
@@ -272,11 +390,22 @@ def run_pretraining(args):
         model.load_bert_weights(bert_state_dict)
 
     else:
-        model_state_dict = torch.load(args.model_file, map_location="cpu")
+        model_state_dict = load_checkpoint_file(args.model_file)
         model.load_state_dict(model_state_dict, strict=False)
 
     if args.optimizer_file is not None:
-        optimizer.load_state_dict(torch.load(args.optimizer_file, map_location="cpu"))
+        if args.vocab_parallel_entities:
+            # each rank has its own optimizer states of the partitioned entity embeddings
+            if not isinstance(args.optimizer_file, list) or len(args.optimizer_file) != num_workers:
+                raise RuntimeError("The optimizer states need to be saved by the same number of workers")
+            optimizer.load_state_dict(load_checkpoint_file(args.optimizer_file[worker_index]))
+        elif isinstance(args.optimizer_file, list):
+            # the optimizer states are saved separately by each rank
+            optimizer_state_dicts = [load_checkpoint_file(f) for f in args.optimizer_file]
+            optimizer.load_state_dict(merge_optimizer_state_dicts(optimizer_state_dicts))
+            optimizer_state_dicts = None
+        else:
+            optimizer.load_state_dict(load_checkpoint_file(args.optimizer_file))
 
     if args.amp_file is not None:
         amp.load_state_dict(torch.load(args.amp_file, map_location="cpu"))
@@ -293,21 +422,40 @@ def run_pretraining(args):
     if args.scheduler_file is not None:
         scheduler.load_state_dict(torch.load(args.scheduler_file, map_location="cpu"))
 
-    if args.local_rank != -1:
+    comm_hook_state = None
+    if args.local_rank != -1 and args.shard_gradients:
+        # the gradients are reduced by the optimizer instead of DistributedDataParallel
+        broadcast_module(model)
+    elif args.local_rank != -1:
+        if device.type == "cuda":
+            device_kwargs = dict(device_ids=[args.local_rank], output_device=args.local_rank)
+        else:
+            device_kwargs = {}
+        if args.vocab_parallel_entities:
+            torch.nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(
+                model, get_vocab_parallel_parameter_names(model)
+            )
         model = torch.nn.parallel.DistributedDataParallel(
+            model, broadcast_buffers=False, **device_kwargs, **get_ddp_graph_kwargs(model, args)
+        )
+        comm_hook_state = register_comm_hook(
             model,
-            device_ids=[args.local_rank],
-            output_device=args.local_rank,
-            broadcast_buffers=False,
-            find_unused_parameters=True,
+            args.comm_hook,
+            args.powersgd_rank,
+            args.powersgd_start_iteration,
+            getattr(args, "powersgd_iteration", 0),
         )
 
     model.train()
 
     if args.local_rank == -1 or worker_index == 0:
         entity_vocab.save(os.path.join(args.output_dir, ENTITY_VOCAB_FILE))
+        if entity_vocab.binary:
+            entity_vocab.save_binary(os.path.join(args.output_dir, BINARY_ENTITY_VOCAB_DIR))
+        # the partitioning of the entity embeddings is not stored in the model configuration
+        model_config = {k: v for k, v in config.to_dict().items() if k != "vocab_parallel_entities"}
         metadata = dict(
-            model_config=config.to_dict(),
+            model_config=model_config,
             max_seq_length=dataset_list[0].max_seq_length,
             max_entity_length=dataset_list[0].max_entity_length,
             max_mention_length=dataset_list[0].max_mention_length,
@@ -316,111 +464,239 @@ def run_pretraining(args):
         with open(os.path.join(args.output_dir, "metadata.json"), "w") as metadata_file:
             json.dump(metadata, metadata_file, indent=2, sort_keys=True)
 
+    # the checkpoints are created by all ranks if the optimizer states or the entity embeddings are partitioned, or if
+    # the optimizer states are saved in per-rank safetensors files
+    tensor_file_checkpoint = args.checkpoint_format == "safetensors"
+    checkpoint_file_extension = TENSOR_FILE_EXTENSION if tensor_file_checkpoint else ".bin"
+    collective_checkpoint = (
+        sharded_optimizer or args.vocab_parallel_entities or (tensor_file_checkpoint and args.local_rank != -1)
+    )
+
+    # the checkpoints are written by a background thread while the training continues
+    checkpoint_writer = CheckpointWriter(args.output_dir, keep_last_checkpoints=args.keep_last_checkpoints)
+
     def save_model(model, suffix):
-        if args.local_rank != -1:
-            model = model.module
-
-        model_file = f"model_{suffix}.bin"
-        torch.save(model.state_dict(), os.path.join(args.output_dir, model_file))
-        optimizer_file = f"optimizer_{suffix}.bin"
-        torch.save(optimizer.state_dict(), os.path.join(args.output_dir, optimizer_file))
-        scheduler_file = f"scheduler_{suffix}.bin"
-        torch.save(scheduler.state_dict(), os.path.join(args.output_dir, scheduler_file))
-        metadata = dict(
-            global_step=global_step, model_file=model_file, optimizer_file=optimizer_file, scheduler_file=scheduler_file
-        )
-        if args.fp16:
-            amp_file = f"amp_{suffix}.bin"
-            torch.save(amp.state_dict(), os.path.join(args.output_dir, amp_file))
-            metadata["amp_file"] = amp_file
-        with open(os.path.join(args.output_dir, f"metadata_{suffix}.json"), "w") as f:
-            json.dump(metadata, f, indent=2, sort_keys=True)
+        # this function is called on all ranks if collective_checkpoint is True, and only on the first rank otherwise
+        with telemetry.phase("checkpoint", on_device=False):
+            metadata = dict(global_step=global_step)
+            if seq_length_schedule is not None:
+                metadata["seq_length_schedule"] = seq_length_schedule
+            if comm_hook_state is not None:
+                # PowerSGD switches from the uncompressed all-reduce to the compression based on this counter
+                metadata["powersgd_iteration"] = comm_hook_state.iter
+            states = {}
+            other_rank_files = []
+            if (
+                args.vocab_parallel_entities
+                or tensor_file_checkpoint
+                or (sharded_optimizer and args.sharded_optimizer_checkpoint)
+            ):
+                optimizer_files = [
+                    f"optimizer_{suffix}_{i:05d}-of-{num_workers:05d}{checkpoint_file_extension}"
+                    for i in range(num_workers)
+                ]
+                if args.vocab_parallel_entities or sharded_optimizer:
+                    local_state_dict = optimizer.state_dict()
+                else:
+                    # the replicated optimizer states are divided among the ranks
+                    local_state_dict = split_optimizer_state_dict(optimizer.state_dict(), num_workers)[worker_index]
+                states[optimizer_files[worker_index]] = local_state_dict
+                other_rank_files = [f for i, f in enumerate(optimizer_files) if i != worker_index]
+                metadata["optimizer_files"] = optimizer_files
+                optimizer_state_dict = None
+            elif sharded_optimizer:
+                optimizer_state_dict = optimizer.consolidated_state_dict()
+            else:
+                optimizer_state_dict = optimizer.state_dict()
+
+            model_state_dict = getattr(model, "module", model).state_dict()
+            if worker_index != 0:
+                checkpoint_writer.save(states)
+                return
+
+            model_file = f"model_{suffix}{checkpoint_file_extension}"
+            states[model_file] = model_state_dict
+            metadata["model_file"] = model_file
+            if optimizer_state_dict is not None:
+                optimizer_file = f"optimizer_{suffix}.bin"
+                states[optimizer_file] = optimizer_state_dict
+                metadata["optimizer_file"] = optimizer_file
+            scheduler_file = f"scheduler_{suffix}.bin"
+            states[scheduler_file] = scheduler.state_dict()
+            metadata["scheduler_file"] = scheduler_file
+            if args.fp16:
+                amp_file = f"amp_{suffix}.bin"
+                states[amp_file] = amp.state_dict()
+                metadata["amp_file"] = amp_file
+
+            # the metadata is published after the optimizer states of the other ranks are written
+            checkpoint_writer.save(
+                states, metadata_file=f"metadata_{suffix}.json", metadata=metadata, wait_for_files=other_rank_files
+            )
 
     if args.local_rank == -1 or worker_index == 0:
         summary_writer = SummaryWriter(args.log_dir)
         pbar = tqdm(total=num_train_steps, initial=global_step)
+    else:
+        summary_writer = None
 
-    tr_loss = 0
+    # every rank writes its own telemetry file to make it possible to find slow ranks
+    if args.local_rank == -1:
+        telemetry_file = os.path.join(args.output_dir, "telemetry.jsonl")
+    else:
+        telemetry_file = os.path.join(args.output_dir, f"telemetry_{worker_index:05d}.jsonl")
+    telemetry = TrainingTelemetry(device, telemetry_file, summary_writer, enabled=args.telemetry)
+
+    profiler = StepProfiler(
+        args.output_dir,
+        model,
+        device,
+        profile_steps=args.profile_steps,
+        profile_on_signal=args.profile_on_signal,
+        num_signal_steps=args.profile_signal_steps,
+        rank=None if args.local_rank == -1 else worker_index,
+    )
+    profiler.step(global_step)
+
+    # training statistics are accumulated on the device and read back only once per optimizer step
+    stats = {}
     accumulation_count = 0
-    results = []
     prev_error = False
+    is_first_backward = True
+    num_oom_splits = 0
     prev_step_time = time.time()
     prev_save_time = time.time()
 
-    for batch in batch_generator.generate_batches():
-        try:
-            batch = {k: torch.from_numpy(v).to(device) for k, v in batch.items()}
-            result = model(**batch)
+    def accumulate_stats(loss, result):
+        values = {"loss": loss.detach()}
+        for name in ("masked_lm", "masked_entity"):
+            if name + "_loss" in result:
+                values[name + "_loss"] = result[name + "_loss"].detach()
+                values[name + "_correct"] = result[name + "_correct"]
+                values[name + "_total"] = result[name + "_total"]
+        for key, value in values.items():
+            value = value.to(torch.float64)
+            if key in stats:
+                stats[key] = stats[key] + value
+            else:
+                stats[key] = value
+
+    prefetcher = BatchPrefetcher(batch_generator.generate_batches(), device, telemetry=telemetry)
+    for batch in prefetcher:
+        telemetry.add_batch(batch)
+
+        def maybe_no_sync(is_last_part):
+            # DistributedDataParallel with a static graph requires the first backward pass to be synchronized
+            if (
+                hasattr(model, "no_sync")
+                and num_workers > 1
+                and (accumulation_count + 1 != args.gradient_accumulation_steps or not is_last_part)
+                and not (args.static_graph and is_first_backward)
+            ):
+                return model.no_sync()
+            else:
+                return contextlib.ExitStack()
+
+        def forward(micro_batch, is_last_part):
+            # DistributedDataParallel prepares the synchronization of the gradients in the forward pass
+            with maybe_no_sync(is_last_part), telemetry.phase("forward"):
+                result = model(**micro_batch)
+            if micro_batch is not batch:
+                result = weight_split_result(result, batch)
             loss = result["loss"]
-            result = {k: v.to("cpu").detach().numpy() for k, v in result.items()}
 
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
+            return loss, (loss, result)
 
-            def maybe_no_sync():
-                if (
-                    hasattr(model, "no_sync")
-                    and num_workers > 1
-                    and accumulation_count + 1 != args.gradient_accumulation_steps
-                ):
-                    return model.no_sync()
-                else:
-                    return contextlib.ExitStack()
-
-            with maybe_no_sync():
+        def backward(loss, is_last_part):
+            with maybe_no_sync(is_last_part), telemetry.phase("backward"):
                 if args.fp16:
                     with amp.scale_loss(loss, optimizer) as scaled_loss:
                         scaled_loss.backward()
                 else:
                     loss.backward()
 
+        try:
+            outputs, num_splits, gradients_reset = run_with_oom_recovery(
+                batch,
+                forward,
+                backward,
+                model.zero_grad,
+                enabled=args.oom_recovery,
+                # the ranks would disagree on the accumulated micro-batches if only one of them reset the gradients
+                split_backward=num_workers == 1,
+            )
+
         except RuntimeError:
             if prev_error:
                 logger.exception("Consecutive errors have been observed. Exiting...")
                 raise
+            if args.static_graph:
+                # skipping a batch changes the sequence of the backward passes recorded in the static graph
+                logger.exception("An unexpected error has occurred. Batches cannot be skipped with a static graph")
+                raise
             logger.exception("An unexpected error has occurred. Skipping a batch...")
             prev_error = True
-            loss = None
+            outputs = None
             torch.cuda.empty_cache()
             continue
 
+        if gradients_reset:
+            logger.warning("Discarded the gradients of %d micro-batches in this step", accumulation_count)
+            accumulation_count = 0
+            stats = {}
+        num_oom_splits += num_splits
+
         accumulation_count += 1
         prev_error = False
-        tr_loss += loss.item()
-        loss = None
-        results.append(result)
+        is_first_backward = False
+        for loss, result in outputs:
+            accumulate_stats(loss, result)
+        outputs = None
 
         if accumulation_count == args.gradient_accumulation_steps:
-            if args.max_grad_norm != 0.0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-            optimizer.step()
-            scheduler.step()
-            model.zero_grad()
-            accumulation_count = 0
+            with telemetry.phase("optimizer"):
+                if args.max_grad_norm != 0.0:
+                    if args.fp16:
+                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+                    elif sharded_optimizer:
+                        optimizer.clip_grad_norm_(args.max_grad_norm)
+                    elif args.vocab_parallel_entities:
+                        clip_vocab_parallel_grad_norm_(model.parameters(), args.max_grad_norm)
+                    else:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                optimizer.step()
+                scheduler.step()
+                model.zero_grad()
+
+            stat_names = list(stats.keys())
+            stat_values = dict(zip(stat_names, torch.stack([stats[name] for name in stat_names]).tolist()))
+            stats = {}
 
             summary = {}
             summary["learning_rate"] = max(scheduler.get_last_lr())
-            summary["loss"] = tr_loss
-            tr_loss = 0
+            summary["loss"] = stat_values["loss"]
+
+            if args.oom_recovery:
+                summary["oom_splits"] = num_oom_splits
+                num_oom_splits = 0
 
             current_time = time.time()
             summary["batch_run_time"] = current_time - prev_step_time
             prev_step_time = current_time
 
             for name in ("masked_lm", "masked_entity"):
-                try:
-                    summary[name + "_loss"] = np.concatenate([r[name + "_loss"].flatten() for r in results]).mean()
-                    correct = np.concatenate([r[name + "_correct"].flatten() for r in results]).sum()
-                    total = np.concatenate([r[name + "_total"].flatten() for r in results]).sum()
-                    if total > 0:
-                        summary[name + "_acc"] = correct / total
-                except KeyError:
+                if name + "_loss" not in stat_values:
                     continue
+                summary[name + "_loss"] = stat_values[name + "_loss"] / accumulation_count
+                if stat_values[name + "_total"] > 0:
+                    summary[name + "_acc"] = stat_values[name + "_correct"] / stat_values[name + "_total"]
 
-            results = []
+            accumulation_count = 0
+
+            # the time spent saving the checkpoint after this step is reported in the next step
+            telemetry.end_step(global_step, queue_size=prefetcher.qsize())
 
             if args.local_rank == -1 or worker_index == 0:
                 for (name, value) in summary.items():
@@ -434,17 +710,26 @@ def run_pretraining(args):
                 pbar.update()
 
             global_step += 1
+            profiler.step(global_step)
+
+            if collective_checkpoint or args.local_rank == -1 or worker_index == 0:
+                save_interval_elapsed = False
+                if args.save_interval_sec:
+                    save_interval_elapsed = time.time() - prev_save_time > args.save_interval_sec
+                    if collective_checkpoint:
+                        # all ranks need to agree on saving the model because they save the optimizer states together
+                        save_flag = torch.tensor(int(save_interval_elapsed), device=device)
+                        torch.distributed.broadcast(save_flag, 0)
+                        save_interval_elapsed = bool(save_flag.item())
 
-            if args.local_rank == -1 or worker_index == 0:
                 if global_step == num_train_steps:
                     # save the final model
                     save_model(model, f"epoch{args.num_epochs}")
-                    time.sleep(60)
                 elif global_step % num_train_steps_per_epoch == 0:
                     # save the model at each epoch
                     epoch = int(global_step / num_train_steps_per_epoch)
                     save_model(model, f"epoch{epoch}")
-                if args.save_interval_sec and time.time() - prev_save_time > args.save_interval_sec:
+                if save_interval_elapsed:
                     save_model(model, f"step{global_step:07}")
                     prev_save_time = time.time()
                 if args.save_interval_steps and global_step % args.save_interval_steps == 0:
@@ -453,18 +738,72 @@ def run_pretraining(args):
             if global_step == num_train_steps:
                 break
 
+    prefetcher.close()
+    checkpoint_writer.close()
+    telemetry.close()
+    profiler.close()
+
     if args.local_rank == -1 or worker_index == 0:
         summary_writer.close()
 
 
+def weight_split_result(result: dict, batch: dict) -> dict:
+    """
+    Weight the losses computed on a part of the micro-batch by the fraction of the masked tokens of the micro-batch in
+    the part, so that the losses and the gradients of the parts sum up to those of the micro-batch.
+    """
+    ret = dict(result)
+    ret["loss"] = result["loss"].new_tensor(0.0)
+    for name in ("masked_lm", "masked_entity"):
+        if name + "_loss" in result:
+            total = (batch[name + "_labels"] != -1).sum().clamp(min=1)
+            ret[name + "_loss"] = result[name + "_loss"] * result[name + "_total"] / total
+            ret["loss"] = ret["loss"] + ret[name + "_loss"]
+    return ret
+
+
+def get_ddp_graph_kwargs(model: LukePretrainingModel, args) -> dict:
+    """
+    Return the arguments of DistributedDataParallel describing the autograd graph of the model. The prediction heads
+    are always applied in the forward pass, so the set of parameters receiving gradients only depends on which labels
+    are generated, which is fixed during the whole training. The graph is declared static only if requested because
+    the training loop must then run exactly the same backward passes on all ranks, without skipping failed batches or
+    splitting micro-batches.
+    """
+    unused_heads = []
+    if args.masked_entity_prob == 0.0:
+        unused_heads.append(model.entity_predictions)
+    if args.masked_lm_prob == 0.0:
+        unused_heads.append(model.lm_head if hasattr(model, "lm_head") else model.cls.predictions)
+
+    # the decoder weights are tied to the embeddings and therefore always receive gradients
+    find_unused_parameters = any(
+        param.requires_grad
+        for head in unused_heads
+        for name, param in head.named_parameters()
+        if not name.startswith("decoder.")
+    )
+    ret = dict(find_unused_parameters=find_unused_parameters)
+    if args.static_graph and "static_graph" in inspect.signature(torch.nn.parallel.DistributedDataParallel).parameters:
+        ret["static_graph"] = True
+
+    return ret
+
+
 def run_parallel_pretraining(args):
-    num_workers = torch.cuda.device_count()
+    if args.cpu:
+        num_workers = args.num_processes or 1
+        num_threads = args.num_threads_per_process or len(get_local_cpu_ids(0, num_workers))
+    else:
+        num_workers = args.num_processes or torch.cuda.device_count()
+        num_threads = 1
 
     current_env = os.environ.copy()
     current_env["MASTER_ADDR"] = args.master_addr
     current_env["MASTER_PORT"] = args.master_port
     current_env["WORLD_SIZE"] = str(num_workers * args.num_nodes)
-    current_env["OMP_NUM_THREADS"] = str(1)
+    current_env["LOCAL_WORLD_SIZE"] = str(num_workers)
+    current_env["OMP_NUM_THREADS"] = str(num_threads)
     processes = []
     for local_rank in range(num_workers):
         cmd = ["luke", "start-pretraining-worker", f"--local-rank={local_rank}", f"--args={json.dumps(vars(args))}"]
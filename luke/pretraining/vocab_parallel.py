@@ -0,0 +1,313 @@
+import math
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch import nn
+
+from luke.utils.distributed import VOCAB_PARALLEL_ATTRIBUTE, is_vocab_parallel
+
+
+def get_vocab_range(vocab_size: int, rank: int, world_size: int) -> Tuple[int, int]:
+    """
+    Return the contiguous range of rows [start, end) owned by the rank.
+    """
+    num_rows_per_rank = math.ceil(vocab_size / world_size)
+    start = min(rank * num_rows_per_rank, vocab_size)
+    end = min(start + num_rows_per_rank, vocab_size)
+    return start, end
+
+
+def get_vocab_parallel_parameter_names(model: nn.Module) -> List[str]:
+    """
+    Return the names of the vocabulary-parallel parameters and their aliases created by weight tying. The names are
+    passed to DistributedDataParallel to exclude the parameters.
+    """
+    names = []
+    for module_name, module in model.named_modules():
+        for name, param in module._parameters.items():
+            if param is not None and is_vocab_parallel(param):
+                names.append(f"{module_name}.{name}" if module_name else name)
+
+    return names
+
+
+def clip_vocab_parallel_grad_norm_(parameters: Iterable[torch.Tensor], max_norm: float) -> torch.Tensor:
+    """
+    Clip the gradient norm of a model containing vocabulary-parallel parameters. The norm of the partitioned
+    parameters is summed over the ranks, whereas the norm of the replicated parameters is computed locally. This must
+    be called on all ranks, including the ones without gradients.
+    """
+    parameters = list(parameters)
+    grads = []
+    replicated_norm = None
+    partitioned_norm = None
+    for param in parameters:
+        if param.grad is None:
+            continue
+        grads.append(param.grad.data)
+        norm = param.grad.data.float().norm() ** 2
+        if is_vocab_parallel(param):
+            partitioned_norm = norm if partitioned_norm is None else partitioned_norm + norm
+        else:
+            replicated_norm = norm if replicated_norm is None else replicated_norm + norm
+
+    if grads:
+        device = grads[0].device
+    elif parameters:
+        device = parameters[0].device
+    else:
+        device = torch.device("cpu")
+    if partitioned_norm is None:
+        partitioned_norm = torch.zeros((), device=device)
+    if replicated_norm is None:
+        replicated_norm = torch.zeros((), device=device)
+
+    dist.all_reduce(partitioned_norm)
+    total_norm = (replicated_norm + partitioned_norm).sqrt()
+    if not grads:
+        return total_norm
+
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for grad in grads:
+        grad.mul_(clip_coef.to(grad.dtype))
+
+    return total_norm
+
+
+def _gather_sizes(size: int, device: torch.device) -> List[int]:
+    size_tensor = torch.tensor([size], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(size_tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size_tensor)
+    return [int(s.item()) for s in sizes]
+
+
+def _all_gather(tensor: torch.Tensor, sizes: List[int]) -> List[torch.Tensor]:
+    """
+    All-gather tensors whose first dimensions differ across the ranks.
+    """
+    padded_tensor = tensor.new_zeros((max(sizes),) + tensor.shape[1:])
+    padded_tensor[: tensor.size(0)] = tensor
+    tensors = [torch.empty_like(padded_tensor) for _ in sizes]
+    dist.all_gather(tensors, padded_tensor)
+    return [t[:size] for t, size in zip(tensors, sizes)]
+
+
+def _reduce_scatter(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Sum the i-th tensor over the ranks and return the result on the i-th rank. This is implemented using a reduce
+    operation per rank because the gloo backend does not support reduce_scatter.
+    """
+    rank = dist.get_rank()
+    output = None
+    for dst, tensor in enumerate(tensors):
+        tensor = tensor.contiguous().clone()
+        dist.reduce(tensor, dst=dst)
+        if dst == rank:
+            output = tensor
+
+    return output
+
+
+class _GatherFromRanks(torch.autograd.Function):
+    """
+    Concatenate the tensors of all ranks. The gradients are summed and returned to the rank owning the tensor.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor: torch.Tensor, sizes: List[int]):
+        ctx.sizes = sizes
+        return torch.cat(_all_gather(tensor, sizes))
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return _reduce_scatter(list(torch.split(grad_output, ctx.sizes))), None
+
+
+class _ScatterToRanks(torch.autograd.Function):
+    """
+    Sum the concatenated tensors over the ranks and return the i-th part to the i-th rank.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor: torch.Tensor, sizes: List[int]):
+        ctx.sizes = sizes
+        return _reduce_scatter(list(torch.split(tensor, sizes)))
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return torch.cat(_all_gather(grad_output, ctx.sizes)), None
+
+
+class _AllReduceSum(torch.autograd.Function):
+    """
+    Sum the tensor over the ranks. The backward pass is the identity because the result is consumed by the same
+    computation on every rank.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor: torch.Tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return grad_output
+
+
+def _scale_grad_by_world_size(grad: torch.Tensor) -> torch.Tensor:
+    # the gradients contain the losses of all ranks, whereas DistributedDataParallel averages them over the ranks
+    return grad / dist.get_world_size()
+
+
+class VocabParallelEmbedding(nn.Module):
+    """
+    Embedding whose rows are partitioned into contiguous ranges across the ranks of the default process group.
+
+    The IDs looked up on all ranks are all-gathered, each rank embeds the IDs in its own range, and the partial results
+    are reduce-scattered back to the ranks that requested them. The state dict contains the full embedding matrix, so
+    that checkpoints are interchangeable with nn.Embedding; creating it is a collective operation.
+    """
+
+    def __init__(self, num_embeddings: int, embedding_dim: int, padding_idx: Optional[int] = None, init_std=0.02):
+        super(VocabParallelEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.padding_idx = padding_idx
+
+        self.vocab_start_index, self.vocab_end_index = get_vocab_range(
+            num_embeddings, dist.get_rank(), dist.get_world_size()
+        )
+        self.weight = nn.Parameter(torch.empty(self.vocab_end_index - self.vocab_start_index, embedding_dim))
+        self.weight.data.normal_(mean=0.0, std=init_std)
+        setattr(self.weight, VOCAB_PARALLEL_ATTRIBUTE, True)
+        self.weight.register_hook(_scale_grad_by_world_size)
+
+        if padding_idx is not None and self.vocab_start_index <= padding_idx < self.vocab_end_index:
+            self._local_padding_idx = padding_idx - self.vocab_start_index
+        else:
+            self._local_padding_idx = None
+
+    def forward(self, ids: torch.LongTensor) -> torch.Tensor:
+        flat_ids = ids.reshape(-1)
+        sizes = _gather_sizes(flat_ids.size(0), ids.device)
+        all_ids = torch.cat(_all_gather(flat_ids, sizes))
+
+        id_mask = (all_ids >= self.vocab_start_index) & (all_ids < self.vocab_end_index)
+        local_ids = (all_ids - self.vocab_start_index) * id_mask
+        embeddings = F.embedding(local_ids, self.weight, padding_idx=self._local_padding_idx)
+        embeddings = embeddings * id_mask.unsqueeze(-1).to(embeddings.dtype)
+
+        embeddings = _ScatterToRanks.apply(embeddings, sizes)
+        return embeddings.view(ids.shape + (self.embedding_dim,))
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        destination[prefix + "weight"] = gather_vocab_parallel_tensor(self.weight.detach())
+
+    def _load_from_state_dict(
+        self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+    ):
+        load_vocab_parallel_tensor(self.weight, prefix + "weight", self, state_dict, missing_keys, error_msgs)
+
+    def extra_repr(self) -> str:
+        return f"{self.num_embeddings}, {self.embedding_dim}, rows=[{self.vocab_start_index}, {self.vocab_end_index})"
+
+
+def gather_vocab_parallel_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    sizes = _gather_sizes(tensor.size(0), tensor.device)
+    return torch.cat(_all_gather(tensor, sizes))
+
+
+def load_vocab_parallel_tensor(
+    param: torch.Tensor,
+    key: str,
+    embeddings: VocabParallelEmbedding,
+    state_dict: dict,
+    missing_keys: List[str],
+    error_msgs: List[str],
+):
+    if key not in state_dict:
+        missing_keys.append(key)
+        return
+
+    tensor = state_dict[key]
+    if tensor.size(0) != embeddings.num_embeddings:
+        error_msgs.append(f"size mismatch for {key}: expected {embeddings.num_embeddings} rows, got {tensor.size(0)}")
+        return
+
+    with torch.no_grad():
+        param.copy_(tensor[embeddings.vocab_start_index : embeddings.vocab_end_index])
+
+
+class VocabParallelEntityPredictionHead(nn.Module):
+    """
+    Entity prediction head using the vocabulary-parallel entity embeddings as the decoder.
+
+    The transformed hidden states of all ranks are all-gathered and scored against the local rows of the decoder. The
+    softmax is normalized using the maximum and the sum over all ranks. The returned loss is the mean loss of the local
+    examples, but its gradient includes the losses of the other ranks so that the local rows of the decoder receive
+    the gradients of all examples.
+    """
+
+    def __init__(self, transform: nn.Module, embeddings: VocabParallelEmbedding):
+        super(VocabParallelEntityPredictionHead, self).__init__()
+        self.transform = transform
+        self.decoder = embeddings
+        self.bias = nn.Parameter(torch.zeros(embeddings.vocab_end_index - embeddings.vocab_start_index))
+        setattr(self.bias, VOCAB_PARALLEL_ATTRIBUTE, True)
+        self.bias.register_hook(_scale_grad_by_world_size)
+
+    def forward(self, hidden_states: torch.Tensor, labels: torch.LongTensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        rank = dist.get_rank()
+        start = self.decoder.vocab_start_index
+        end = self.decoder.vocab_end_index
+
+        hidden_states = self.transform(hidden_states)
+        sizes = _gather_sizes(hidden_states.size(0), hidden_states.device)
+        all_hidden_states = _GatherFromRanks.apply(hidden_states, sizes)
+        all_labels = torch.cat(_all_gather(labels, sizes))
+
+        logits = (F.linear(all_hidden_states, self.decoder.weight) + self.bias).float()
+
+        if logits.size(1) > 0:
+            max_logits = logits.detach().max(dim=1)[0]
+        else:
+            max_logits = logits.new_full((logits.size(0),), -math.inf)
+        dist.all_reduce(max_logits, op=dist.ReduceOp.MAX)
+
+        sum_exp_logits = _AllReduceSum.apply(torch.exp(logits - max_logits.unsqueeze(1)).sum(dim=1))
+
+        label_mask = (all_labels >= start) & (all_labels < end)
+        local_labels = (all_labels - start) * label_mask
+        if logits.size(1) > 0:
+            target_logits = logits.gather(1, local_labels.unsqueeze(1)).squeeze(1) * label_mask.to(logits.dtype)
+        else:
+            target_logits = logits.new_zeros(logits.size(0))
+        target_logits = _AllReduceSum.apply(target_logits)
+
+        losses = torch.log(sum_exp_logits) + max_logits - target_logits
+        correct = target_logits.detach() >= max_logits
+
+        size_tensor = torch.tensor(sizes, device=losses.device)
+        rank_indices = torch.repeat_interleave(torch.arange(len(sizes), device=losses.device), size_tensor)
+        rank_losses = losses.new_zeros(len(sizes)).index_add(0, rank_indices, losses)
+        rank_losses = rank_losses / size_tensor.clamp(min=1).to(losses.dtype)
+
+        total_loss = rank_losses.sum()
+        loss = total_loss - (total_loss - rank_losses[rank]).detach()
+
+        offset = sum(sizes[:rank])
+        num_correct = correct[offset : offset + sizes[rank]].sum()
+
+        return loss, num_correct
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(VocabParallelEntityPredictionHead, self)._save_to_state_dict(destination, prefix, keep_vars)
+        destination[prefix + "bias"] = gather_vocab_parallel_tensor(self.bias.detach())
+
+    def _load_from_state_dict(
+        self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+    ):
+        load_vocab_parallel_tensor(self.bias, prefix + "bias", self.decoder, state_dict, missing_keys, error_msgs)
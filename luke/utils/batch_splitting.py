@@ -0,0 +1,100 @@
+import logging
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_OUT_OF_MEMORY_MESSAGES = ("out of memory", "can't allocate memory")
+
+
+def is_out_of_memory_error(error: BaseException) -> bool:
+    return isinstance(error, RuntimeError) and any(message in str(error) for message in _OUT_OF_MEMORY_MESSAGES)
+
+
+def get_batch_size(batch: Dict[str, torch.Tensor]) -> int:
+    return next(iter(batch.values())).size(0)
+
+
+def split_batch(batch: Dict[str, torch.Tensor]) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+    """
+    Split the batch into two halves along the first dimension.
+    """
+    size = (get_batch_size(batch) + 1) // 2
+    return {k: v[:size] for k, v in batch.items()}, {k: v[size:] for k, v in batch.items()}
+
+
+def run_with_oom_recovery(
+    batch: Dict[str, torch.Tensor],
+    forward: Callable[[Dict[str, torch.Tensor], bool], Tuple[torch.Tensor, Any]],
+    backward: Callable[[torch.Tensor, bool], None],
+    reset_gradients: Callable[[], None],
+    enabled: bool = True,
+    split_backward: bool = True,
+) -> Tuple[List[Any], int, bool]:
+    """
+    Run the forward and backward passes of a micro-batch. If they run out of memory, the micro-batch is split into two
+    halves that are run in turn, and the halves are split recursively if needed.
+
+    forward receives the micro-batch or a part of it and whether the part is the last one of the micro-batch, and
+    returns the loss and an arbitrary output. The loss of a part needs to be weighted so that the gradients of the parts
+    sum up to those of the whole micro-batch. backward receives the loss and whether the part is the last one of the
+    micro-batch. In distributed training, both passes of the parts other than the last one need to be run without
+    synchronizing the gradients (e.g., in DistributedDataParallel.no_sync), because DistributedDataParallel prepares
+    the all-reduce of the gradients in the forward pass.
+
+    The function returns the outputs of the parts, the number of splits, and whether the gradients have been reset.
+    If the backward pass runs out of memory, the gradients may have been partially accumulated; reset_gradients is
+    then called and the whole micro-batch is run again. This discards the gradients of the micro-batches previously
+    accumulated in the same optimizer step, so the step is computed on fewer examples than configured.
+
+    If split_backward is False, out-of-memory errors in the backward pass are raised instead. This is required in
+    distributed training because the gradients cannot be reset on a single rank, and the gradients of the failed
+    pass may already have been all-reduced with the other ranks.
+    """
+    pending_parts = [batch]
+    completed_parts = []
+    outputs = []
+    num_splits = 0
+    gradients_reset = False
+
+    while pending_parts:
+        part = pending_parts.pop(0)
+        loss = output = None
+        in_backward = False
+        try:
+            is_last_part = not pending_parts
+            loss, output = forward(part, is_last_part)
+            in_backward = True
+            backward(loss, is_last_part)
+            outputs.append(output)
+            completed_parts.append(part)
+            continue
+
+        except RuntimeError as e:
+            if not enabled or not is_out_of_memory_error(e) or get_batch_size(part) < 2:
+                raise
+            if in_backward and not split_backward:
+                raise
+
+        # the part is retried outside the except clause so that the tensors referenced by the traceback are released
+        loss = output = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        num_splits += 1
+        logger.warning(
+            "Ran out of memory in the %s pass of a micro-batch of size %d. Retrying it in two halves...",
+            "backward" if in_backward else "forward",
+            get_batch_size(part),
+        )
+        if in_backward:
+            reset_gradients()
+            gradients_reset = True
+            pending_parts = completed_parts + list(split_batch(part)) + pending_parts
+            completed_parts = []
+            outputs = []
+        else:
+            pending_parts = list(split_batch(part)) + pending_parts
+
+    return outputs, num_splits, gradients_reset
@@ -0,0 +1,112 @@
+import logging
+import os
+from typing import List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Parameters having this attribute are partitioned across the ranks instead of being replicated. They are excluded
+# from DistributedDataParallel and their gradients are not averaged across the ranks.
+VOCAB_PARALLEL_ATTRIBUTE = "vocab_parallel"
+
+COMM_HOOKS = ("none", "fp16", "bf16", "powersgd")
+
+
+def get_distributed_backend(device: torch.device) -> str:
+    if device.type == "cuda":
+        return "nccl"
+    return "gloo"
+
+
+def get_local_cpu_ids(local_rank: int, num_local_processes: int) -> List[int]:
+    """
+    Split the CPUs available to this process into contiguous blocks of equal size and return the block assigned to
+    the process with the given local rank. All CPUs are returned if there are fewer CPUs than processes.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpu_ids = sorted(os.sched_getaffinity(0))
+    else:
+        cpu_ids = list(range(os.cpu_count()))
+
+    num_cpus_per_process = len(cpu_ids) // num_local_processes
+    if num_cpus_per_process == 0:
+        return cpu_ids
+
+    return cpu_ids[local_rank * num_cpus_per_process : (local_rank + 1) * num_cpus_per_process]
+
+
+def pin_threads(local_rank: int, num_local_processes: int, num_threads: Optional[int] = None) -> List[int]:
+    """
+    Pin the current process to its own block of CPUs and set the number of intra-op threads accordingly. This
+    prevents the processes running on the same node from competing for the same cores.
+    """
+    cpu_ids = get_local_cpu_ids(local_rank, num_local_processes)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_ids)
+
+    if num_threads is None:
+        num_threads = len(cpu_ids)
+    torch.set_num_threads(num_threads)
+    logger.info("Pinned process %d to CPUs %s using %d threads", local_rank, cpu_ids, num_threads)
+
+    return cpu_ids
+
+
+def is_vocab_parallel(param: torch.Tensor) -> bool:
+    return getattr(param, VOCAB_PARALLEL_ATTRIBUTE, False)
+
+
+def register_comm_hook(
+    model: torch.nn.parallel.DistributedDataParallel,
+    comm_hook: str,
+    powersgd_rank: int = 4,
+    powersgd_start_iteration: int = 1000,
+    powersgd_iteration: int = 0,
+):
+    """
+    Register a communication hook compressing the gradients all-reduced by the DistributedDataParallel model.
+    fp16 and bf16 halve the communicated bytes by casting the gradient buckets. powersgd communicates low-rank
+    approximations of the gradient matrices of rank powersgd_rank with error feedback, after all-reducing the
+    uncompressed gradients in the first powersgd_start_iteration iterations. powersgd_iteration is the number of
+    iterations already run when the training is resumed. Only the iteration counter is restored, so the error feedback
+    and the warm-started approximations are rebuilt from zero after resuming.
+    """
+    if comm_hook == "none":
+        return None
+
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+    if comm_hook == "fp16":
+        state, hook = None, default_hooks.fp16_compress_hook
+    elif comm_hook == "bf16":
+        state, hook = None, default_hooks.bf16_compress_hook
+    elif comm_hook == "powersgd":
+        state = powerSGD_hook.PowerSGDState(
+            process_group=None,
+            matrix_approximation_rank=powersgd_rank,
+            start_powerSGD_iter=powersgd_start_iteration,
+            use_error_feedback=True,
+            warm_start=True,
+        )
+        state.iter = powersgd_iteration
+        hook = powerSGD_hook.powerSGD_hook
+    else:
+        raise ValueError(f"Invalid communication hook: {comm_hook}")
+
+    model.register_comm_hook(state, hook)
+    logger.info("Registered the %s communication hook", comm_hook)
+
+    return state
+
+
+def broadcast_module(module: torch.nn.Module, src: int = 0):
+    """
+    Broadcast the replicated parameters and the buffers of the module from the rank src to the other ranks.
+    """
+    with torch.no_grad():
+        for param in module.parameters():
+            if not is_vocab_parallel(param):
+                torch.distributed.broadcast(param.data, src=src)
+        for buffer in module.buffers():
+            torch.distributed.broadcast(buffer, src=src)
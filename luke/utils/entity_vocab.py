@@ -1,6 +1,8 @@
-from typing import List, TextIO, Dict
+from typing import List, TextIO, Dict, FrozenSet, Optional, Tuple
+import heapq
 import json
-import math
+import logging
+import os
 from pathlib import Path
 
 import multiprocessing
@@ -9,20 +11,43 @@ from contextlib import closing
 from multiprocessing.pool import Pool
 
 import click
+import numpy as np
+from marisa_trie import Trie
 from tqdm import tqdm
 from wikipedia2vec.dump_db import DumpDB
 
 from .interwiki_db import InterwikiDB
+from .link_index import LinkIndex
+from .wikipedia_scan import LinkCounter, partition_titles, scan_page
+
+logger = logging.getLogger(__name__)
 
 PAD_TOKEN = "[PAD]"
 UNK_TOKEN = "[UNK]"
 MASK_TOKEN = "[MASK]"
 
 SPECIAL_TOKENS = {PAD_TOKEN, UNK_TOKEN, MASK_TOKEN}
+MULTILINGUAL_SPECIAL_TOKENS = [PAD_TOKEN, UNK_TOKEN, MASK_TOKEN]
 
 Entity = namedtuple("Entity", ["title", "language"])
 
-_dump_db = None  # global variable used in multiprocessing workers
+# the files of binary entity vocabularies
+BINARY_TRIE_FILE = "entities.marisa"
+BINARY_IDS_FILE = "ids.npy"
+BINARY_COUNTS_FILE = "counts.npy"
+BINARY_ID_INDPTR_FILE = "id_indptr.npy"
+BINARY_ID_KEY_INDICES_FILE = "id_key_indices.npy"
+BINARY_METADATA_FILE = "metadata.json"
+
+# global variables used in multiprocessing workers
+_dump_db = _sketch_size = _target_titles = _interwiki_db = None
+
+
+@click.command()
+@click.argument("vocab_file", type=click.Path(exists=True))
+@click.argument("out_dir", type=click.Path(file_okay=False))
+def convert_entity_vocab(vocab_file: str, out_dir: str):
+    EntityVocab(vocab_file).save_binary(out_dir)
 
 
 @click.command()
@@ -33,20 +58,55 @@ _dump_db = None  # global variable used in multiprocessing workers
 @click.option("--white-list-only", is_flag=True)
 @click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--chunk-size", default=100)
-def build_entity_vocab(dump_db_file: str, white_list: List[TextIO], **kwargs):
+@click.option("--approximate", is_flag=True)
+@click.option("--sketch-size", type=int, default=None)
+@click.option("--link-index", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--num-shards", default=1)
+@click.option("--shard-index", default=0)
+def build_entity_vocab(dump_db_file: str, white_list: List[TextIO], link_index: Optional[str], **kwargs):
     dump_db = DumpDB(dump_db_file)
     white_list = [line.rstrip() for f in white_list for line in f]
-    EntityVocab.build(dump_db, white_list=white_list, language=dump_db.language, **kwargs)
+    if link_index is not None:
+        link_index = LinkIndex(link_index)
+    EntityVocab.build(dump_db, white_list=white_list, language=dump_db.language, link_index=link_index, **kwargs)
+
+
+@click.command()
+@click.argument("out_file", type=click.Path())
+@click.option("vocab_files", "-v", "--vocab-file", type=click.Path(exists=True), multiple=True, required=True)
+@click.option("--vocab-size", default=1000000)
+@click.option("-w", "--white-list", type=click.File(), multiple=True)
+@click.option("--white-list-only", is_flag=True)
+def merge_entity_vocabs(out_file: str, vocab_files: List[str], white_list: List[TextIO], **kwargs):
+    white_list = [line.rstrip() for f in white_list for line in f]
+    EntityVocab.merge(list(vocab_files), out_file, white_list=white_list, **kwargs)
 
 
 class EntityVocab(object):
+    """
+    Entity vocabulary loaded from a JSONL file, a TSV file, or a binary vocabulary directory.
+
+    A binary vocabulary consists of a marisa trie of the entities keyed by "title\tlanguage" and numpy arrays of the
+    ids and the counts of the entities, which are memory-mapped instead of being parsed. As the vocabulary is pickled
+    as its path, the worker processes map the same files and share their pages. The dictionaries vocab, counter, and
+    inv_vocab are built on first access for a binary vocabulary, which is as slow as parsing a JSONL file.
+    """
+
     def __init__(self, vocab_file: str):
         self._vocab_file = vocab_file
 
-        self.vocab: Dict[Entity, int] = {}
-        self.counter: Dict[Entity, int] = {}
-        self.inv_vocab: Dict[int, List[Entity]] = defaultdict(list)
+        self._vocab: Dict[Entity, int] = None
+        self._counter: Dict[Entity, int] = None
+        self._inv_vocab: Dict[int, List[Entity]] = None
+        self._trie: Trie = None
 
+        if is_binary_entity_vocab(vocab_file):
+            self._load_binary_vocab(vocab_file)
+            return
+
+        self._vocab = {}
+        self._counter = {}
+        self._inv_vocab = defaultdict(list)
         # allow tsv files for backward compatibility
         if vocab_file.endswith(".tsv"):
             self._parse_tsv_vocab_file(vocab_file)
@@ -58,9 +118,9 @@ class EntityVocab(object):
             for (index, line) in enumerate(f):
                 title, count = line.rstrip().split("\t")
                 entity = Entity(title, None)
-                self.vocab[entity] = index
-                self.counter[entity] = int(count)
-                self.inv_vocab[index] = [entity]
+                self._vocab[entity] = index
+                self._counter[entity] = int(count)
+                self._inv_vocab[index] = [entity]
 
     def _parse_jsonl_vocab_file(self, vocab_file: str):
         with open(vocab_file, "r") as f:
@@ -69,9 +129,43 @@ class EntityVocab(object):
         for item in entities_json:
             for title, language in item["entities"]:
                 entity = Entity(title, language)
-                self.vocab[entity] = item["id"]
-                self.counter[entity] = item["count"]
-                self.inv_vocab[item["id"]].append(entity)
+                self._vocab[entity] = item["id"]
+                self._counter[entity] = item["count"]
+                self._inv_vocab[item["id"]].append(entity)
+
+    def _load_binary_vocab(self, vocab_dir: str):
+        self._trie = Trie()
+        self._trie.mmap(os.path.join(vocab_dir, BINARY_TRIE_FILE))
+        self._ids = np.load(os.path.join(vocab_dir, BINARY_IDS_FILE), mmap_mode="r")
+        self._counts = np.load(os.path.join(vocab_dir, BINARY_COUNTS_FILE), mmap_mode="r")
+        self._id_indptr = np.load(os.path.join(vocab_dir, BINARY_ID_INDPTR_FILE), mmap_mode="r")
+        self._id_key_indices = np.load(os.path.join(vocab_dir, BINARY_ID_KEY_INDICES_FILE), mmap_mode="r")
+        with open(os.path.join(vocab_dir, BINARY_METADATA_FILE)) as f:
+            self._size = json.load(f)["size"]
+
+    @property
+    def binary(self) -> bool:
+        return self._trie is not None
+
+    @property
+    def vocab(self) -> Dict[Entity, int]:
+        if self._vocab is None:
+            self._vocab = {entity: self.get_id(*entity) for entity in self}
+        return self._vocab
+
+    @property
+    def counter(self) -> Dict[Entity, int]:
+        if self._counter is None:
+            self._counter = {entity: self.get_count_by_title(*entity) for entity in self}
+        return self._counter
+
+    @property
+    def inv_vocab(self) -> Dict[int, List[Entity]]:
+        if self._inv_vocab is None:
+            self._inv_vocab = defaultdict(list)
+            for entity in self:
+                self._inv_vocab[self.get_id(*entity)].append(entity)
+        return self._inv_vocab
 
     @property
     def size(self) -> int:
@@ -81,7 +175,9 @@ class EntityVocab(object):
         return (self.__class__, (self._vocab_file,))
 
     def __len__(self):
-        return len(self.inv_vocab)
+        if self._trie is not None:
+            return self._size
+        return len(self._inv_vocab)
 
     def __contains__(self, item: str):
         return self.contains(item, language=None)
@@ -90,25 +186,79 @@ class EntityVocab(object):
         return self.get_id(key, language=None)
 
     def __iter__(self):
-        return iter(self.vocab)
+        if self._trie is not None:
+            return (_key_to_entity(self._trie.restore_key(int(index))) for index in self._id_key_indices)
+        return iter(self._vocab)
 
     def contains(self, title: str, language: str = None):
-        return Entity(title, language) in self.vocab
+        if self._trie is not None:
+            return _entity_to_key(title, language) in self._trie
+        return Entity(title, language) in self._vocab
 
     def get_id(self, title: str, language: str = None, default: int = None) -> int:
+        if self._trie is not None:
+            index = self._trie.get(_entity_to_key(title, language))
+            if index is None:
+                return default
+            return int(self._ids[index])
+
         try:
-            return self.vocab[Entity(title, language)]
+            return self._vocab[Entity(title, language)]
         except KeyError:
             return default
 
     def get_title_by_id(self, id_: int, language: str = None) -> str:
-        for entity in self.inv_vocab[id_]:
+        if self._trie is not None:
+            if not 0 <= id_ < len(self._id_indptr) - 1:
+                return None
+            for index in self._id_key_indices[self._id_indptr[id_] : self._id_indptr[id_ + 1]]:
+                entity = _key_to_entity(self._trie.restore_key(int(index)))
+                if entity.language == language:
+                    return entity.title
+            return None
+
+        for entity in self._inv_vocab[id_]:
             if entity.language == language:
                 return entity.title
 
     def get_count_by_title(self, title: str, language: str = None) -> int:
+        if self._trie is not None:
+            index = self._trie.get(_entity_to_key(title, language))
+            if index is None:
+                return 0
+            return int(self._counts[index])
+
         entity = Entity(title, language)
-        return self.counter.get(entity, 0)
+        return self._counter.get(entity, 0)
+
+    def save_binary(self, out_dir: str):
+        """
+        Save the vocabulary in the binary format to out_dir.
+        """
+        entities = list(self)
+        keys = [_entity_to_key(*entity) for entity in entities]
+        trie = Trie(keys)
+        key_indices = np.array([trie[key] for key in keys], dtype=np.int64)
+
+        ids = np.empty(len(trie), dtype=np.int32)
+        ids[key_indices] = [self.get_id(*entity) for entity in entities]
+        counts = np.empty(len(trie), dtype=np.int64)
+        counts[key_indices] = [self.get_count_by_title(*entity) for entity in entities]
+
+        # the entities of each id in the order of the original vocabulary
+        order = np.argsort(ids[key_indices], kind="stable")
+        id_key_indices = key_indices[order].astype(np.int32)
+        id_indptr = np.zeros(int(ids.max(initial=-1)) + 2, dtype=np.int64)
+        np.cumsum(np.bincount(ids, minlength=len(id_indptr) - 1), out=id_indptr[1:])
+
+        os.makedirs(out_dir, exist_ok=True)
+        trie.save(os.path.join(out_dir, BINARY_TRIE_FILE))
+        np.save(os.path.join(out_dir, BINARY_IDS_FILE), ids)
+        np.save(os.path.join(out_dir, BINARY_COUNTS_FILE), counts)
+        np.save(os.path.join(out_dir, BINARY_ID_INDPTR_FILE), id_indptr)
+        np.save(os.path.join(out_dir, BINARY_ID_KEY_INDICES_FILE), id_key_indices)
+        with open(os.path.join(out_dir, BINARY_METADATA_FILE), "w") as f:
+            json.dump(dict(size=len(self)), f)
 
     def save(self, out_file: str):
         with open(out_file, "w") as f:
@@ -128,14 +278,92 @@ class EntityVocab(object):
         pool_size: int,
         chunk_size: int,
         language: str,
+        approximate: bool = False,
+        sketch_size: int = None,
+        link_index: LinkIndex = None,
+        num_shards: int = 1,
+        shard_index: int = 0,
+    ):
+        """
+        Count the link targets in the pages and write the most frequent entities to out_file.
+
+        Each worker counts the links in a chunk of pages and the parent merges the partial counts of the chunks. In the
+        approximate mode, the partial counts are reduced to the candidates of the most frequent entities using the
+        Misra-Gries heavy hitters algorithm with sketch_size counters, bounding the memory usage of the parent, and the
+        candidates are then counted exactly in the second pass over the pages. An entity is guaranteed to be a
+        candidate if it accounts for more than 1 / (sketch_size + 1) of the links.
+
+        If the LinkIndex of the dump is specified, the links are counted exactly from the index without reading the
+        pages.
+
+        If num_shards is larger than one, only the links in the shard_index-th partition of the pages are counted, and
+        all the entities that can be in the vocabulary are written to out_file with their partial counts. The partial
+        vocabularies of the partitions are combined into the vocabulary using merge_entity_vocabs.
+        """
+        titles = list(dump_db.titles())
+        target_titles = partition_titles(titles, num_shards, shard_index)
+        if approximate and num_shards > 1:
+            raise ValueError("The approximate mode cannot be used with multiple shards")
+
+        if link_index is not None:
+            link_index.check_dump_db(dump_db)
+            counter = link_index.count_links(target_titles if num_shards > 1 else None)
+        elif approximate:
+            if sketch_size is None:
+                sketch_size = vocab_size * 4
+            sketch = EntityVocab._count_entities_in_pages(dump_db, titles, pool_size, chunk_size, sketch_size)
+            candidate_titles = frozenset(sketch.keys()) | frozenset(white_list)
+            logger.info("Counting %d candidate entities", len(candidate_titles))
+            counter = EntityVocab._count_entities_in_pages(
+                dump_db, titles, pool_size, chunk_size, target_titles=candidate_titles
+            )
+        else:
+            counter = EntityVocab._count_entities_in_pages(dump_db, target_titles, pool_size, chunk_size)
+
+        if num_shards > 1:
+            # the vocabulary size is applied when the partial vocabularies are merged
+            EntityVocab.build_from_counter(counter, frozenset(titles), out_file, None, white_list, False, language)
+        else:
+            EntityVocab.build_from_counter(
+                counter, frozenset(titles), out_file, vocab_size, white_list, white_list_only, language
+            )
+
+    @staticmethod
+    def merge(
+        vocab_files: List[str], out_file: str, vocab_size: int, white_list: List[str], white_list_only: bool,
     ):
+        """
+        Sum the counts in the partial vocabularies built by the partitions of the pages and write the most frequent
+        entities to out_file. The result is the same as building the vocabulary from all the pages at once.
+        """
         counter = Counter()
-        with tqdm(total=dump_db.page_size(), mininterval=0.5) as pbar:
-            with closing(Pool(pool_size, initializer=EntityVocab._initialize_worker, initargs=(dump_db,))) as pool:
-                for ret in pool.imap_unordered(EntityVocab._count_entities, dump_db.titles(), chunksize=chunk_size):
-                    counter.update(ret)
-                    pbar.update()
+        language = None
+        for vocab_file in vocab_files:
+            vocab = EntityVocab(vocab_file)
+            for entity, count in vocab.counter.items():
+                if entity.title not in SPECIAL_TOKENS:
+                    counter[entity.title] += count
+                    language = entity.language
+
+        # the partial vocabularies contain only the entities that can be in the vocabulary
+        EntityVocab.build_from_counter(
+            counter, frozenset(counter.keys()), out_file, vocab_size, white_list, white_list_only, language
+        )
 
+    @staticmethod
+    def build_from_counter(
+        counter: Counter,
+        valid_titles: FrozenSet[str],
+        out_file: str,
+        vocab_size: int,
+        white_list: List[str],
+        white_list_only: bool,
+        language: str,
+    ):
+        """
+        Write the special tokens, the entities in the white list, and the most frequent entities in valid_titles to
+        out_file.
+        """
         title_dict = OrderedDict()
         title_dict[PAD_TOKEN] = 0
         title_dict[UNK_TOKEN] = 0
@@ -146,8 +374,8 @@ class EntityVocab(object):
                 title_dict[title] = counter[title]
 
         if not white_list_only:
-            valid_titles = frozenset(dump_db.titles())
-            for title, count in counter.most_common():
+            # the entities with the same count are ordered by their titles so that the vocabulary is deterministic
+            for title, count in sorted(counter.items(), key=lambda item: (-item[1], item[0])):
                 if title in valid_titles and not title.startswith("Category:"):
                     title_dict[title] = count
                     if len(title_dict) == vocab_size:
@@ -159,18 +387,114 @@ class EntityVocab(object):
                 f.write("\n")
 
     @staticmethod
-    def _initialize_worker(dump_db: DumpDB):
-        global _dump_db
+    def _count_entities_in_pages(
+        dump_db: DumpDB,
+        titles: List[str],
+        pool_size: int,
+        chunk_size: int,
+        sketch_size: int = None,
+        target_titles: FrozenSet[str] = None,
+    ) -> Counter:
+        chunks = [titles[i : i + chunk_size] for i in range(0, len(titles), chunk_size)]
+        initargs = (dump_db, sketch_size, target_titles)
+        counter = Counter()
+        with tqdm(total=len(titles), mininterval=0.5) as pbar:
+            with closing(Pool(pool_size, initializer=EntityVocab._initialize_worker, initargs=initargs)) as pool:
+                for chunk_counter, num_pages in pool.imap_unordered(EntityVocab._count_entities, chunks):
+                    counter.update(chunk_counter)
+                    # the sketch is reduced only when it doubles in size to amortize the cost of the reduction
+                    if sketch_size is not None and len(counter) > sketch_size * 2:
+                        counter = _reduce_sketch(counter, sketch_size)
+                    pbar.update(num_pages)
+
+        if sketch_size is not None:
+            counter = _reduce_sketch(counter, sketch_size)
+        return counter
+
+    @staticmethod
+    def _initialize_worker(dump_db: DumpDB, sketch_size: int = None, target_titles: FrozenSet[str] = None):
+        global _dump_db, _sketch_size, _target_titles
         _dump_db = dump_db
+        _sketch_size = sketch_size
+        _target_titles = target_titles
 
     @staticmethod
-    def _count_entities(title: str) -> Dict[str, int]:
+    def _count_entities(titles: List[str]) -> Tuple[Dict[str, int], int]:
         counter = Counter()
-        for paragraph in _dump_db.get_paragraphs(title):
-            for wiki_link in paragraph.wiki_links:
-                title = _dump_db.resolve_redirect(wiki_link.title)
-                counter[title] += 1
+        for page_title in titles:
+            for paragraph in scan_page(_dump_db, page_title):
+                for wiki_link in paragraph.wiki_links:
+                    if _target_titles is None or wiki_link.title in _target_titles:
+                        counter[wiki_link.title] += 1
+
+        if _sketch_size is not None:
+            counter = _reduce_sketch(counter, _sketch_size)
+        return counter, len(titles)
+
+
+class EntityVocabBuilder(LinkCounter):
+    """
+    A consumer of scan_wikipedia that counts the links in the pages and writes the entity vocabulary to out_file. The
+    result is the EntityVocab of the written file.
+    """
+
+    name = "entity_vocab"
+
+    def __init__(
+        self,
+        out_file: str,
+        language: str,
+        vocab_size: int = 1000000,
+        white_list: List[str] = (),
+        white_list_only: bool = False,
+    ):
+        super().__init__()
+        self._out_file = out_file
+        self._language = language
+        self._vocab_size = vocab_size
+        self._white_list = list(white_list)
+        self._white_list_only = white_list_only
+        self._valid_titles = set()
+
+    def merge(self, title: str, result: Counter):
+        super().merge(title, result)
+        self._valid_titles.add(title)
+
+    def finish(self) -> "EntityVocab":
+        EntityVocab.build_from_counter(
+            self._counter,
+            frozenset(self._valid_titles),
+            self._out_file,
+            self._vocab_size,
+            self._white_list,
+            self._white_list_only,
+            self._language,
+        )
+        return EntityVocab(self._out_file)
+
+
+def _reduce_sketch(counter: Counter, sketch_size: int) -> Counter:
+    """
+    Reduce the counter to at most sketch_size entries by subtracting the (sketch_size + 1)-th largest count from all
+    counts, which is the merge operation of Misra-Gries summaries.
+    """
+    if len(counter) <= sketch_size:
         return counter
+    threshold = heapq.nlargest(sketch_size + 1, counter.values())[-1]
+    return Counter({title: count - threshold for title, count in counter.items() if count > threshold})
+
+
+def is_binary_entity_vocab(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, BINARY_TRIE_FILE))
+
+
+def _entity_to_key(title: str, language: str = None) -> str:
+    return "%s\t%s" % (title, language or "")
+
+
+def _key_to_entity(key: str) -> Entity:
+    title, language = key.rsplit("\t", 1)
+    return Entity(title, language or None)
 
 
 @click.command()
@@ -178,8 +502,13 @@ class EntityVocab(object):
 @click.option("inter_wiki_db_path", "-i", type=click.Path())
 @click.option("out_file", "-o", type=click.Path())
 @click.option("vocab_size", "-s", type=int)
+@click.option("--pool-size", default=multiprocessing.cpu_count())
 def build_multilingual_entity_vocab(
-    entity_vocab_files: List[str], inter_wiki_db_path: str, out_file: str, vocab_size: int = 1000000
+    entity_vocab_files: List[str],
+    inter_wiki_db_path: str,
+    out_file: str,
+    vocab_size: int = 1000000,
+    pool_size: int = multiprocessing.cpu_count(),
 ):
 
     for entity_vocab_path in entity_vocab_files:
@@ -190,46 +519,131 @@ def build_multilingual_entity_vocab(
                 "Please use the jsonl file format and try again."
             )
 
-    db = InterwikiDB.load(inter_wiki_db_path)
-
-    vocab: Dict[Entity, int] = {}  # title -> index
-    inv_vocab = defaultdict(set)  # index -> Set[title]
-    count_dict = defaultdict(int)  # index -> count
+    # each worker parses a vocabulary file and resolves its entities to the rows of the Wikidata items
+    pool_size = max(1, min(pool_size, len(entity_vocab_files)))
+    initargs = (inter_wiki_db_path,)
+    with closing(Pool(pool_size, initializer=_initialize_multilingual_worker, initargs=initargs)) as pool:
+        results = pool.map(_read_multilingual_vocab_file, entity_vocab_files)
 
-    special_token_to_idx = {special_token: idx for idx, special_token in enumerate(SPECIAL_TOKENS)}
-    current_new_id = len(special_token_to_idx)
-
-    for entity_vocab_path in entity_vocab_files:
-        with open(entity_vocab_path, "r") as f:
-            for line in f:
-                entity_dict = json.loads(line)
-                for title, lang in entity_dict["entities"]:
-                    entity = Entity(title, lang)
-                    multilingual_entities = {entity}
-                    if title not in SPECIAL_TOKENS:
-                        aligned_entities = {Entity(t, ln) for t, ln in db.query(title, lang)}
-                        multilingual_entities.update(aligned_entities)
-                        # judge if we should assign a new id to these entities
-                        already_registered_entities = aligned_entities & vocab.keys()
-                        if len(already_registered_entities) > 0:
-                            already_registered_entity = list(already_registered_entities)[0]
-                            ent_id = vocab[already_registered_entity]
-                        else:
-                            ent_id = current_new_id
-                            current_new_id += 1
-                    else:
-                        ent_id = special_token_to_idx[title]
-
-                    vocab[entity] = ent_id
-                    inv_vocab[ent_id].add((entity.title, entity.language))  # Convert Entity to Tuple for json.dump
-                    count_dict[ent_id] += entity_dict["count"]
-    json_dicts = [
-        {"entities": list(inv_vocab[ent_id]), "count": count_dict[ent_id]} for ent_id in range(current_new_id)
-    ]
-    json_dicts.sort(key=lambda x: -x["count"] if x["count"] != 0 else -math.inf)
-    json_dicts = json_dicts[:vocab_size]
+    keys = [key for result in results for key in result[0]]
+    arrays = [np.concatenate([result[n] for result in results]) for n in range(1, 5)]
+    json_dicts = _merge_multilingual_entities(keys, *arrays)[:vocab_size]
 
     with open(out_file, "w") as f:
         for ent_id, item in enumerate(json_dicts):
             json.dump({"id": ent_id, **item}, f)
             f.write("\n")
+
+
+def _initialize_multilingual_worker(inter_wiki_db_path: str):
+    global _interwiki_db
+    _interwiki_db = InterwikiDB.load(inter_wiki_db_path)
+
+
+def _read_multilingual_vocab_file(
+    entity_vocab_path: str,
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    special_token_to_idx = {special_token: idx for idx, special_token in enumerate(MULTILINGUAL_SPECIAL_TOKENS)}
+    titles = []
+    languages = []
+    counts = []
+    num_entities = []
+    with open(entity_vocab_path, "r") as f:
+        for line in f:
+            entity_dict = json.loads(line)
+            for title, lang in entity_dict["entities"]:
+                titles.append(title)
+                languages.append(lang)
+            counts.append(entity_dict["count"])
+            num_entities.append(len(entity_dict["entities"]))
+
+    special_ids = np.fromiter((special_token_to_idx.get(title, -1) for title in titles), np.int64, len(titles))
+    rows = _interwiki_db.batch_query(titles, languages)
+    rows[special_ids != -1] = -1
+    keys = [_entity_to_key(title, lang) for title, lang in zip(titles, languages)]
+
+    return keys, special_ids, rows, np.array(counts, dtype=np.int64), np.array(num_entities, dtype=np.int64)
+
+
+def _merge_multilingual_entities(
+    keys: List[str], special_ids: np.ndarray, rows: np.ndarray, counts: np.ndarray, num_entities: np.ndarray
+) -> List[dict]:
+    """
+    Merge the entities of the vocabulary items into multilingual entities. The entities with the same special token
+    title, the entities aligned to the same Wikidata item, and the entities in the same item are merged. The merged
+    entities are sorted by their counts in descending order, preceded by the ones with zero counts, and ties are
+    ordered by their first appearances.
+    """
+    num_special_tokens = len(MULTILINGUAL_SPECIAL_TOKENS)
+
+    # the nodes of the union-find are the special tokens, the distinct entities in the order of their first
+    # appearances, and the Wikidata items
+    unique_keys, first_indices, inverse = np.unique(
+        np.array(keys, dtype=object), return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_indices, kind="stable")
+    unique_keys = unique_keys[order]
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    entity_nodes = num_special_tokens + ranks[inverse]
+    num_unique_entities = len(unique_keys)
+
+    aligned = rows != -1
+    _, row_inverse = np.unique(rows[aligned], return_inverse=True)
+    row_nodes = num_special_tokens + num_unique_entities + row_inverse
+
+    item_starts = np.cumsum(num_entities) - num_entities
+    first_entity_nodes = entity_nodes[np.repeat(item_starts, num_entities)]
+
+    special = special_ids != -1
+    parents = _union_find(
+        num_special_tokens + num_unique_entities + row_inverse.size,
+        np.concatenate([entity_nodes[special], entity_nodes[aligned], entity_nodes]),
+        np.concatenate([special_ids[special], row_nodes, first_entity_nodes]),
+    )
+
+    # each root is the smallest node of its component, so the groups are ordered by their first appearances
+    entity_roots = parents[num_special_tokens : num_special_tokens + num_unique_entities]
+    roots = np.unique(np.concatenate([np.arange(num_special_tokens), entity_roots]))
+    entity_groups = np.searchsorted(roots, entity_roots)
+
+    nonempty = num_entities != 0
+    item_groups = np.searchsorted(roots, parents[entity_nodes[item_starts[nonempty]]])
+    group_counts = np.bincount(item_groups, weights=counts[nonempty], minlength=len(roots))
+    group_counts = np.rint(group_counts).astype(np.int64)
+
+    sorted_groups = np.argsort(np.where(group_counts == 0, -np.inf, -group_counts), kind="stable")
+    members = np.argsort(entity_groups, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(entity_groups, minlength=len(roots)))])
+
+    json_dicts = []
+    for group in sorted_groups:
+        entities = [list(_key_to_entity(key)) for key in unique_keys[members[indptr[group] : indptr[group + 1]]]]
+        json_dicts.append({"entities": entities, "count": int(group_counts[group])})
+
+    return json_dicts
+
+
+def _union_find(num_nodes: int, nodes1: np.ndarray, nodes2: np.ndarray) -> np.ndarray:
+    """
+    Return the root of each node after merging the pairs of the nodes. The roots are the smallest nodes of the
+    components. The pairs are merged simultaneously by linking the larger roots to the smaller ones and compressing
+    the paths by pointer jumping.
+    """
+    parents = np.arange(num_nodes)
+    while True:
+        while True:
+            grandparents = parents[parents]
+            if np.array_equal(grandparents, parents):
+                break
+            parents = grandparents
+
+        roots1 = parents[nodes1]
+        roots2 = parents[nodes2]
+        unmerged = roots1 != roots2
+        if not unmerged.any():
+            return parents
+
+        roots1 = roots1[unmerged]
+        roots2 = roots2[unmerged]
+        np.minimum.at(parents, np.maximum(roots1, roots2), np.minimum(roots1, roots2))
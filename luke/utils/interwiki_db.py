@@ -1,29 +1,57 @@
 # -*- coding: utf-8 -*-
-from typing import List
+from typing import BinaryIO, Dict, FrozenSet, Iterator, List, Optional, Tuple, Union
 
 import bz2
+import gzip
+import io
 import logging
+import mmap
+import multiprocessing
+import os
 import re
+import tempfile
+from contextlib import closing
+from multiprocessing.pool import Pool
+
 import click
 import joblib
 import numpy as np
 import ujson
 from marisa_trie import Trie
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 KEY_RULE = re.compile("^(.*):([^:]+)$")
+# the header of a bz2 stream followed by the magic number of its first block
+BZ2_STREAM_HEADER_RULE = re.compile(rb"BZh[1-9]1AY&SY")
+
+# the magic numbers of the supported compression formats
+COMPRESSION_MAGICS = {"bz2": b"BZh", "gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+BUFFER_SIZE = 2 ** 20
 
 logger = logging.getLogger(__name__)
 
+# global variables used in multiprocessing workers
+_target_languages = _spill_dir = None
+
 
 @click.command()
 @click.argument("wikidata_dump_file", type=click.Path(exists=True))
 @click.argument("out_file", type=click.Path())
 @click.option("-l", "--language", multiple=True)
-def build_interwiki_db(wikidata_dump_file: str, out_file: str, language: List[str] = None):
+@click.option("--pool-size", default=multiprocessing.cpu_count())
+@click.option("--chunk-size", default=10000)
+@click.option("--block-size", default=2 ** 26)
+@click.option("--spill-dir", type=click.Path(exists=True, file_okay=False), default=None)
+def build_interwiki_db(wikidata_dump_file: str, out_file: str, language: List[str] = None, **kwargs):
     logging.basicConfig(level=logging.INFO)
     if language:
         language = frozenset(language)
-    interwiki_db = InterwikiDB.build(wikidata_dump_file, language)
+    interwiki_db = InterwikiDB.build(wikidata_dump_file, language, **kwargs)
     interwiki_db.save(out_file)
 
 
@@ -33,54 +61,121 @@ class InterwikiDB(object):
         self._data = data
         self._indptr = indptr
         self._title_indices = title_indices
+        self._title_to_item_id_cache = {}
 
     def query(self, title: str, lang: str):
-        try:
-            key = "%s:%s" % (title, lang)
-            row = self._title_indices[self._title_trie[key]]
-            objs = [
-                KEY_RULE.match(self._title_trie.restore_key(ind))
-                for ind in self._data[self._indptr[row] : self._indptr[row + 1]]
-            ]
-            return [(o.group(1), o.group(2)) for o in objs]
-
-        except KeyError:
-            return []
+        return [self.get_title(title_id) for title_id in self.query_ids(title, lang)]
+
+    def item_id(self, title: str, lang: str) -> int:
+        """
+        Return the id of the Wikidata item of the title, or -1 if the title is not in the database.
+        """
+        if lang is None:
+            return -1
+        title_id = self._title_trie.get("%s:%s" % (title, lang))
+        if title_id is None:
+            return -1
+        return int(self._title_indices[title_id])
+
+    def query_ids(self, title: str, lang: str) -> np.ndarray:
+        """
+        Return the ids of the titles aligned to the title including itself. The ids can be converted to the titles using
+        get_title.
+        """
+        item_id = self.item_id(title, lang)
+        if item_id == -1:
+            return np.zeros(0, dtype=self._data.dtype)
+        return self._data[self._indptr[item_id] : self._indptr[item_id + 1]]
+
+    def get_title(self, title_id: int) -> Tuple[str, str]:
+        obj = KEY_RULE.match(self._title_trie.restore_key(int(title_id)))
+        return obj.group(1), obj.group(2)
+
+    def batch_query(self, titles: List[str], langs: Union[str, List[str]], use_cache: bool = False) -> np.ndarray:
+        """
+        Return the ids of the Wikidata items of the titles, or -1 for the titles not in the database or without
+        languages. Two titles are aligned if their item ids are equal and not -1.
+
+        The titles are looked up in the trie by default. If a single language is given and either use_cache is True or
+        the dictionary of the language has already been built, the cached dictionary of get_title_to_item_id is used
+        instead.
+        """
+        if isinstance(langs, str) and (use_cache or langs in self._title_to_item_id_cache):
+            title_to_item_id = self.get_title_to_item_id(langs)
+            return np.fromiter((title_to_item_id.get(title, -1) for title in titles), dtype=np.int64, count=len(titles))
+
+        if isinstance(langs, str) or langs is None:
+            langs = [langs] * len(titles)
+
+        title_ids = np.fromiter(
+            (
+                -1 if lang is None else self._title_trie.get("%s:%s" % (title, lang), -1)
+                for title, lang in zip(titles, langs)
+            ),
+            dtype=np.int64,
+            count=len(titles),
+        )
+        item_ids = np.full(len(titles), -1, dtype=np.int64)
+        mask = title_ids != -1
+        item_ids[mask] = self._title_indices[title_ids[mask]]
+
+        return item_ids
+
+    def get_title_to_item_id(self, lang: str) -> Dict[str, int]:
+        """
+        Return a dictionary mapping the titles in the language to the ids of their Wikidata items. The dictionary is
+        built by scanning all the titles in the database and is cached for each language, so this is only worthwhile
+        for a large number of lookups in a single process.
+        """
+        if lang is None:
+            return {}
+        if lang not in self._title_to_item_id_cache:
+            suffix = ":" + lang
+            self._title_to_item_id_cache[lang] = {
+                key[: -len(suffix)]: int(self._title_indices[title_id])
+                for key, title_id in self._title_trie.iteritems()
+                if key.endswith(suffix)
+            }
+        return self._title_to_item_id_cache[lang]
 
     @staticmethod
-    def build(wiki_data_file: str, target_languages: List[str] = None):
+    def build(
+        wiki_data_file: str,
+        target_languages: List[str] = None,
+        pool_size: int = 1,
+        chunk_size: int = 10000,
+        block_size: int = 2 ** 26,
+        spill_dir: str = None,
+    ):
+        """
+        Build the database from a Wikidata JSON dump that is compressed using bz2, gzip, or zstd or not compressed. If
+        pool_size is larger than one, the dump is parsed in parallel: uncompressed dumps and multistream bz2 dumps are
+        split into blocks of about block_size bytes that are decompressed and parsed by the workers, and the other dumps
+        are decompressed in the main process and parsed by the workers in chunks of chunk_size lines. The workers write
+        the parsed sitelinks to temporary files in spill_dir. Both ways produce the same database.
+        """
+        if pool_size > 1:
+            return InterwikiDB._build_in_parallel(
+                wiki_data_file, target_languages, pool_size, chunk_size, block_size, spill_dir
+            )
+
         data = []
         indptr = [0]
         titles = []
         title_indices = []
 
-        with bz2.BZ2File(wiki_data_file) as f:
+        with _open_dump_file(wiki_data_file) as f:
             for (n, line) in enumerate(f):
                 if n % 1000 == 0 and n != 0:
                     logger.info("Processed %d lines", n)
 
-                line = line.rstrip().decode("utf-8")
-                if line in ("[", "]"):
+                item_titles = _parse_item(line, target_languages)
+                if item_titles is None:
                     continue
 
-                if line[-1] == ",":
-                    line = line[:-1]
-                obj = ujson.loads(line)
-                if obj["type"] != "item":
-                    continue
-
-                for link_obj in obj["sitelinks"].values():
-                    site = link_obj["site"]
-                    if not site.endswith("wiki"):
-                        continue
-                    lang = site[:-4]
-                    if target_languages and lang not in target_languages:
-                        continue
-
+                for title in item_titles:
                     title_indices.append(len(indptr) - 1)
                     data.append(len(titles))
-
-                    title = "%s:%s" % (link_obj["title"], lang)
                     titles.append(title)
 
                 indptr.append(len(data))
@@ -94,6 +189,82 @@ class InterwikiDB(object):
 
         return InterwikiDB(title_trie, data, indptr, new_title_indices)
 
+    @staticmethod
+    def _build_in_parallel(
+        wiki_data_file: str,
+        target_languages: Optional[FrozenSet[str]],
+        pool_size: int,
+        chunk_size: int,
+        block_size: int,
+        spill_dir: Optional[str],
+    ):
+        with tempfile.TemporaryDirectory(dir=spill_dir) as temp_dir:
+            # each segment is either a spill file or the titles of an item spanning two blocks
+            segments = []
+            initargs = (target_languages, temp_dir)
+            with closing(Pool(pool_size, initializer=_initialize_worker, initargs=initargs)) as pool:
+                block_ranges = _split_dump_file(wiki_data_file, block_size)
+                if block_ranges is None:
+                    results = pool.imap(_parse_lines, _read_line_chunks(wiki_data_file, chunk_size))
+                else:
+                    tasks = [(wiki_data_file, start, end) for start, end in block_ranges]
+                    results = pool.imap(_parse_block, tasks)
+
+                # the lines spanning two blocks are joined and parsed in the main process
+                pending = b""
+                for (n, (spill_file, head, tail)) in enumerate(results):
+                    if n % 100 == 0 and n != 0:
+                        logger.info("Processed %d chunks", n)
+
+                    if tail is None:
+                        pending += head
+                        continue
+
+                    item_titles = _parse_item(pending + head, target_languages)
+                    if item_titles is not None:
+                        segments.append(item_titles)
+                    segments.append(spill_file)
+                    pending = tail
+
+                item_titles = _parse_item(pending, target_languages)
+                if item_titles is not None:
+                    segments.append(item_titles)
+
+            def iter_items():
+                for segment in segments:
+                    if isinstance(segment, str):
+                        with open(segment, encoding="utf-8", newline="\n") as f:
+                            for line in f:
+                                line = line.rstrip("\n")
+                                yield line.split("\t") if line else []
+                    else:
+                        yield segment
+
+            num_titles = 0
+
+            def iter_titles():
+                nonlocal num_titles
+                for item_titles in iter_items():
+                    num_titles += len(item_titles)
+                    yield from item_titles
+
+            title_trie = Trie(iter_titles())
+
+            data = []
+            indptr = [0]
+            new_title_indices = np.empty(num_titles, dtype=np.int)
+            for (row, item_titles) in enumerate(iter_items()):
+                for title in item_titles:
+                    title_id = title_trie[title]
+                    data.append(title_id)
+                    new_title_indices[title_id] = row
+                indptr.append(len(data))
+
+        data = np.array(data, dtype=np.int)
+        indptr = np.array(indptr, dtype=np.int)
+
+        return InterwikiDB(title_trie, data, indptr, new_title_indices)
+
     def save(self, out_file: str):
         joblib.dump(
             dict(
@@ -113,3 +284,160 @@ class InterwikiDB(object):
         data["title_trie"] = title_trie
 
         return InterwikiDB(**data)
+
+
+def _get_compression(dump_file: str) -> Optional[str]:
+    with open(dump_file, "rb") as f:
+        magic = f.read(4)
+    for compression, magic_prefix in COMPRESSION_MAGICS.items():
+        if magic.startswith(magic_prefix):
+            return compression
+    return None
+
+
+def _open_dump_file(dump_file: str) -> BinaryIO:
+    compression = _get_compression(dump_file)
+    if compression == "bz2":
+        return bz2.BZ2File(dump_file)
+    if compression == "gzip":
+        return gzip.GzipFile(dump_file)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed dumps")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(dump_file, "rb"), closefd=True)
+        return io.BufferedReader(reader, BUFFER_SIZE)
+    return open(dump_file, "rb")
+
+
+def _parse_item(line: bytes, target_languages: Optional[FrozenSet[str]]) -> Optional[List[str]]:
+    """
+    Return the keys of the Wikipedia sitelinks of the item in the line, or None if the line does not contain an item.
+    """
+    line = line.rstrip().decode("utf-8")
+    if line in ("", "[", "]"):
+        return None
+
+    if line[-1] == ",":
+        line = line[:-1]
+    obj = ujson.loads(line)
+    if obj["type"] != "item":
+        return None
+
+    titles = []
+    for link_obj in obj["sitelinks"].values():
+        site = link_obj["site"]
+        if not site.endswith("wiki"):
+            continue
+        lang = site[:-4]
+        if target_languages and lang not in target_languages:
+            continue
+        titles.append("%s:%s" % (link_obj["title"], lang))
+
+    return titles
+
+
+def _split_dump_file(dump_file: str, block_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Split the dump file into ranges of bytes that can be decompressed independently. Uncompressed files are split at
+    arbitrary positions, and bz2 files are split at the boundaries of their streams. Return None if the file cannot be
+    split.
+    """
+    file_size = os.path.getsize(dump_file)
+    if file_size == 0:
+        return None
+
+    compression = _get_compression(dump_file)
+    if compression == "bz2":
+        with open(dump_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                offsets = [m.start() for m in BZ2_STREAM_HEADER_RULE.finditer(buf)]
+        if len(offsets) < 2 or offsets[0] != 0:
+            return None
+    elif compression is not None:
+        return None
+    else:
+        offsets = range(0, file_size, block_size)
+
+    ranges = []
+    start = 0
+    for offset in offsets:
+        if offset - start >= block_size:
+            ranges.append((start, offset))
+            start = offset
+    ranges.append((start, file_size))
+
+    return ranges
+
+
+def _read_block(dump_file: str, start: int, end: int) -> Iterator[bytes]:
+    compressed = _get_compression(dump_file) == "bz2"
+    decompressor = bz2.BZ2Decompressor()
+    with open(dump_file, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            buf = f.read(min(BUFFER_SIZE, remaining))
+            remaining -= len(buf)
+            if not compressed:
+                yield buf
+                continue
+
+            # a block may consist of multiple bz2 streams
+            while buf:
+                if decompressor.eof:
+                    decompressor = bz2.BZ2Decompressor()
+                yield decompressor.decompress(buf)
+                buf = decompressor.unused_data if decompressor.eof else b""
+
+
+def _read_line_chunks(dump_file: str, chunk_size: int) -> Iterator[List[bytes]]:
+    with _open_dump_file(dump_file) as f:
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _initialize_worker(target_languages: Optional[FrozenSet[str]], spill_dir: str):
+    global _target_languages, _spill_dir
+    _target_languages = target_languages
+    _spill_dir = spill_dir
+
+
+def _parse_block(args: Tuple[str, int, int]) -> Tuple[str, bytes, Optional[bytes]]:
+    """
+    Parse the complete lines in the block and write the keys of the sitelinks of each item to a spill file. Return
+    the spill file, the bytes before the first newline, and the bytes after the last newline, which is None if the
+    block contains no newline.
+    """
+    dump_file, start, end = args
+    head = None
+    pending = b""
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=_spill_dir, delete=False) as spill_file:
+        for buf in _read_block(dump_file, start, end):
+            lines = (pending + buf).split(b"\n")
+            pending = lines.pop()
+            if head is None and lines:
+                head = lines.pop(0)
+            _write_items(spill_file, lines)
+
+    if head is None:
+        return spill_file.name, pending, None
+    return spill_file.name, head, pending
+
+
+def _parse_lines(lines: List[bytes]) -> Tuple[str, bytes, bytes]:
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=_spill_dir, delete=False) as spill_file:
+        _write_items(spill_file, lines)
+    return spill_file.name, b"", b""
+
+
+def _write_items(spill_file, lines: List[bytes]):
+    for line in lines:
+        item_titles = _parse_item(line, _target_languages)
+        if item_titles is not None:
+            spill_file.write("\t".join(item_titles) + "\n")
@@ -0,0 +1,213 @@
+import json
+import logging
+import multiprocessing
+import os
+from array import array
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import click
+import numpy as np
+from marisa_trie import Trie
+from wikipedia2vec.dump_db import DumpDB, Paragraph, WikiLink
+
+from .wikipedia_scan import PageConsumer, scan_wikipedia
+
+logger = logging.getLogger(__name__)
+
+TITLE_TRIE_FILE = "titles.marisa"
+ANCHOR_TRIE_FILE = "anchors.marisa"
+TITLE_PAGE_ROWS_FILE = "title_page_rows.npy"
+PARAGRAPH_INDPTR_FILE = "paragraph_indptr.npy"
+LINK_INDPTR_FILE = "link_indptr.npy"
+LINK_TARGETS_FILE = "link_targets.npy"
+LINK_ANCHORS_FILE = "link_anchors.npy"
+LINK_SPANS_FILE = "link_spans.npy"
+METADATA_FILE = "metadata.json"
+
+
+@click.command()
+@click.argument("dump_db_file", type=click.Path(exists=True))
+@click.argument("out_dir", type=click.Path(file_okay=False))
+@click.option("--pool-size", default=multiprocessing.cpu_count())
+@click.option("--chunk-size", default=100)
+def build_link_index(dump_db_file: str, out_dir: str, **kwargs):
+    dump_db = DumpDB(dump_db_file)
+    LinkIndex.build(dump_db, out_dir, **kwargs)
+
+
+class LinkIndex(object):
+    """
+    A memory-mapped index of the links in the pages of a DumpDB. For each paragraph of each page, the index stores the
+    target of each link resolved through the redirects, its character span, and its anchor text. The targets and the
+    anchor texts are stored as the ids of the titles and the anchor texts in tries.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, METADATA_FILE)) as f:
+            self.metadata = json.load(f)
+
+        self.title_trie = Trie().mmap(os.path.join(index_dir, TITLE_TRIE_FILE))
+        self.anchor_trie = Trie().mmap(os.path.join(index_dir, ANCHOR_TRIE_FILE))
+        self._title_page_rows = np.load(os.path.join(index_dir, TITLE_PAGE_ROWS_FILE), mmap_mode="r")
+        self._paragraph_indptr = np.load(os.path.join(index_dir, PARAGRAPH_INDPTR_FILE), mmap_mode="r")
+        self._link_indptr = np.load(os.path.join(index_dir, LINK_INDPTR_FILE), mmap_mode="r")
+        self.link_targets = np.load(os.path.join(index_dir, LINK_TARGETS_FILE), mmap_mode="r")
+        self.link_anchors = np.load(os.path.join(index_dir, LINK_ANCHORS_FILE), mmap_mode="r")
+        self._link_spans = np.load(os.path.join(index_dir, LINK_SPANS_FILE), mmap_mode="r")
+
+    def __reduce__(self):
+        return (self.__class__, (self.index_dir,))
+
+    def __contains__(self, title: str) -> bool:
+        title_id = self.title_trie.get(title)
+        return title_id is not None and self._title_page_rows[title_id] != -1
+
+    def check_dump_db(self, dump_db: DumpDB):
+        if self.metadata["dump_db_uuid"] != dump_db.uuid:
+            raise RuntimeError(f"The link index in {self.index_dir} is not built from the DumpDB")
+
+    def get_paragraph_links(self, title: str) -> List[List[Tuple[int, int, int, int]]]:
+        """
+        Return the links in each paragraph of the page as tuples of the target id, the anchor text id, and the start
+        and end positions. An empty list is returned if the page is not in the index.
+        """
+        title_id = self.title_trie.get(title)
+        if title_id is None or self._title_page_rows[title_id] == -1:
+            return []
+
+        row = self._title_page_rows[title_id]
+        paragraph_start, paragraph_end = self._paragraph_indptr[row], self._paragraph_indptr[row + 1]
+        link_indptr = self._link_indptr[paragraph_start : paragraph_end + 1]
+        start, end = link_indptr[0], link_indptr[-1]
+        links = list(
+            zip(
+                self.link_targets[start:end].tolist(),
+                self.link_anchors[start:end].tolist(),
+                *self._link_spans[start:end].T.tolist(),
+            )
+        )
+        return [
+            links[link_start - start : link_end - start] for link_start, link_end in zip(link_indptr, link_indptr[1:])
+        ]
+
+    def get_wiki_links(self, title: str) -> List[List[WikiLink]]:
+        return [
+            [
+                WikiLink(self.title_trie.restore_key(target_id), self.anchor_trie.restore_key(anchor_id), start, end)
+                for target_id, anchor_id, start, end in links
+            ]
+            for links in self.get_paragraph_links(title)
+        ]
+
+    def count_links(self, titles: Iterable[str] = None) -> Counter:
+        """
+        Return the number of the links to each title. Only the links in the pages of titles are counted if specified.
+        """
+        link_targets = self.link_targets
+        if titles is not None:
+            title_ids = [self.title_trie[title] for title in titles if title in self]
+            rows = self._title_page_rows[np.array(title_ids, dtype=np.int64)]
+            starts = self._link_indptr[self._paragraph_indptr[rows]]
+            lengths = self._link_indptr[self._paragraph_indptr[rows + 1]] - starts
+            # the indices of the links in the pages are generated without iterating over the pages
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            link_targets = link_targets[offsets + np.arange(offsets.size)]
+
+        counts = np.bincount(link_targets, minlength=len(self.title_trie))
+        return Counter({self.title_trie.restore_key(int(i)): int(counts[i]) for i in np.flatnonzero(counts)})
+
+    def count_anchor_targets(self) -> List[Tuple[int, int, int]]:
+        """
+        Return the distinct pairs of the anchor text ids and the target ids of the links with their numbers of
+        occurrences.
+        """
+        keys = self.link_anchors.astype(np.int64) * len(self.title_trie) + self.link_targets
+        keys, counts = np.unique(keys, return_counts=True)
+        anchor_ids, target_ids = np.divmod(keys, len(self.title_trie))
+        return list(zip(anchor_ids.tolist(), target_ids.tolist(), counts.tolist()))
+
+    @staticmethod
+    def build(dump_db: DumpDB, out_dir: str, pool_size: int = 1, chunk_size: int = 100):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        scan_wikipedia(dump_db, [LinkIndexBuilder(out_dir, dump_db)], pool_size=pool_size, chunk_size=chunk_size)
+        return LinkIndex(out_dir)
+
+
+class LinkIndexBuilder(PageConsumer):
+    """
+    A consumer of scan_wikipedia that writes the link index of the pages to out_dir.
+    """
+
+    name = "link_index"
+    requires_text = False
+
+    def __init__(self, out_dir: str, dump_db: DumpDB):
+        self._out_dir = out_dir
+        self._dump_db_uuid = dump_db.uuid
+        self._language = dump_db.language
+        self._title_ids = {}
+        self._anchor_ids = {}
+        self._page_title_ids = array("q")
+        self._paragraph_indptr = array("q", [0])
+        self._link_indptr = array("q", [0])
+        self._link_targets = array("q")
+        self._link_anchors = array("q")
+        self._link_spans = array("q")
+
+    def process_page(self, title: str, paragraphs: List[Paragraph]) -> List[List[tuple]]:
+        return [
+            [(link.title, link.text, link.start, link.end) for link in paragraph.wiki_links] for paragraph in paragraphs
+        ]
+
+    def merge(self, title: str, result: List[List[tuple]]):
+        self._page_title_ids.append(self._title_ids.setdefault(title, len(self._title_ids)))
+        for links in result:
+            for link_title, text, start, end in links:
+                self._link_targets.append(self._title_ids.setdefault(link_title, len(self._title_ids)))
+                self._link_anchors.append(self._anchor_ids.setdefault(text, len(self._anchor_ids)))
+                self._link_spans.extend((start, end))
+            self._link_indptr.append(len(self._link_targets))
+        self._paragraph_indptr.append(len(self._link_indptr) - 1)
+
+    def finish(self) -> str:
+        title_trie = Trie(self._title_ids.keys())
+        anchor_trie = Trie(self._anchor_ids.keys())
+        title_trie.save(os.path.join(self._out_dir, TITLE_TRIE_FILE))
+        anchor_trie.save(os.path.join(self._out_dir, ANCHOR_TRIE_FILE))
+
+        # the ids assigned in the order of appearance are replaced with the ids in the tries
+        title_id_map = np.fromiter((title_trie[title] for title in self._title_ids), np.int64, len(self._title_ids))
+        anchor_id_map = np.fromiter((anchor_trie[text] for text in self._anchor_ids), np.int64, len(self._anchor_ids))
+
+        title_page_rows = np.full(len(title_trie), -1, dtype=np.int64)
+        title_page_rows[title_id_map[np.frombuffer(self._page_title_ids, dtype=np.int64)]] = np.arange(
+            len(self._page_title_ids)
+        )
+        arrays = {
+            TITLE_PAGE_ROWS_FILE: title_page_rows,
+            PARAGRAPH_INDPTR_FILE: np.frombuffer(self._paragraph_indptr, dtype=np.int64),
+            LINK_INDPTR_FILE: np.frombuffer(self._link_indptr, dtype=np.int64),
+            LINK_TARGETS_FILE: title_id_map[np.frombuffer(self._link_targets, dtype=np.int64)].astype(np.int32),
+            LINK_ANCHORS_FILE: anchor_id_map[np.frombuffer(self._link_anchors, dtype=np.int64)].astype(np.int32),
+            LINK_SPANS_FILE: np.frombuffer(self._link_spans, dtype=np.int64).reshape(-1, 2).astype(np.int32),
+        }
+        for file_name, arr in arrays.items():
+            np.save(os.path.join(self._out_dir, file_name), arr)
+
+        with open(os.path.join(self._out_dir, METADATA_FILE), "w") as f:
+            json.dump(
+                dict(
+                    dump_db_uuid=self._dump_db_uuid,
+                    language=self._language,
+                    number_of_pages=len(self._page_title_ids),
+                    number_of_paragraphs=len(self._link_indptr) - 1,
+                    number_of_links=len(self._link_targets),
+                ),
+                f,
+                indent=2,
+            )
+
+        return self._out_dir
@@ -9,20 +9,25 @@ import click
 import torch
 
 from luke.model import LukeConfig
-from .entity_vocab import EntityVocab
+from .entity_vocab import EntityVocab, is_binary_entity_vocab
 from .word_tokenizer import AutoTokenizer
 
 MODEL_FILE = "pytorch_model.bin"
 METADATA_FILE = "metadata.json"
 TSV_ENTITY_VOCAB_FILE = "entity_vocab.tsv"
 ENTITY_VOCAB_FILE = "entity_vocab.jsonl"
+BINARY_ENTITY_VOCAB_DIR = "entity_vocab"
 
 
 def get_entity_vocab_file_path(directory: str) -> str:
     default_entity_vocab_file_path = os.path.join(directory, ENTITY_VOCAB_FILE)
     tsv_entity_vocab_file_path = os.path.join(directory, TSV_ENTITY_VOCAB_FILE)
+    binary_entity_vocab_path = os.path.join(directory, BINARY_ENTITY_VOCAB_DIR)
 
-    if os.path.exists(tsv_entity_vocab_file_path):
+    # the binary vocabulary is preferred as it is loaded without parsing
+    if is_binary_entity_vocab(binary_entity_vocab_path):
+        return binary_entity_vocab_path
+    elif os.path.exists(tsv_entity_vocab_file_path):
         return tsv_entity_vocab_file_path
     elif os.path.exists(default_entity_vocab_file_path):
         return default_entity_vocab_file_path
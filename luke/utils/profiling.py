@@ -0,0 +1,154 @@
+import logging
+import os
+import signal
+from typing import Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# the modules whose forward passes are labeled in the profiles
+PROFILED_MODULES = (
+    "BertEmbeddings",
+    "RobertaEmbeddings",
+    "EntityEmbeddings",
+    "VocabParallelEmbedding",
+    "BertSelfAttention",
+    "EntityAwareSelfAttention",
+    "BertPreTrainingHeads",
+    "RobertaLMHead",
+    "EntityPredictionHead",
+    "VocabParallelEntityPredictionHead",
+)
+MODULE_LABEL_PREFIX = "module::"
+# the labels of the phases of the training steps and the optimizer steps recorded by torch.profiler
+SUMMARY_LABEL_PREFIXES = (MODULE_LABEL_PREFIX, "phase::", "Optimizer.step")
+
+PROFILE_SIGNAL = getattr(signal, "SIGUSR2", None)
+
+
+def parse_step_range(step_range: Optional[str]) -> Optional[Tuple[int, int]]:
+    """
+    Parse a step range specified as start:end. The end step is exclusive.
+    """
+    if not step_range:
+        return None
+
+    start, end = (int(s) for s in step_range.split(":"))
+    if start >= end:
+        raise ValueError(f"Invalid step range: {step_range}")
+    return start, end
+
+
+class StepProfiler(object):
+    """
+    Record torch.profiler traces of a window of training steps.
+
+    The window is either specified by profile_steps, or starts at the next step after the process receives SIGUSR2
+    if profile_on_signal is True and lasts num_signal_steps steps. The traces are recorded with the input shapes, the
+    memory usage, and the stacks. At the end of the window, a Chrome trace and a summary table of the labeled modules,
+    the phases of the training steps, and the optimizer steps are written to the profile directory in output_dir.
+    step() needs to be called with the number of completed steps before the first step and after each step.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        model: torch.nn.Module,
+        device: torch.device,
+        profile_steps: Optional[str] = None,
+        profile_on_signal: bool = False,
+        num_signal_steps: int = 10,
+        rank: Optional[int] = None,
+    ):
+        self._output_dir = os.path.join(output_dir, "profile")
+        self._model = model
+        self._device = device
+        self._profile_steps = parse_step_range(profile_steps)
+        self._num_signal_steps = num_signal_steps
+        self._file_suffix = "" if rank is None else f"_rank{rank}"
+
+        self._profiler = None
+        self._start_step = None
+        self._end_step = None
+        self._labeled_modules = []
+        self._signal_received = False
+
+        if profile_on_signal:
+            if PROFILE_SIGNAL is None:
+                raise RuntimeError("Profiling on signal is not supported on this platform")
+            signal.signal(PROFILE_SIGNAL, self._handle_signal)
+            logger.info("Send SIGUSR2 to process %d to profile %d steps", os.getpid(), num_signal_steps)
+
+    def step(self, global_step: int):
+        if self._profiler is not None and global_step >= self._end_step:
+            self._stop(global_step)
+
+        if self._profiler is None:
+            if self._profile_steps is not None and self._profile_steps[0] <= global_step < self._profile_steps[1]:
+                self._start(global_step, self._profile_steps[1])
+                self._profile_steps = None
+            elif self._signal_received:
+                self._signal_received = False
+                self._start(global_step, global_step + self._num_signal_steps)
+
+    def close(self):
+        if self._profiler is not None:
+            self._stop(self._end_step)
+
+    def _handle_signal(self, signum, frame):
+        self._signal_received = True
+
+    def _start(self, start_step: int, end_step: int):
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if self._device.type == "cuda":
+            activities.append(ProfilerActivity.CUDA)
+
+        for module in self._model.modules():
+            if module.__class__.__name__ in PROFILED_MODULES:
+                self._label_module(module)
+
+        logger.info("Start profiling steps %d to %d", start_step, end_step)
+        self._start_step = start_step
+        self._end_step = end_step
+        self._profiler = profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+        self._profiler.start()
+
+    def _stop(self, end_step: int):
+        from torch.autograd.profiler_util import EventList
+
+        self._profiler.stop()
+        for module in self._labeled_modules:
+            # the instance attribute shadows the forward method of the class
+            del module.forward
+        self._labeled_modules = []
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        name = f"step{self._start_step}-{end_step}{self._file_suffix}"
+        self._profiler.export_chrome_trace(os.path.join(self._output_dir, f"trace_{name}.json"))
+
+        key_averages = self._profiler.key_averages()
+        summary = EventList([e for e in key_averages if e.key.startswith(SUMMARY_LABEL_PREFIXES)])
+        sort_by = "cuda_time_total" if self._device.type == "cuda" else "cpu_time_total"
+        with open(os.path.join(self._output_dir, f"summary_{name}.txt"), "w") as f:
+            f.write(summary.table(sort_by=sort_by, row_limit=-1))
+            f.write("\n")
+            f.write(key_averages.table(sort_by=sort_by, row_limit=50))
+        logger.info("Saved the profile of steps %d to %d to %s", self._start_step, end_step, self._output_dir)
+
+        self._profiler = None
+
+    def _label_module(self, module: torch.nn.Module):
+        # the forward method is wrapped instead of using hooks so that the label is closed even if the forward pass
+        # raises an error such as an OOM error
+        forward = module.forward
+        label = MODULE_LABEL_PREFIX + module.__class__.__name__
+
+        def labeled_forward(*args, **kwargs):
+            with torch.autograd.profiler.record_function(label):
+                return forward(*args, **kwargs)
+
+        module.forward = labeled_forward
+        self._labeled_modules.append(module)
@@ -0,0 +1,158 @@
+import contextlib
+import json
+import logging
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+COUNTED_MASKS = (("words", "word_attention_mask"), ("entities", "entity_attention_mask"))
+
+
+class TrainingTelemetry(object):
+    """
+    Collect lightweight statistics of the training steps: the time spent in each phase of a step, the number of
+    non-padding words and entities processed per second, the depth of the batch queue, and the peak memory usage. The
+    statistics of each step are written to TensorBoard and to a JSONL file.
+
+    On CUDA devices, the phases running on the device are timed using CUDA events that are read only when the step
+    finishes, so the instrumentation does not add synchronization points to the training loop. The other phases, such
+    as waiting for the next batch, are timed using the wall clock. The peak memory is the peak allocated device memory
+    during the step on CUDA devices, and the peak resident set size of the process on CPU.
+    """
+
+    def __init__(
+        self, device: torch.device, log_file: Optional[str] = None, summary_writer=None, enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self._use_cuda_events = device.type == "cuda"
+        self._device = device
+        self._summary_writer = summary_writer
+        self._log_file = None
+        if enabled and log_file is not None:
+            self._log_file = open(log_file, "a")
+
+        self._host_times = {}
+        self._events = []
+        self._counts = {}
+        self._step_start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, on_device: bool = True):
+        """
+        Measure the time spent in the block. If on_device is True, the time is measured on the current CUDA stream.
+        The block is also labeled in the traces recorded by torch.profiler, even if the telemetry is disabled.
+        """
+        if not self.enabled:
+            with torch.autograd.profiler.record_function("phase::" + name):
+                yield
+            return
+
+        with torch.autograd.profiler.record_function("phase::" + name), self._measure(name, on_device):
+            yield
+
+    @contextlib.contextmanager
+    def _measure(self, name: str, on_device: bool):
+        if on_device and self._use_cuda_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+            try:
+                yield
+            finally:
+                end_event = torch.cuda.Event(enable_timing=True)
+                end_event.record()
+                self._events.append((name, start_event, end_event))
+        else:
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._host_times[name] = self._host_times.get(name, 0.0) + time.perf_counter() - start_time
+
+    def iterate(self, iterable: Iterable) -> Iterator:
+        """
+        Iterate over the iterable recording the time spent waiting for each item as the data_wait phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase("data_wait", on_device=False):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_batch(self, batch: Dict[str, torch.Tensor]):
+        """
+        Count the non-padding words and entities in the batch. The counts stay on the device until the step finishes.
+        """
+        if not self.enabled:
+            return
+        for name, mask_name in COUNTED_MASKS:
+            if mask_name in batch:
+                count = batch[mask_name].sum()
+                if name in self._counts:
+                    count = count + self._counts[name]
+                self._counts[name] = count
+
+    def end_step(self, step: int, queue_size: Optional[int] = None) -> Dict[str, float]:
+        if not self.enabled:
+            return {}
+
+        current_time = time.perf_counter()
+        step_time = current_time - self._step_start_time
+        self._step_start_time = current_time
+
+        summary = dict(step_time=step_time)
+        for name, value in self._host_times.items():
+            summary[name + "_time"] = value
+        for name, start_event, end_event in self._events:
+            # the events have usually already completed as the statistics of the step have been read back
+            end_event.synchronize()
+            key = name + "_time"
+            summary[key] = summary.get(key, 0.0) + start_event.elapsed_time(end_event) / 1000.0
+
+        if self._counts:
+            names = list(self._counts.keys())
+            counts = torch.stack([self._counts[name].to(torch.float64) for name in names]).tolist()
+            for name, count in zip(names, counts):
+                summary[name + "_per_sec"] = count / step_time
+
+        if queue_size is not None:
+            summary["queue_size"] = queue_size
+        summary["peak_memory_mb"] = self._get_peak_memory() / 2 ** 20
+
+        self._host_times = {}
+        self._events = []
+        self._counts = {}
+
+        if self._summary_writer is not None:
+            for name, value in summary.items():
+                self._summary_writer.add_scalar("telemetry/" + name, value, step)
+        if self._log_file is not None:
+            self._log_file.write(json.dumps(dict(step=step, time=time.time(), **summary)) + "\n")
+            self._log_file.flush()
+
+        return summary
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def _get_peak_memory(self) -> int:
+        if self._device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(self._device)
+            torch.cuda.reset_peak_memory_stats(self._device)
+            return peak_memory
+        if resource is not None:
+            # ru_maxrss is reported in kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return 0
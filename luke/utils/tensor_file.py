@@ -0,0 +1,139 @@
+import json
+import struct
+from typing import Any, BinaryIO, Dict, Union
+
+import numpy as np
+import torch
+
+TENSOR_FILE_EXTENSION = ".safetensors"
+
+# the data types of the safetensors format and the NumPy types used to map them into memory
+_DTYPES = {
+    torch.float64: ("F64", np.float64),
+    torch.float32: ("F32", np.float32),
+    torch.float16: ("F16", np.float16),
+    torch.bfloat16: ("BF16", np.int16),
+    torch.int64: ("I64", np.int64),
+    torch.int32: ("I32", np.int32),
+    torch.int16: ("I16", np.int16),
+    torch.int8: ("I8", np.int8),
+    torch.uint8: ("U8", np.uint8),
+    torch.bool: ("BOOL", np.bool_),
+}
+_TORCH_DTYPES = {name: dtype for dtype, (name, _) in _DTYPES.items()}
+
+_STATE_METADATA_KEY = "luke_state"
+
+
+def is_tensor_file(path: str) -> bool:
+    return path.endswith(TENSOR_FILE_EXTENSION)
+
+
+def save_tensor_file(state: Any, file: Union[str, BinaryIO]):
+    """
+    Save the state in the safetensors format. The state may be a flat state dict of a model, or any nested structure
+    of dicts, lists and tuples containing tensors and JSON-serializable values such as the state dict of an optimizer.
+    The tensors are stored as separate entries named after their position in the structure, and the structure itself
+    is stored as JSON in the metadata of the file.
+    """
+    tensors = {}
+    structure = _flatten(state, "", tensors)
+
+    # ordering the tensors by the size of their data types keeps all tensors aligned in the file
+    names = sorted(tensors.keys(), key=lambda name: (-tensors[name].element_size(), name))
+    header = {"__metadata__": {"format": "pt", _STATE_METADATA_KEY: json.dumps(structure)}}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = dict(
+            dtype=_DTYPES[tensor.dtype][0], shape=list(tensor.shape), data_offsets=[offset, offset + num_bytes]
+        )
+        offset += num_bytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    if isinstance(file, str):
+        with open(file, "wb") as f:
+            _write(f, header_bytes, [tensors[name] for name in names])
+    else:
+        _write(file, header_bytes, [tensors[name] for name in names])
+
+
+def load_tensor_file(path: str) -> Any:
+    """
+    Load the state saved by save_tensor_file. The tensors are lazily mapped from the file using copy-on-write memory
+    mapping, so only the data actually read is loaded into memory, and the tensors are read directly into their
+    destination when they are copied to parameters or moved to another device. Files written by other safetensors
+    implementations are loaded as flat state dicts.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size).decode("utf-8"))
+
+    metadata = header.pop("__metadata__", None) or {}
+    buffer = None
+    if any(info["data_offsets"][1] > 0 for info in header.values()):
+        buffer = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_size)
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = _TORCH_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        array = buffer[begin:end].view(_DTYPES[dtype][1]).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor
+
+    if _STATE_METADATA_KEY not in metadata:
+        return tensors
+
+    return _unflatten(json.loads(metadata[_STATE_METADATA_KEY]), tensors)
+
+
+def _write(f: BinaryIO, header_bytes: bytes, tensors):
+    f.write(struct.pack("<Q", len(header_bytes)))
+    f.write(header_bytes)
+    for tensor in tensors:
+        if tensor.numel() == 0:
+            continue
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        f.write(memoryview(tensor.numpy()).cast("B"))
+
+
+def _flatten(obj: Any, name: str, tensors: Dict[str, torch.Tensor]) -> Any:
+    if isinstance(obj, torch.Tensor):
+        if name in tensors:
+            raise ValueError(f"Duplicate tensor name: {name}")
+        tensors[name] = obj
+        return {"__tensor__": name}
+    if isinstance(obj, dict):
+        # dict keys are stored as pairs because the optimizer states are indexed by integers
+        items = []
+        for key, value in obj.items():
+            items.append([key, _flatten(value, f"{name}.{key}" if name else str(key), tensors)])
+        return {"__dict__": items}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [_flatten(value, f"{name}.{i}", tensors) for i, value in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [_flatten(value, f"{name}.{i}", tensors) for i, value in enumerate(obj)]
+    return obj
+
+
+def _unflatten(obj: Any, tensors: Dict[str, torch.Tensor]) -> Any:
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return tensors[obj["__tensor__"]]
+        if "__tuple__" in obj:
+            return tuple(_unflatten(value, tensors) for value in obj["__tuple__"])
+        return {key: _unflatten(value, tensors) for key, value in obj["__dict__"]}
+    if isinstance(obj, list):
+        return [_unflatten(value, tensors) for value in obj]
+    return obj
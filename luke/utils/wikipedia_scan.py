@@ -0,0 +1,224 @@
+import hashlib
+import logging
+from collections import Counter
+from contextlib import closing
+from multiprocessing.pool import Pool
+from typing import Any, Dict, FrozenSet, Iterable, List, Tuple
+
+from tqdm import tqdm
+from wikipedia2vec.dump_db import DumpDB, Paragraph, WikiLink
+
+logger = logging.getLogger(__name__)
+
+# global variables used in pool workers
+_dump_db = _consumers = _link_index = _with_text = None
+
+
+class PageConsumer(object):
+    """
+    A consumer of the pages scanned by scan_wikipedia. process_page is called in the pool workers for each page with its
+    paragraphs whose links are resolved, and merge is called in the main process with the results of process_page in
+    the order of the titles. The consumers listed in requires are finished before the pages are passed to this
+    consumer, and their results are passed to prepare. If requires_text is False, the consumer only uses the links of
+    the paragraphs, and the pages are not read from the DumpDB when a link index is available.
+
+    The pages are processed in chunks. start_chunk is called in the pool worker with the titles of a chunk before its
+    pages are processed, and finish_chunk is called with the results of process_page for the pages in the chunk. The
+    result of finish_chunk is passed to merge_chunk in the main process, which passes the results of the pages to merge
+    by default. A consumer overrides these methods to process the results of a chunk in the pool workers.
+    """
+
+    name = None
+    requires = ()
+    requires_text = True
+
+    def prepare(self, results: Dict[str, Any]):
+        pass
+
+    def initialize_worker(self, dump_db: DumpDB):
+        pass
+
+    def process_page(self, title: str, paragraphs: List[Paragraph]) -> Any:
+        raise NotImplementedError()
+
+    def merge(self, title: str, result: Any):
+        raise NotImplementedError()
+
+    def start_chunk(self, chunk_index: int, titles: List[str]):
+        pass
+
+    def finish_chunk(self, chunk_index: int, results: List[Tuple[str, Any]]) -> Any:
+        return results
+
+    def merge_chunk(self, chunk_index: int, result: Any):
+        for title, page_result in result:
+            self.merge(title, page_result)
+
+    def finish(self) -> Any:
+        return None
+
+
+class LinkCounter(PageConsumer):
+    """
+    Count the resolved targets of the links in the pages.
+    """
+
+    name = "link_counts"
+    requires_text = False
+
+    def __init__(self, target_titles: FrozenSet[str] = None):
+        self._target_titles = target_titles
+        self._counter = Counter()
+
+    def process_page(self, title: str, paragraphs: List[Paragraph]) -> Counter:
+        counter = Counter()
+        for paragraph in paragraphs:
+            for wiki_link in paragraph.wiki_links:
+                if self._target_titles is None or wiki_link.title in self._target_titles:
+                    counter[wiki_link.title] += 1
+        return counter
+
+    def merge(self, title: str, result: Counter):
+        self._counter.update(result)
+
+    def finish(self) -> Counter:
+        return self._counter
+
+
+def scan_page(dump_db: DumpDB, title: str, link_index=None, with_text: bool = True) -> List[Paragraph]:
+    """
+    Return the paragraphs of the page whose links point to the titles resolved through the redirects. If link_index is
+    specified, the links are read from the index, and the texts of the paragraphs are empty unless with_text is True.
+    """
+    if link_index is not None:
+        paragraph_links = link_index.get_wiki_links(title)
+        if not with_text:
+            return [Paragraph("", wiki_links, False) for wiki_links in paragraph_links]
+        return [
+            Paragraph(paragraph.text, wiki_links, paragraph.abstract)
+            for paragraph, wiki_links in zip(dump_db.get_paragraphs(title), paragraph_links)
+        ]
+
+    paragraphs = []
+    for paragraph in dump_db.get_paragraphs(title):
+        wiki_links = [
+            WikiLink(dump_db.resolve_redirect(wiki_link.title), wiki_link.text, wiki_link.start, wiki_link.end)
+            for wiki_link in paragraph.wiki_links
+        ]
+        paragraphs.append(Paragraph(paragraph.text, wiki_links, paragraph.abstract))
+    return paragraphs
+
+
+def partition_titles(titles: Iterable[str], num_shards: int, shard_index: int) -> List[str]:
+    """
+    Return the titles in the shard_index-th of num_shards partitions. The titles are partitioned by their hashes, which
+    are the same on every machine, so that the builds of the partitions can be distributed across machines.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard index {shard_index} for {num_shards} shards")
+    if num_shards == 1:
+        return list(titles)
+    return [
+        title
+        for title in titles
+        if int.from_bytes(hashlib.md5(title.encode("utf-8")).digest()[:8], "little") % num_shards == shard_index
+    ]
+
+
+def scan_wikipedia(
+    dump_db: DumpDB,
+    consumers: List[PageConsumer],
+    titles: Iterable[str] = None,
+    pool_size: int = 1,
+    chunk_size: int = 100,
+    link_index=None,
+    results: Dict[str, Any] = None,
+) -> Dict[str, Any]:
+    """
+    Pass the pages of the dump to the consumers and return the results of the consumers keyed by their names. Each page
+    is read and its links are resolved once for all the consumers. The consumers are scheduled in the smallest number
+    of passes over the pages such that each consumer runs after the ones it requires. The results of the consumers
+    that are already available can be specified by results. If link_index is specified, the links are read from the
+    LinkIndex of the dump instead of resolving them.
+    """
+    if titles is None:
+        titles = list(dump_db.titles())
+    else:
+        titles = list(titles)
+    if link_index is not None:
+        link_index.check_dump_db(dump_db)
+
+    results = dict(results or {})
+    for (n, pass_consumers) in enumerate(_schedule_consumers(consumers, results.keys())):
+        logger.info("Pass %d: %s", n + 1, ", ".join(consumer.name for consumer in pass_consumers))
+        for consumer in pass_consumers:
+            consumer.prepare(results)
+
+        chunks = [titles[i : i + chunk_size] for i in range(0, len(titles), chunk_size)]
+        with tqdm(total=len(titles), mininterval=0.5) as pbar:
+            initargs = (dump_db, pass_consumers, link_index)
+            with closing(Pool(pool_size, initializer=_initialize_worker, initargs=initargs)) as pool:
+                for (chunk_index, chunk_results) in enumerate(pool.imap(_process_pages, enumerate(chunks))):
+                    for consumer, result in zip(pass_consumers, chunk_results):
+                        consumer.merge_chunk(chunk_index, result)
+                    pbar.update(len(chunks[chunk_index]))
+
+        for consumer in pass_consumers:
+            results[consumer.name] = consumer.finish()
+
+    return results
+
+
+def _schedule_consumers(consumers: List[PageConsumer], available: Iterable[str] = ()) -> List[List[PageConsumer]]:
+    consumer_names = [consumer.name for consumer in consumers]
+    if len(set(consumer_names)) != len(consumer_names):
+        raise ValueError(f"The names of the consumers are not unique: {consumer_names}")
+
+    levels = {name: -1 for name in available}
+    consumer_names += list(levels.keys())
+    remaining = list(consumers)
+    while remaining:
+        scheduled = []
+        for consumer in remaining:
+            for name in consumer.requires:
+                if name not in consumer_names:
+                    raise ValueError(f"{consumer.name} requires an unknown consumer: {name}")
+            if all(name in levels for name in consumer.requires):
+                scheduled.append(consumer)
+        if not scheduled:
+            raise ValueError("The consumers have circular requirements")
+
+        for consumer in scheduled:
+            levels[consumer.name] = 1 + max([levels[name] for name in consumer.requires], default=-1)
+            remaining.remove(consumer)
+
+    passes = [[] for _ in range(max([levels[consumer.name] for consumer in consumers], default=-1) + 1)]
+    for consumer in consumers:
+        passes[levels[consumer.name]].append(consumer)
+    return passes
+
+
+def _initialize_worker(dump_db: DumpDB, consumers: List[PageConsumer], link_index):
+    global _dump_db, _consumers, _link_index, _with_text
+    _dump_db = dump_db
+    _consumers = consumers
+    _link_index = link_index
+    _with_text = any(consumer.requires_text for consumer in consumers)
+    for consumer in consumers:
+        consumer.initialize_worker(dump_db)
+
+
+def _process_pages(args: Tuple[int, List[str]]) -> list:
+    chunk_index, titles = args
+    for consumer in _consumers:
+        consumer.start_chunk(chunk_index, titles)
+
+    results = [[] for _ in _consumers]
+    for title in titles:
+        paragraphs = scan_page(_dump_db, title, _link_index, _with_text)
+        for consumer, consumer_results in zip(_consumers, results):
+            consumer_results.append((title, consumer.process_page(title, paragraphs)))
+
+    return [
+        consumer.finish_chunk(chunk_index, consumer_results) for consumer, consumer_results in zip(_consumers, results)
+    ]
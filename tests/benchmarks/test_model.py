@@ -0,0 +1,98 @@
+import json
+import os
+
+import torch
+from click.testing import CliRunner
+
+from luke.benchmarks.model import benchmark_model, compare_with_baseline, create_inputs, measure_peak_memory
+
+
+def test_create_inputs():
+    inputs = create_inputs(2, 16, 8, 4)
+    assert inputs["word_ids"].size() == (2, 16)
+    assert inputs["entity_position_ids"].size() == (2, 8, 4)
+
+    # each mention consists of consecutive words followed by padding
+    for position_ids in inputs["entity_position_ids"].view(-1, 4).tolist():
+        positions = [p for p in position_ids if p != -1]
+        assert positions
+        assert position_ids[: len(positions)] == list(range(positions[0], positions[0] + len(positions)))
+        assert positions[-1] < 16
+
+    assert torch.equal(inputs["entity_ids"], create_inputs(2, 16, 8, 4)["entity_ids"])
+
+
+def test_measure_peak_memory():
+    def func():
+        x = torch.ones(1024, 1024)
+        y = x * 2
+        return y.sum()
+
+    assert measure_peak_memory(func) >= 2 * 1024 * 1024 * 4
+
+
+def test_benchmark_model(tmpdir):
+    output_file = os.path.join(str(tmpdir), "results.json")
+    args = [
+        output_file,
+        "--word-lengths",
+        "8,16",
+        "--entity-lengths",
+        "2",
+        "--max-mention-lengths",
+        "2",
+        "--batch-sizes",
+        "1",
+        "--hidden-size",
+        "16",
+        "--num-attention-heads",
+        "2",
+        "--num-iterations",
+        "2",
+        "--num-warmup-iterations",
+        "1",
+    ]
+    result = CliRunner().invoke(benchmark_model, args + ["--mode", "train"])
+    assert result.exit_code == 0, result.output
+
+    with open(output_file) as f:
+        results = json.load(f)
+    assert [(r["model"], r["word_length"]) for r in results["results"]] == [
+        ("luke", 8),
+        ("luke", 16),
+        ("entity_aware_attention", 8),
+        ("entity_aware_attention", 16),
+        ("entity_embeddings", None),
+    ]
+    for record in results["results"]:
+        assert record["latency_seconds"]["p50"] > 0
+        assert record["sequences_per_sec"] > 0
+        assert record["peak_memory_mb"] > 0
+
+    baseline_file = os.path.join(str(tmpdir), "baseline.json")
+    os.rename(output_file, baseline_file)
+    result = CliRunner().invoke(benchmark_model, args + ["--mode", "train", "--baseline-file", baseline_file])
+    assert result.exit_code == 0, result.output
+    with open(output_file) as f:
+        assert all("p50_change" in record for record in json.load(f)["results"])
+
+
+def test_compare_with_baseline():
+    def create_results(mode, p50):
+        record = dict(
+            model="luke",
+            batch_size=1,
+            word_length=8,
+            entity_length=2,
+            max_mention_length=2,
+            latency_seconds=dict(p50=p50),
+        )
+        return dict(config=dict(mode=mode), results=[record])
+
+    results = create_results("inference", 1.5)
+    compare_with_baseline(results, create_results("inference", 1.0))
+    assert results["results"][0]["p50_change"] == 0.5
+
+    results = create_results("inference", 1.5)
+    compare_with_baseline(results, create_results("train", 1.0))
+    assert "p50_change" not in results["results"][0]
@@ -0,0 +1,50 @@
+import json
+import os
+
+from click.testing import CliRunner
+
+from luke.benchmarks.pipeline import benchmark_pipeline
+from luke.benchmarks.synthetic import SyntheticDumpReader
+
+
+def test_synthetic_dump_reader():
+    pages = list(SyntheticDumpReader(20, seed=1))
+    assert len(pages) == 22
+    assert [p.wiki_text for p in pages] == [p.wiki_text for p in SyntheticDumpReader(20, seed=1)]
+    assert sum(p.is_redirect for p in pages) == 2
+    assert any("[[Topic" in p.wiki_text for p in pages)
+
+
+def test_benchmark_pipeline(tmpdir):
+    output_file = os.path.join(str(tmpdir), "results.json")
+    result = CliRunner().invoke(
+        benchmark_pipeline,
+        [
+            output_file,
+            "--work-dir",
+            os.path.join(str(tmpdir), "work"),
+            "--num-pages",
+            "20",
+            "--max-seq-length",
+            "32",
+            "--num-records",
+            "20",
+            "--num-batches",
+            "3",
+            "--num-steps",
+            "2",
+            "--num-warmup-steps",
+            "1",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(output_file) as f:
+        results = json.load(f)
+    assert results["config"]["num_pages"] == 20
+    assert "torch_version" in results["environment"]
+    assert results["results"]["dataset_build"]["pages_per_sec"] > 0
+    assert results["results"]["dataset_build"]["items"] > 0
+    assert results["results"]["create_iterator"]["records_per_sec"] > 0
+    assert results["results"]["batch_worker"]["batches_per_sec"] > 0
+    assert results["results"]["train_step"]["step_seconds"]["p50"] > 0
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+import tensorflow as tf
+from transformers import BertTokenizer
+from wikipedia2vec.dump_db import DumpDB
+from wikipedia2vec.utils.wiki_page import WikiPage
+
+# datasets are read using the graph mode of TensorFlow 1.x
+tf.compat.v1.disable_eager_execution()
+
+SYNTHETIC_PAGES = {
+    "Spain": "Spain is a country in [[Europe]]. Its capital is [[Madrid]]. The country borders [[France]] and "
+    "[[Portugal]].\n\nSpain is a member of the [[European Union]]. The official language is [[Spanish language|"
+    "Spanish]].",
+    "France": "France is a country in [[Europe]]. Its capital is [[Paris]]. The country borders [[Spain]] and "
+    "[[Germany]].\n\nFrance is a founding member of the [[European Union|EU]].",
+    "Germany": "Germany is a country in [[Europe]]. Its capital is [[Berlin]]. The country borders [[France]].",
+    "Portugal": "Portugal is a country in [[Europe]]. Its capital is [[Lisbon]]. The country borders [[Spain]].",
+    "Madrid": "Madrid is the capital of [[Spain]]. It is the largest city of [[Kingdom of Spain|the country]].",
+    "Paris": "Paris is the capital of [[France]]. It is located on the [[Seine]].",
+    "Berlin": "Berlin is the capital of [[Germany]]. It is the largest city of the country.",
+    "Lisbon": "Lisbon is the capital of [[Portugal]]. It is located on the [[Tagus]].",
+    "Europe": "Europe is a continent. It includes [[Spain]], [[France]], [[Germany]] and [[Portugal]].",
+    "European Union": "The European Union is a union of countries in [[Europe]]. It includes [[France]] and "
+    "[[Germany]].",
+    "Spanish language": "Spanish is a language spoken in [[Spain]]. It is also spoken in [[Europe]].",
+    "Category:Countries": "This is a category page of countries such as [[Spain]].",
+}
+SYNTHETIC_REDIRECTS = {"Kingdom of Spain": "Spain", "EU": "European Union"}
+
+
+class _SyntheticDumpReader(object):
+    dump_file = "synthetic-pages-articles.xml.bz2"
+    language = "en"
+
+    def __iter__(self):
+        for title, wiki_text in SYNTHETIC_PAGES.items():
+            yield WikiPage(title, self.language, wiki_text, None)
+        for title, redirect in SYNTHETIC_REDIRECTS.items():
+            yield WikiPage(title, self.language, "", redirect)
+
+
+@pytest.fixture(scope="session")
+def dump_db_file(tmp_path_factory):
+    dump_db_file = str(tmp_path_factory.mktemp("dump_db") / "synthetic.db")
+    DumpDB.build(_SyntheticDumpReader(), dump_db_file, pool_size=1, chunk_size=1)
+    return dump_db_file
+
+
+@pytest.fixture
+def dump_db(dump_db_file):
+    dump_db = DumpDB(dump_db_file)
+    yield dump_db
+    dump_db.close()
+
+
+@pytest.fixture(scope="session")
+def bert_tokenizer(tmp_path_factory):
+    words = sorted(
+        {w.strip(".,[]|").lower() for text in SYNTHETIC_PAGES.values() for w in text.replace("|", " ").split()}
+    )
+    vocab_file = str(tmp_path_factory.mktemp("tokenizer") / "vocab.txt")
+    with open(vocab_file, "w") as f:
+        for token in ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", ":"] + [w for w in words if w]:
+            f.write(token + "\n")
+    return BertTokenizer(vocab_file)
+
+
+@pytest.fixture(scope="session")
+def synthetic_entity_vocab_file(tmp_path_factory):
+    entity_vocab_file = str(tmp_path_factory.mktemp("entity_vocab") / "entity_vocab.jsonl")
+    titles = ["[PAD]", "[UNK]", "[MASK]"] + [t for t in SYNTHETIC_PAGES.keys() if not t.startswith("Category:")]
+    with open(entity_vocab_file, "w") as f:
+        for n, title in enumerate(titles):
+            json.dump({"id": n, "entities": [[title, "en"]], "count": len(titles) - n}, f)
+            f.write("\n")
+    return entity_vocab_file
@@ -0,0 +1,215 @@
+import itertools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+import torch.multiprocessing as mp
+from wikipedia2vec.dump_db import DumpDB
+
+from luke.pretraining.batch_generator import (
+    LukePretrainingBatchWorker,
+    MultilingualBatchGenerator,
+    get_scheduled_max_lengths,
+    parse_seq_length_schedule,
+    truncate_item,
+)
+from luke.pretraining.dataset import WikipediaPretrainingDataset
+from luke.utils.entity_vocab import EntityVocab
+from luke.utils.sentence_tokenizer import SentenceTokenizer
+
+
+def _build_dataset(dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, dataset_dir, entity_id_offset):
+    # the entity ids are shifted so that the dataset of each batch can be identified from its entities
+    entity_vocab_file = dataset_dir + ".jsonl"
+    with open(synthetic_entity_vocab_file) as f, open(entity_vocab_file, "w") as out_f:
+        for line in f:
+            item = json.loads(line)
+            if item["id"] >= 3:
+                item["id"] += entity_id_offset
+            json.dump(item, out_f)
+            out_f.write("\n")
+
+    dump_db = DumpDB(dump_db_file)
+    os.makedirs(dataset_dir)
+    WikipediaPretrainingDataset.build(
+        dump_db,
+        bert_tokenizer,
+        SentenceTokenizer.from_name("en"),
+        EntityVocab(entity_vocab_file),
+        dataset_dir,
+        max_seq_length=32,
+        max_entity_length=8,
+        max_mention_length=4,
+        min_sentence_length=2,
+        include_sentences_without_entities=False,
+        include_unk_entities=False,
+        pool_size=1,
+        chunk_size=1,
+        max_num_documents=None,
+    )
+    dump_db.close()
+    return dataset_dir
+
+
+def test_get_sampling_rate():
+    assert MultilingualBatchGenerator.get_sampling_rate([100, 100], 0.7) == [0.5, 0.5]
+    assert MultilingualBatchGenerator.get_sampling_rate([300, 100], 1.0) == [0.75, 0.25]
+    assert MultilingualBatchGenerator.get_sampling_rate([300, 100], 0.0) == [0.5, 0.5]
+
+
+def test_assign_datasets_to_processes():
+    assignments = MultilingualBatchGenerator.assign_datasets_to_processes([0.5, 0.2, 0.2, 0.1], 2)
+    assert sorted(assignments) == [[0], [1, 2, 3]]
+    assert MultilingualBatchGenerator.assign_datasets_to_processes([0.5, 0.5], 4) == [[0], [1]]
+
+
+def _generate_batches(dataset_dirs, queue_size, num_batches, result_queue):
+    # the settings of conftest.py and the default start method are not inherited by the spawned process
+    tf.compat.v1.disable_eager_execution()
+    multiprocessing.set_start_method("fork", force=True)
+    np.random.seed(0)
+    batch_generator = MultilingualBatchGenerator(
+        dataset_dirs,
+        [600, 300, 100],
+        sampling_smoothing_factor=1.0,
+        batch_size=1,
+        masked_lm_prob=0.15,
+        masked_entity_prob=0.0,
+        whole_word_masking=False,
+        unmasked_word_prob=0.1,
+        random_word_prob=0.1,
+        unmasked_entity_prob=0.0,
+        random_entity_prob=0.0,
+        mask_words_in_entity_span=False,
+        seq_length_schedule=[[8, 5, -1]],
+        start_step=5,
+        batches_per_step=4,
+        num_processes=2,
+        shuffle_buffer_size=1,
+    )
+    batches = itertools.islice(batch_generator.generate_batches(queue_size=queue_size), num_batches)
+    result_queue.put(
+        (
+            batch_generator.sampling_rate,
+            [(batch["word_ids"].shape[1], int(batch["entity_ids"].max())) for batch in batches],
+        )
+    )
+
+
+def test_generate_batches(dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    dataset_dirs = [
+        _build_dataset(
+            dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / f"dataset{i}"), i * 100
+        )
+        for i in range(3)
+    ]
+
+    # the generator is run in a fresh process because its workers are forked and read the datasets using TensorFlow,
+    # which hangs in forked processes once sessions have been run in the parent by the other tests
+    queue_size = 4
+    context = mp.get_context("spawn")
+    result_queue = context.SimpleQueue()
+    process = context.Process(target=_generate_batches, args=(dataset_dirs, queue_size, 1000, result_queue))
+    process.start()
+    sampling_rate, batches = result_queue.get()
+    process.join()
+    assert sampling_rate == [0.6, 0.3, 0.1]
+
+    # the n-th batch is requested at most queue_size + n - 1 batches after the start, and the steps are estimated from
+    # the numbers of the preceding requests, so the batches requested before step 8 are truncated by the schedule
+    num_truncated_batches = (8 - 5) * 4 - queue_size + 1
+    assert all(seq_length <= 5 for seq_length, _ in batches[:num_truncated_batches])
+    assert max(seq_length for seq_length, _ in batches) > 5
+
+    dataset_indices = [
+        max_entity_id // 100 for _, max_entity_id in batches[num_truncated_batches:] if max_entity_id >= 3
+    ]
+    frequencies = np.bincount(dataset_indices, minlength=3) / len(dataset_indices)
+    assert np.allclose(frequencies, sampling_rate, atol=0.05)
+
+
+def test_parse_seq_length_schedule():
+    assert parse_seq_length_schedule("0.1:128:32,0.5:256", 1000) == [[100, 128, 32], [500, 256, -1]]
+    with pytest.raises(ValueError):
+        parse_seq_length_schedule("0.5:128,0.1:256", 1000)
+    with pytest.raises(ValueError):
+        parse_seq_length_schedule("0.5", 1000)
+
+
+def test_get_scheduled_max_lengths():
+    schedule = [[100, 128, 32], [500, 256, -1]]
+    assert get_scheduled_max_lengths(schedule, 0, 512, 128) == (128, 32)
+    assert get_scheduled_max_lengths(schedule, 100, 512, 128) == (256, 128)
+    assert get_scheduled_max_lengths(schedule, 500, 512, 128) == (512, 128)
+    assert get_scheduled_max_lengths(schedule, 0, 64, 16) == (64, 16)
+
+
+def test_truncate_item():
+    item = dict(
+        word_ids=np.arange(10),
+        entity_ids=np.array([1, 2, 3, 4]),
+        entity_position_ids=np.array([[0, 1], [4, -1], [5, 6], [7, -1]]),
+        page_id=1,
+    )
+    ret = truncate_item(item, 8, 10)
+    assert ret["word_ids"].tolist() == list(range(6))
+    # the third entity is removed because its mention does not fit in the truncated words
+    assert ret["entity_ids"].tolist() == [1, 2]
+    assert ret["entity_position_ids"].tolist() == [[0, 1], [4, -1]]
+
+    ret = truncate_item(item, 12, 1)
+    assert ret["word_ids"].size == 10
+    assert ret["entity_ids"].tolist() == [1]
+
+    assert truncate_item(item, 12, 4) is item
+
+
+def test_batch_worker_with_seq_length_schedule(dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    dump_db = DumpDB(dump_db_file)
+    dataset_dir = str(tmp_path / "dataset")
+    os.makedirs(dataset_dir)
+    WikipediaPretrainingDataset.build(
+        dump_db,
+        bert_tokenizer,
+        SentenceTokenizer.from_name("en"),
+        EntityVocab(synthetic_entity_vocab_file),
+        dataset_dir,
+        max_seq_length=32,
+        max_entity_length=8,
+        max_mention_length=4,
+        min_sentence_length=2,
+        include_sentences_without_entities=True,
+        include_unk_entities=False,
+        pool_size=1,
+        chunk_size=1,
+        max_num_documents=None,
+    )
+    dump_db.close()
+
+    worker = LukePretrainingBatchWorker(
+        None,
+        dataset_dir,
+        batch_size=1,
+        masked_lm_prob=0.15,
+        masked_entity_prob=0.15,
+        whole_word_masking=False,
+        unmasked_word_prob=0.1,
+        random_word_prob=0.1,
+        unmasked_entity_prob=0.0,
+        random_entity_prob=0.0,
+        mask_words_in_entity_span=False,
+        seq_length_schedule=[[2, 6, 1]],
+        start_step=1,
+        shuffle_buffer_size=1,
+    )
+    max_lengths = []
+    for batch in itertools.islice(worker.generate_batches(), 5):
+        max_lengths.append((batch["word_ids"].shape[1], batch["entity_ids"].shape[1]))
+        worker.current_step += 1
+
+    assert max_lengths[0][0] <= 6
+    assert max_lengths[0][1] <= 1
+    assert max(length for length, _ in max_lengths[1:]) > 6
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+import pytest
+import torch
+from click.testing import CliRunner
+
+from luke.optimization import LukeAdamW, merge_optimizer_state_dicts
+from luke.pretraining.checkpoint import (
+    CheckpointWriter,
+    convert_checkpoint,
+    copy_to_host,
+    load_checkpoint_file,
+    load_checkpoint_metadata,
+)
+
+
+def _save(writer, global_step, suffix):
+    states = {f"model_{suffix}.bin": dict(weight=torch.full((2,), float(global_step)))}
+    metadata = dict(global_step=global_step, model_file=f"model_{suffix}.bin")
+    writer.save(states, metadata_file=f"metadata_{suffix}.json", metadata=metadata)
+
+
+def test_copy_to_host():
+    state_dict = torch.nn.Linear(2, 2).state_dict()
+    state = dict(model=state_dict, steps=[torch.tensor(1.0), 3])
+    copied_state = copy_to_host(state)
+    state_dict["weight"].add_(1.0)
+
+    assert not torch.equal(copied_state["model"]["weight"], state_dict["weight"])
+    assert copied_state["model"]._metadata == state_dict._metadata
+    assert copied_state["steps"][1] == 3
+
+
+def test_checkpoint_writer_retains_last_checkpoints(tmpdir):
+    output_dir = str(tmpdir)
+    writer = CheckpointWriter(output_dir, keep_last_checkpoints=2)
+    for global_step in range(1, 6):
+        _save(writer, global_step, f"step{global_step}")
+        if global_step == 2:
+            _save(writer, global_step, "epoch1")
+    writer.close()
+
+    assert sorted(m["metadata_file"] for m in load_checkpoint_metadata(output_dir)) == [
+        "metadata_epoch1.json",
+        "metadata_step4.json",
+        "metadata_step5.json",
+    ]
+    assert sorted(f for f in os.listdir(output_dir) if f.startswith("model_")) == [
+        "model_epoch1.bin",
+        "model_step4.bin",
+        "model_step5.bin",
+    ]
+    assert load_checkpoint_metadata(output_dir)[-1]["global_step"] == 5
+    assert torch.load(os.path.join(output_dir, "model_step5.bin"))["weight"].tolist() == [5.0, 5.0]
+
+
+def test_checkpoint_writer_waits_for_other_ranks(tmpdir):
+    output_dir = str(tmpdir)
+    writer = CheckpointWriter(output_dir, poll_interval=0.01)
+    writer.save(
+        {"optimizer_0.bin": {}}, metadata_file="metadata_step1.json", metadata={}, wait_for_files=["optimizer_1.bin"]
+    )
+    time.sleep(0.1)
+    assert not os.path.exists(os.path.join(output_dir, "metadata_step1.json"))
+
+    CheckpointWriter(output_dir).save({"optimizer_1.bin": {}})
+    writer.close()
+    with open(os.path.join(output_dir, "metadata_step1.json")) as f:
+        assert json.load(f) == {}
+    assert not [f for f in os.listdir(output_dir) if f.endswith(".tmp")]
+
+
+def test_checkpoint_writer_raises_error(tmpdir):
+    writer = CheckpointWriter(os.path.join(str(tmpdir), "missing"))
+    writer.save({"model.bin": {}})
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+def test_checkpoint_writer_times_out(tmpdir):
+    output_dir = str(tmpdir)
+    writer = CheckpointWriter(output_dir, poll_interval=0.01, wait_timeout=0.05)
+    writer.save(
+        {"optimizer_0.bin": {}}, metadata_file="metadata_step1.json", metadata={}, wait_for_files=["optimizer_1.bin"]
+    )
+    with pytest.raises(RuntimeError) as excinfo:
+        writer.save({"optimizer_0.bin": {}})
+    assert isinstance(excinfo.value.__cause__, TimeoutError)
+    assert not os.path.exists(os.path.join(output_dir, "metadata_step1.json"))
+    writer.close()
+
+
+def test_convert_checkpoint(tmpdir):
+    output_dir = str(tmpdir)
+    with open(os.path.join(output_dir, "metadata.json"), "w") as f:
+        json.dump(dict(arguments=dict(vocab_parallel_entities=False)), f)
+
+    model = torch.nn.Linear(3, 2)
+    optimizer = LukeAdamW(model.parameters(), lr=0.1)
+    model(torch.randn(4, 3)).sum().backward()
+    optimizer.step()
+    torch.save(model.state_dict(), os.path.join(output_dir, "model_step1.bin"))
+    torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer_step1.bin"))
+    metadata = dict(global_step=1, model_file="model_step1.bin", optimizer_file="optimizer_step1.bin")
+    with open(os.path.join(output_dir, "metadata_step1.json"), "w") as f:
+        json.dump(metadata, f)
+
+    result = CliRunner().invoke(
+        convert_checkpoint, [output_dir, "--num-optimizer-shards", "2", "--remove-source-files"], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+
+    metadata = load_checkpoint_metadata(output_dir)[0]
+    assert metadata["model_file"] == "model_step1.safetensors"
+    assert metadata["optimizer_files"] == [
+        "optimizer_step1_00000-of-00002.safetensors",
+        "optimizer_step1_00001-of-00002.safetensors",
+    ]
+    assert not os.path.exists(os.path.join(output_dir, "model_step1.bin"))
+
+    new_model = torch.nn.Linear(3, 2)
+    new_model.load_state_dict(load_checkpoint_file(os.path.join(output_dir, metadata["model_file"])))
+    assert torch.equal(new_model.weight, model.weight)
+
+    new_optimizer = LukeAdamW(new_model.parameters(), lr=0.1)
+    new_optimizer.load_state_dict(
+        merge_optimizer_state_dicts(
+            [load_checkpoint_file(os.path.join(output_dir, f)) for f in metadata["optimizer_files"]]
+        )
+    )
+    assert torch.equal(new_optimizer.state[new_model.bias]["exp_avg"], optimizer.state[model.bias]["exp_avg"])
+    assert new_optimizer.param_groups[0]["betas"] == optimizer.param_groups[0]["betas"]
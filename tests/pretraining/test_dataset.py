@@ -0,0 +1,275 @@
+import filecmp
+import itertools
+import json
+import os
+
+import pytest
+from wikipedia2vec.dump_db import DumpDB
+from wikipedia2vec.utils.wiki_page import WikiPage
+
+from luke.pretraining.dataset import MANIFEST_FILE, ONLINE_CACHE_DIR, WikipediaPretrainingDataset
+from luke.utils.entity_vocab import EntityVocab
+from luke.utils.sentence_tokenizer import SentenceTokenizer
+from tests.conftest import SYNTHETIC_PAGES, SYNTHETIC_REDIRECTS
+
+BUILD_KWARGS = dict(
+    max_seq_length=32,
+    max_entity_length=8,
+    max_mention_length=4,
+    min_sentence_length=2,
+    include_sentences_without_entities=False,
+    include_unk_entities=False,
+    pool_size=2,
+    chunk_size=1,
+    max_num_documents=None,
+)
+
+
+def _to_hashable(item):
+    return (
+        int(item["page_id"]),
+        tuple(item["word_ids"].tolist()),
+        tuple(item["entity_ids"].tolist()),
+        tuple(map(tuple, item["entity_position_ids"].tolist())),
+    )
+
+
+class _DumpReader(object):
+    dump_file = "modified-pages-articles.xml.bz2"
+    language = "en"
+
+    def __init__(self, pages):
+        self._pages = pages
+
+    def __iter__(self):
+        for title, wiki_text in self._pages.items():
+            yield WikiPage(title, self.language, wiki_text, None)
+        for title, redirect in SYNTHETIC_REDIRECTS.items():
+            yield WikiPage(title, self.language, "", redirect)
+
+
+def _build_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, output_dir, **kwargs):
+    os.makedirs(output_dir, exist_ok=True)
+    WikipediaPretrainingDataset.build(
+        dump_db,
+        bert_tokenizer,
+        SentenceTokenizer.from_name("en"),
+        EntityVocab(synthetic_entity_vocab_file),
+        output_dir,
+        **dict(BUILD_KWARGS, **kwargs),
+    )
+    return WikipediaPretrainingDataset(output_dir)
+
+
+def _read_items(dataset):
+    return sorted(
+        _to_hashable(item) for item in itertools.islice(dataset.create_iterator(shuffle_buffer_size=1), len(dataset))
+    )
+
+
+@pytest.fixture
+def dataset(dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    dump_db = DumpDB(dump_db_file)
+    dataset = _build_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / "dataset"))
+    dump_db.close()
+    return dataset
+
+
+def test_build_shards(dataset, dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    sharded_dataset = _build_dataset(
+        dump_db, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / "sharded_dataset"), shard_size=3
+    )
+    # the 11 pages excluding the category page are split into 4 shards
+    assert sharded_dataset.metadata["dataset_files"] == ["dataset-{:05d}.tf".format(i) for i in range(4)]
+    with open(os.path.join(sharded_dataset._dataset_dir, MANIFEST_FILE)) as f:
+        shards = json.load(f)["shards"]
+    assert [shard["start"] for shard in shards] == ["", "France", "Madrid", "Spain"]
+    assert all(shard["completed"] for shard in shards)
+    assert sum(shard["number_of_pages"] for shard in shards) == 11
+    assert sum(shard["number_of_items"] for shard in shards) == len(sharded_dataset) == len(dataset)
+    assert _read_items(sharded_dataset) == _read_items(dataset)
+
+
+def test_build_shards_in_parallel(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    datasets = [
+        _build_dataset(
+            dump_db,
+            bert_tokenizer,
+            synthetic_entity_vocab_file,
+            str(tmp_path / name),
+            shard_size=2,
+            pool_size=pool_size,
+        )
+        for name, pool_size in [("dataset1", 1), ("dataset2", 3)]
+    ]
+    # the shards are identical regardless of the workers that wrote them
+    assert datasets[0].metadata == datasets[1].metadata
+    for file_name in datasets[0].metadata["dataset_files"]:
+        assert filecmp.cmp(
+            os.path.join(datasets[0]._dataset_dir, file_name),
+            os.path.join(datasets[1]._dataset_dir, file_name),
+            shallow=False,
+        )
+
+
+def test_resume_build(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    output_dir = str(tmp_path / "dataset")
+    dataset = _build_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, output_dir, shard_size=3)
+    expected_items = _read_items(dataset)
+
+    # simulate a build interrupted while writing the second shard
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    manifest["shards"][1].update(completed=False, number_of_pages=None, number_of_items=None)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+    os.remove(os.path.join(output_dir, "dataset-00001.tf"))
+    os.remove(os.path.join(output_dir, "metadata.json"))
+    mtime = os.stat(os.path.join(output_dir, "dataset-00000.tf")).st_mtime_ns
+
+    dataset = _build_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, output_dir, shard_size=3)
+    assert os.stat(os.path.join(output_dir, "dataset-00000.tf")).st_mtime_ns == mtime
+    assert _read_items(dataset) == expected_items
+
+
+def test_incremental_build(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    previous_dir = str(tmp_path / "previous_dataset")
+    _build_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, previous_dir, shard_size=3)
+
+    # the second shard contains a changed page and the last shard contains a new page
+    pages = dict(SYNTHETIC_PAGES)
+    pages["Lisbon"] = "Lisbon is the largest city of [[Portugal]]. It is located on the [[Tagus]]."
+    pages["Tagus"] = "The Tagus is a river flowing through [[Spain]] and [[Portugal]]."
+    new_dump_db_file = str(tmp_path / "new.db")
+    DumpDB.build(_DumpReader(pages), new_dump_db_file, pool_size=1, chunk_size=1)
+    new_dump_db = DumpDB(new_dump_db_file)
+
+    output_dir = str(tmp_path / "dataset")
+    dataset = _build_dataset(
+        new_dump_db,
+        bert_tokenizer,
+        synthetic_entity_vocab_file,
+        output_dir,
+        shard_size=3,
+        previous_dataset_dir=previous_dir,
+        previous_dump_db=dump_db,
+    )
+    for index, reused in enumerate([True, False, True, False]):
+        file_name = "dataset-{:05d}.tf".format(index)
+        assert filecmp.cmp(os.path.join(previous_dir, file_name), os.path.join(output_dir, file_name)) == reused
+
+    expected_dataset = _build_dataset(
+        new_dump_db, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / "expected_dataset")
+    )
+    assert _read_items(dataset) == _read_items(expected_dataset)
+    new_dump_db.close()
+
+
+def test_merge_datasets(dataset, dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmp_path):
+    dataset_dirs = [str(tmp_path / f"dataset-{i}") for i in range(3)]
+    for shard_index, dataset_dir in enumerate(dataset_dirs):
+        _build_dataset(
+            dump_db,
+            bert_tokenizer,
+            synthetic_entity_vocab_file,
+            dataset_dir,
+            shard_size=2,
+            num_shards=3,
+            shard_index=shard_index,
+        )
+
+    with pytest.raises(ValueError):
+        WikipediaPretrainingDataset.merge_datasets(dataset_dirs[:2], str(tmp_path / "incomplete"))
+
+    output_dir = str(tmp_path / "merged")
+    WikipediaPretrainingDataset.merge_datasets(dataset_dirs, output_dir)
+    merged_dataset = WikipediaPretrainingDataset(output_dir)
+    assert len(merged_dataset) == len(dataset)
+    assert merged_dataset.tokenizer.vocab == bert_tokenizer.vocab
+    assert merged_dataset.entity_vocab.size == dataset.entity_vocab.size
+    assert {k: v for k, v in merged_dataset.metadata.items() if k != "dataset_files"} == {
+        k: v for k, v in dataset.metadata.items() if k != "dataset_files"
+    }
+    assert _read_items(merged_dataset) == _read_items(dataset)
+
+    # the merged dataset is used as the previous dataset of the builds of the partitions
+    for shard_index in range(3):
+        rebuilt_dir = str(tmp_path / f"rebuilt-{shard_index}")
+        _build_dataset(
+            dump_db,
+            bert_tokenizer,
+            synthetic_entity_vocab_file,
+            rebuilt_dir,
+            shard_size=2,
+            num_shards=3,
+            shard_index=shard_index,
+            previous_dataset_dir=output_dir,
+            previous_dump_db=dump_db,
+        )
+        for file_name in os.listdir(dataset_dirs[shard_index]):
+            if file_name.startswith("dataset-"):
+                assert filecmp.cmp(
+                    os.path.join(dataset_dirs[shard_index], file_name), os.path.join(rebuilt_dir, file_name)
+                )
+
+    with pytest.raises(ValueError):
+        _build_dataset(
+            dump_db,
+            bert_tokenizer,
+            synthetic_entity_vocab_file,
+            str(tmp_path / "unpartitioned"),
+            previous_dataset_dir=output_dir,
+            previous_dump_db=dump_db,
+        )
+
+
+def _build_online_dataset(dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, output_dir, cache):
+    entity_vocab = EntityVocab(synthetic_entity_vocab_file)
+    os.makedirs(output_dir)
+    WikipediaPretrainingDataset.build_online(
+        dump_db_file, bert_tokenizer, "en", entity_vocab, output_dir, cache=cache, num_sample_pages=1000, **BUILD_KWARGS
+    )
+    return WikipediaPretrainingDataset(output_dir)
+
+
+def test_create_iterator(dataset):
+    assert len(dataset) > 0
+    items = list(itertools.islice(dataset.create_iterator(shuffle_buffer_size=1), len(dataset)))
+    for item in items:
+        assert item["word_ids"].size <= dataset.max_seq_length - 2
+        assert item["entity_ids"].size > 0
+        assert item["entity_position_ids"].shape == (item["entity_ids"].size, dataset.max_mention_length)
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_online_dataset(dataset, dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, tmp_path, cache):
+    online_dataset = _build_online_dataset(
+        dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / "online_dataset"), cache
+    )
+    assert online_dataset.online
+    assert len(online_dataset) == len(dataset)
+    assert not os.path.exists(os.path.join(online_dataset._dataset_dir, "dataset.tf"))
+
+    iterator = dataset.create_iterator(shuffle_buffer_size=1)
+    expected = sorted(_to_hashable(item) for item in itertools.islice(iterator, len(dataset)))
+    iterator = online_dataset.create_iterator(shuffle_buffer_size=1)
+    for _ in range(3):  # the second and third epochs are read from the cache if it is enabled
+        items = list(itertools.islice(iterator, len(dataset)))
+        assert sorted(_to_hashable(item) for item in items) == expected
+
+    cache_file = os.path.join(online_dataset._dataset_dir, ONLINE_CACHE_DIR, "dataset-00000-of-00001.tf")
+    assert os.path.exists(cache_file) == cache
+
+
+def test_online_dataset_partitions_pages_across_workers(
+    dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, tmp_path
+):
+    online_dataset = _build_online_dataset(
+        dump_db_file, bert_tokenizer, synthetic_entity_vocab_file, str(tmp_path / "online_dataset"), False
+    )
+    page_ids = []
+    for worker_index in range(2):
+        iterator = online_dataset.create_iterator(num_workers=2, worker_index=worker_index, shuffle_buffer_size=1)
+        page_ids.append({int(item["page_id"]) for item in itertools.islice(iterator, len(online_dataset) // 2)})
+    assert not page_ids[0] & page_ids[1]
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import torch
+
+from luke.pretraining.prefetcher import BatchPrefetcher
+from luke.utils.telemetry import TrainingTelemetry
+
+
+def _generate_batches(num_batches):
+    for n in range(num_batches):
+        yield dict(word_ids=np.full((2, 3), n, dtype=np.int64), word_attention_mask=np.ones((2, 3), dtype=np.int64))
+
+
+def test_prefetch_batches():
+    batches = list(BatchPrefetcher(_generate_batches(5), torch.device("cpu")))
+    assert len(batches) == 5
+    for n, batch in enumerate(batches):
+        assert isinstance(batch["word_ids"], torch.Tensor)
+        assert torch.equal(batch["word_ids"], torch.full((2, 3), n, dtype=torch.long))
+        assert torch.equal(batch["word_attention_mask"], torch.ones((2, 3), dtype=torch.long))
+
+
+def test_prefetch_batches_propagates_errors():
+    def generate_batches():
+        yield from _generate_batches(2)
+        raise ValueError("error in the batch worker")
+
+    prefetcher = iter(BatchPrefetcher(generate_batches(), torch.device("cpu")))
+    next(prefetcher)
+    with pytest.raises(ValueError):
+        next(prefetcher)
+
+
+def test_close_stops_the_underlying_iterator():
+    closed = []
+
+    def generate_batches():
+        try:
+            yield from _generate_batches(1000)
+        finally:
+            closed.append(True)
+
+    prefetcher = BatchPrefetcher(generate_batches(), torch.device("cpu"), queue_size=1)
+    for _ in zip(range(3), prefetcher):
+        pass
+    prefetcher.close()
+    prefetcher._thread.join(5)
+    assert closed == [True]
+
+
+def test_prefetch_batches_records_data_wait_time():
+    telemetry = TrainingTelemetry(torch.device("cpu"))
+    list(BatchPrefetcher(_generate_batches(3), torch.device("cpu"), telemetry=telemetry))
+    assert "data_wait_time" in telemetry.end_step(1)
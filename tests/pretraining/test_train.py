@@ -0,0 +1,183 @@
+import os
+from argparse import Namespace
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from luke.model import LukeConfig
+from luke.optimization import LukeAdamW
+from luke.pretraining.model import LukePretrainingModel
+from luke.pretraining.train import get_ddp_graph_kwargs, weight_split_result
+from luke.utils.batch_splitting import split_batch
+from luke.utils.distributed import COMM_HOOKS, register_comm_hook
+
+WORLD_SIZE = 2
+
+
+def _create_model():
+    torch.manual_seed(0)
+    config = LukeConfig(
+        vocab_size=30,
+        entity_vocab_size=20,
+        bert_model_name="bert-base-uncased",
+        entity_emb_size=8,
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=16,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+    )
+    model = LukePretrainingModel(config)
+    for param in model.parameters():
+        param.requires_grad = False
+    for param in model.entity_embeddings.parameters():
+        param.requires_grad = True
+    for param in model.entity_predictions.parameters():
+        param.requires_grad = True
+    return model
+
+
+def _create_batch(with_masked_entities: bool):
+    masked_entity_labels = torch.full((2, 3), -1, dtype=torch.long)
+    if with_masked_entities:
+        masked_entity_labels[0, 1] = 5
+    return dict(
+        word_ids=torch.randint(1, 30, (2, 8)),
+        word_segment_ids=torch.zeros(2, 8, dtype=torch.long),
+        word_attention_mask=torch.ones(2, 8, dtype=torch.long),
+        entity_ids=torch.randint(1, 20, (2, 3)),
+        entity_position_ids=torch.tensor([[[1, -1], [2, 3], [-1, -1]]] * 2),
+        entity_segment_ids=torch.zeros(2, 3, dtype=torch.long),
+        entity_attention_mask=torch.ones(2, 3, dtype=torch.long),
+        masked_entity_labels=masked_entity_labels,
+    )
+
+
+def _run_worker(rank: int, init_file: str, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE)
+    model = _create_model()
+    args = Namespace(masked_entity_prob=0.15, masked_lm_prob=0.0, static_graph=True)
+    ddp_model = torch.nn.parallel.DistributedDataParallel(
+        model, broadcast_buffers=False, **get_ddp_graph_kwargs(model, args)
+    )
+    torch.manual_seed(rank)
+    # the first backward pass needs to be synchronized when the graph is static
+    ddp_model(**_create_batch(True))["loss"].backward()
+    for step in range(3):
+        # the second rank receives batches without masked entities in the first step
+        batches = [_create_batch(rank == 0 or step > 0) for _ in range(2)]
+        with ddp_model.no_sync():
+            ddp_model(**batches[0])["loss"].backward()
+        ddp_model(**batches[1])["loss"].backward()
+
+    result_queue.put((rank, model.entity_predictions.bias.grad.tolist()))
+    dist.destroy_process_group()
+
+
+def _run_comm_hook_worker(rank: int, init_file: str, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE)
+    args = Namespace(masked_entity_prob=0.15, masked_lm_prob=0.0, static_graph=False)
+    losses = {}
+    for comm_hook in COMM_HOOKS:
+        model = _create_model()
+        ddp_model = torch.nn.parallel.DistributedDataParallel(
+            model, broadcast_buffers=False, **get_ddp_graph_kwargs(model, args)
+        )
+        state = register_comm_hook(ddp_model, comm_hook, powersgd_rank=1, powersgd_start_iteration=2)
+        optimizer = LukeAdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+
+        torch.manual_seed(rank)
+        batch = _create_batch(True)
+        losses[comm_hook] = []
+        for _ in range(30):
+            loss = ddp_model(**batch)["loss"]
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            losses[comm_hook].append(loss.item())
+
+    # the iteration counter of PowerSGD is restored when the training is resumed
+    ddp_model = torch.nn.parallel.DistributedDataParallel(
+        model, broadcast_buffers=False, **get_ddp_graph_kwargs(model, args)
+    )
+    resumed_state = register_comm_hook(
+        ddp_model, "powersgd", powersgd_rank=1, powersgd_start_iteration=2, powersgd_iteration=state.iter
+    )
+    ddp_model(**batch)["loss"].backward()
+    losses["powersgd_iterations"] = [state.iter, resumed_state.iter]
+
+    result_queue.put((rank, losses))
+    dist.destroy_process_group()
+
+
+def test_get_ddp_graph_kwargs():
+    model = _create_model()
+    kwargs = get_ddp_graph_kwargs(model, Namespace(masked_entity_prob=0.15, masked_lm_prob=0.15, static_graph=False))
+    assert not kwargs["find_unused_parameters"]
+    assert not kwargs.get("static_graph", False)
+
+    kwargs = get_ddp_graph_kwargs(model, Namespace(masked_entity_prob=0.0, masked_lm_prob=0.15, static_graph=False))
+    assert kwargs["find_unused_parameters"]
+
+    # the language model head is frozen
+    kwargs = get_ddp_graph_kwargs(model, Namespace(masked_entity_prob=0.15, masked_lm_prob=0.0, static_graph=True))
+    assert not kwargs["find_unused_parameters"]
+    assert kwargs["static_graph"]
+
+
+def test_forward_without_masked_entities():
+    model = _create_model()
+    ret = model(**_create_batch(False))
+    assert ret["masked_entity_loss"].item() == 0.0
+    assert ret["masked_entity_total"].item() == 0
+
+    ret["loss"].backward()
+    assert model.entity_predictions.transform.dense.weight.grad is not None
+
+
+def test_weight_split_result():
+    model = _create_model()
+    batch = _create_batch(True)
+    batch["masked_entity_labels"][1, 0] = 7
+    batch["masked_entity_labels"][1, 2] = 3
+    ret = model(**batch)
+    ret["loss"].backward()
+    expected_grad = model.entity_embeddings.entity_embeddings.weight.grad.clone()
+
+    model.zero_grad()
+    loss = 0.0
+    for part in split_batch(batch):
+        part_ret = weight_split_result(model(**part), batch)
+        part_ret["loss"].backward()
+        loss += part_ret["masked_entity_loss"].item()
+    assert loss == pytest.approx(ret["masked_entity_loss"].item(), rel=1e-5)
+    assert torch.allclose(model.entity_embeddings.entity_embeddings.weight.grad, expected_grad, atol=1e-6)
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_gloo_data_parallel_with_fixed_bert_weights(tmpdir):
+    context = mp.get_context("spawn")
+    result_queue = context.SimpleQueue()
+    mp.spawn(
+        _run_worker, args=(os.path.join(str(tmpdir), "init"), result_queue), nprocs=WORLD_SIZE, join=True,
+    )
+    grads = dict(result_queue.get() for _ in range(WORLD_SIZE))
+    assert grads[0] == pytest.approx(grads[1])
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_comm_hooks_converge(tmpdir):
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(
+        _run_comm_hook_worker, args=(os.path.join(str(tmpdir), "init"), result_queue), nprocs=WORLD_SIZE, join=True,
+    )
+    for _ in range(WORLD_SIZE):
+        rank, losses = result_queue.get()
+        for comm_hook in COMM_HOOKS:
+            assert losses[comm_hook][-1] < losses[comm_hook][0] * 0.5, f"{comm_hook} on rank {rank}"
+            assert losses[comm_hook][-1] == pytest.approx(losses["none"][-1], rel=0.1), comm_hook
+        assert losses["powersgd_iterations"] == [30, 31]
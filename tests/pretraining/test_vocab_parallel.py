@@ -0,0 +1,157 @@
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from luke.model import LukeConfig
+from luke.pretraining.model import LukePretrainingModel
+from luke.pretraining.vocab_parallel import (
+    VocabParallelEmbedding,
+    clip_vocab_parallel_grad_norm_,
+    get_vocab_parallel_parameter_names,
+    get_vocab_range,
+)
+from luke.utils.distributed import VOCAB_PARALLEL_ATTRIBUTE
+
+WORLD_SIZE = 2
+VOCAB_SIZE = 11
+
+
+def _create_config(**kwargs):
+    return LukeConfig(
+        vocab_size=30,
+        entity_vocab_size=VOCAB_SIZE,
+        bert_model_name="bert-base-uncased",
+        entity_emb_size=8,
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=16,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+        **kwargs,
+    )
+
+
+def _create_batch(rank: int):
+    generator = torch.Generator().manual_seed(rank)
+    masked_entity_labels = torch.full((2, 3), -1, dtype=torch.long)
+    if rank == 0:
+        # the second rank does not have masked entities
+        masked_entity_labels[0, 1] = 5
+        masked_entity_labels[1, 0] = 10
+    return dict(
+        word_ids=torch.randint(1, 30, (2, 8), generator=generator),
+        word_segment_ids=torch.zeros(2, 8, dtype=torch.long),
+        word_attention_mask=torch.ones(2, 8, dtype=torch.long),
+        entity_ids=torch.randint(1, VOCAB_SIZE, (2, 3), generator=generator),
+        entity_position_ids=torch.tensor([[[1, -1], [2, 3], [-1, -1]]] * 2),
+        entity_segment_ids=torch.zeros(2, 3, dtype=torch.long),
+        entity_attention_mask=torch.ones(2, 3, dtype=torch.long),
+        masked_entity_labels=masked_entity_labels,
+    )
+
+
+def _run_worker(rank: int, init_file: str, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE)
+    results = {}
+
+    # embedding lookups
+    weight = torch.randn(VOCAB_SIZE, 4, generator=torch.Generator().manual_seed(0))
+    embedding = VocabParallelEmbedding(VOCAB_SIZE, 4, padding_idx=0)
+    embedding.load_state_dict(dict(weight=weight))
+    ids = torch.tensor([[1, 10, 0], [6, 6, 3]]) if rank == 0 else torch.tensor([[5, 7]])
+    output = embedding(ids)
+    output.sum().backward()
+    reference_grad = torch.zeros_like(weight)
+    for i in [1, 10, 6, 6, 3, 5, 7]:
+        reference_grad[i] += 1.0 / WORLD_SIZE
+
+    start, end = get_vocab_range(VOCAB_SIZE, rank, WORLD_SIZE)
+    results["lookup"] = torch.equal(output, weight[ids])
+    results["embedding_grad"] = torch.allclose(embedding.weight.grad, reference_grad[start:end])
+    results["state_dict"] = torch.equal(embedding.state_dict()["weight"], weight)
+
+    # the pretraining model with and without the vocabulary-parallel entity embeddings
+    torch.manual_seed(0)
+    reference_model = LukePretrainingModel(_create_config())
+    state_dict = reference_model.state_dict()
+    model = LukePretrainingModel(_create_config(vocab_parallel_entities=True))
+    model.load_state_dict(state_dict)
+
+    batch = _create_batch(rank)
+    ret = model(**batch)
+    reference_ret = reference_model(**batch)
+    results["loss"] = torch.allclose(ret["loss"], reference_ret["loss"], atol=1e-6)
+    results["correct"] = ret["masked_entity_correct"].item() == reference_ret["masked_entity_correct"].item()
+
+    ret["loss"].backward()
+    reference_ret["loss"].backward()
+    reference_grads = {}
+    for name, param in reference_model.named_parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad)
+            reference_grads[name] = param.grad / WORLD_SIZE
+
+    grads_equal = True
+    for name, param in model.named_parameters():
+        if param.grad is None:
+            continue
+        reference_grad = reference_grads[name]
+        if name in get_vocab_parallel_parameter_names(model):
+            reference_grad = reference_grad[start:end]
+        else:
+            dist.all_reduce(param.grad)
+            param.grad /= WORLD_SIZE
+        grads_equal = grads_equal and torch.allclose(param.grad, reference_grad, atol=1e-6)
+    results["grads"] = grads_equal
+
+    model_state_dict = model.state_dict()
+    results["model_state_dict"] = sorted(model_state_dict.keys()) == sorted(state_dict.keys()) and all(
+        torch.equal(model_state_dict[k], v) for k, v in state_dict.items()
+    )
+
+    result_queue.put((rank, results))
+    dist.destroy_process_group()
+
+
+def test_get_vocab_range():
+    assert get_vocab_range(11, 0, 2) == (0, 6)
+    assert get_vocab_range(11, 1, 2) == (6, 11)
+    assert get_vocab_range(10, 3, 4) == (9, 10)
+
+
+def _run_clip_grad_norm_worker(rank: int, init_file: str, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE)
+    param = torch.nn.Parameter(torch.zeros(2))
+    setattr(param, VOCAB_PARALLEL_ATTRIBUTE, True)
+    # only the first rank has gradients
+    if rank == 0:
+        param.grad = torch.tensor([3.0, 4.0])
+    result_queue.put((rank, clip_vocab_parallel_grad_norm_([param], 1.0).item()))
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_clip_vocab_parallel_grad_norm_without_gradients(tmpdir):
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(
+        _run_clip_grad_norm_worker,
+        args=(os.path.join(str(tmpdir), "init"), result_queue),
+        nprocs=WORLD_SIZE,
+        join=True,
+    )
+    assert sorted(result_queue.get() for _ in range(WORLD_SIZE)) == [(0, 5.0), (1, 5.0)]
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_vocab_parallel_entities(tmpdir):
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_run_worker, args=(os.path.join(str(tmpdir), "init"), result_queue), nprocs=WORLD_SIZE, join=True)
+    for _ in range(WORLD_SIZE):
+        rank, results = result_queue.get()
+        for name, value in results.items():
+            assert value, f"{name} on rank {rank}"
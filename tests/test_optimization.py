@@ -1,6 +1,11 @@
+import os
+
+import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
-from luke.optimization import LukeAdamW
+from luke.optimization import LukeAdamW, ShardedLukeAdamW, merge_optimizer_state_dicts, split_optimizer_state_dict
 
 
 def test_luke_adam_w():
@@ -16,3 +21,116 @@ def test_luke_adam_w():
         w.grad.zero_()
 
     assert torch.allclose(w, target, atol=0.01)
+
+
+def _create_sharded_optimizer_test_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Tanh(), torch.nn.Linear(8, 8), torch.nn.Linear(8, 2))
+    model[0].bias.requires_grad = False
+    # the last module does not receive gradients on any rank
+    return torch.nn.ModuleList([model, torch.nn.Linear(2, 2)])
+
+
+def _create_optimizer_parameters(model):
+    params = list(model.parameters())
+    return [dict(params=params[:3] + params[6:], weight_decay=0.01), dict(params=params[3:6], weight_decay=0.0)]
+
+
+def _compute_loss(model, rank, step):
+    generator = torch.Generator().manual_seed(step * 10 + rank)
+    return model[0](torch.randn(3, 4, generator=generator)).pow(2).mean()
+
+
+def _run_sharded_optimizer_worker(rank, init_file, shard_gradients, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=2)
+
+    model = _create_sharded_optimizer_test_model()
+    optimizer = ShardedLukeAdamW(
+        _create_optimizer_parameters(model), lr=0.1, shard_gradients=shard_gradients, bucket_size=16
+    )
+    reference_model = _create_sharded_optimizer_test_model()
+    reference_optimizer = LukeAdamW(_create_optimizer_parameters(reference_model), lr=0.1)
+
+    for step in range(3):
+        _compute_loss(model, rank, step).backward()
+        if not shard_gradients:
+            for param in model.parameters():
+                if param.grad is not None:
+                    dist.all_reduce(param.grad)
+                    param.grad.div_(2)
+        optimizer.clip_grad_norm_(0.1)
+        optimizer.step()
+        model.zero_grad()
+
+        reference_loss = (_compute_loss(reference_model, 0, step) + _compute_loss(reference_model, 1, step)) / 2
+        reference_loss.backward()
+        torch.nn.utils.clip_grad_norm_(reference_model.parameters(), 0.1)
+        reference_optimizer.step()
+        reference_model.zero_grad()
+
+    params_equal = all(
+        torch.allclose(p1, p2, atol=1e-6) for p1, p2 in zip(model.parameters(), reference_model.parameters())
+    )
+
+    state_dict = optimizer.consolidated_state_dict()
+    if rank == 0:
+        reference_state_dict = reference_optimizer.state_dict()
+        state_equal = sorted(state_dict["state"].keys()) == sorted(reference_state_dict["state"].keys()) and all(
+            torch.allclose(s[key], reference_state_dict["state"][index][key])
+            for index, s in state_dict["state"].items()
+            for key in ("exp_avg", "exp_avg_sq")
+        )
+    else:
+        state_equal = state_dict is None
+
+    # load the consolidated state dict into an optimizer with the same partition and check the local states
+    new_optimizer = ShardedLukeAdamW(_create_optimizer_parameters(model), lr=0.1)
+    new_optimizer.load_state_dict(merge_optimizer_state_dicts([reference_optimizer.state_dict()]))
+    local_state_dict = optimizer.state_dict()
+    loaded_state_dict = new_optimizer.state_dict()
+    load_equal = sorted(local_state_dict["state"].keys()) == sorted(loaded_state_dict["state"].keys()) and all(
+        torch.allclose(s["exp_avg"], loaded_state_dict["state"][index]["exp_avg"])
+        for index, s in local_state_dict["state"].items()
+    )
+
+    result_queue.put((rank, params_equal, state_equal, load_equal, len(local_state_dict["state"])))
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+@pytest.mark.parametrize("shard_gradients", [False, True])
+def test_sharded_luke_adam_w(tmpdir, shard_gradients):
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(
+        _run_sharded_optimizer_worker,
+        args=(os.path.join(str(tmpdir), "init"), shard_gradients, result_queue),
+        nprocs=2,
+        join=True,
+    )
+    results = sorted(result_queue.get() for _ in range(2))
+    for rank, params_equal, state_equal, load_equal, _ in results:
+        assert params_equal
+        assert state_equal
+        assert load_equal
+
+    # the states of the five trainable parameters receiving gradients are partitioned across the ranks
+    assert sum(result[4] for result in results) == 5
+    assert all(result[4] > 0 for result in results)
+
+
+def test_merge_optimizer_state_dicts():
+    param_groups = [dict(lr=0.1, params=[0, 1, 2])]
+    state_dicts = [
+        dict(state={0: dict(step=1)}, param_groups=param_groups),
+        dict(state={2: dict(step=1)}, param_groups=param_groups),
+    ]
+    merged = merge_optimizer_state_dicts(state_dicts)
+    assert merged == dict(state={0: dict(step=1), 2: dict(step=1)}, param_groups=param_groups)
+
+
+def test_split_optimizer_state_dict():
+    param_groups = [dict(lr=0.1, params=[0, 1, 2])]
+    state_dict = dict(state={0: dict(step=1), 1: dict(step=2), 2: dict(step=3)}, param_groups=param_groups)
+    state_dicts = split_optimizer_state_dict(state_dict, 2)
+    assert [sorted(s["state"].keys()) for s in state_dicts] == [[0, 2], [1]]
+    assert merge_optimizer_state_dicts(state_dicts) == state_dict
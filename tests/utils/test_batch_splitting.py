@@ -0,0 +1,142 @@
+import contextlib
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from luke.utils.batch_splitting import is_out_of_memory_error, run_with_oom_recovery, split_batch
+
+
+def _create_batch():
+    torch.manual_seed(0)
+    return dict(inputs=torch.randn(5, 3), labels=torch.randn(5))
+
+
+def _run(model, batch, max_forward_size=None, fail_first_backward=False, enabled=True, split_backward=True):
+    batch_size = batch["inputs"].size(0)
+    is_last_parts = []
+
+    def forward(part, is_last_part):
+        if max_forward_size is not None and part["inputs"].size(0) > max_forward_size:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        loss = ((model(part["inputs"]).squeeze(1) - part["labels"]) ** 2).mean()
+        loss = loss * part["inputs"].size(0) / batch_size
+        return loss, loss.item()
+
+    def backward(loss, is_last_part):
+        is_last_parts.append(is_last_part)
+        if fail_first_backward and len(is_last_parts) == 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        loss.backward()
+
+    return (
+        run_with_oom_recovery(
+            batch, forward, backward, model.zero_grad, enabled=enabled, split_backward=split_backward
+        ),
+        is_last_parts,
+    )
+
+
+def test_split_batch():
+    first, second = split_batch(_create_batch())
+    assert first["inputs"].size(0) == 3
+    assert second["labels"].size(0) == 2
+
+
+def test_is_out_of_memory_error():
+    assert is_out_of_memory_error(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert not is_out_of_memory_error(RuntimeError("size mismatch"))
+    assert not is_out_of_memory_error(ValueError("out of memory"))
+
+
+def test_run_with_oom_recovery():
+    batch = _create_batch()
+
+    model = torch.nn.Linear(3, 1)
+    (outputs, num_splits, gradients_reset), _ = _run(model, batch)
+    expected_grad = model.weight.grad.clone()
+    assert num_splits == 0
+    assert not gradients_reset
+
+    model.zero_grad()
+    (split_outputs, num_splits, gradients_reset), is_last_parts = _run(model, batch, max_forward_size=2)
+    # 5 -> (3, 2) -> ((2, 1), 2)
+    assert num_splits == 2
+    assert not gradients_reset
+    assert is_last_parts == [False, False, True]
+    assert sum(split_outputs) == pytest.approx(outputs[0])
+    assert torch.allclose(model.weight.grad, expected_grad, atol=1e-6)
+
+
+def test_run_with_oom_recovery_in_backward():
+    batch = _create_batch()
+    model = torch.nn.Linear(3, 1)
+    (outputs, _, _), _ = _run(model, batch)
+    expected_grad = model.weight.grad.clone()
+
+    # the gradients accumulated before the failed backward pass are discarded
+    (split_outputs, num_splits, gradients_reset), _ = _run(model, batch, fail_first_backward=True)
+    assert num_splits == 1
+    assert gradients_reset
+    assert sum(split_outputs) == pytest.approx(outputs[0])
+    assert torch.allclose(model.weight.grad, expected_grad, atol=1e-6)
+
+
+def test_run_with_oom_recovery_without_splitting_backward():
+    model = torch.nn.Linear(3, 1)
+    (_, num_splits, _), _ = _run(model, _create_batch(), max_forward_size=2, split_backward=False)
+    assert num_splits == 2
+
+    with pytest.raises(RuntimeError):
+        _run(model, _create_batch(), fail_first_backward=True, split_backward=False)
+
+
+def test_run_with_oom_recovery_disabled():
+    with pytest.raises(RuntimeError):
+        _run(torch.nn.Linear(3, 1), _create_batch(), max_forward_size=2, enabled=False)
+
+
+def _run_distributed_worker(rank, init_file, result_queue):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=2)
+    torch.manual_seed(0)
+    model = torch.nn.Linear(3, 1)
+    ddp_model = torch.nn.parallel.DistributedDataParallel(model)
+    batches = [dict(inputs=torch.randn(5, 3), labels=torch.randn(5)) for _ in range(2)]
+
+    def maybe_no_sync(is_last_part):
+        return contextlib.ExitStack() if is_last_part else ddp_model.no_sync()
+
+    def forward(part, is_last_part):
+        # only the first rank runs out of memory and splits its micro-batch
+        if rank == 0 and part["inputs"].size(0) > 2:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        with maybe_no_sync(is_last_part):
+            loss = ((ddp_model(part["inputs"]).squeeze(1) - part["labels"]) ** 2).mean()
+        return loss * part["inputs"].size(0) / batches[rank]["inputs"].size(0), None
+
+    def backward(loss, is_last_part):
+        with maybe_no_sync(is_last_part):
+            loss.backward()
+
+    _, num_splits, _ = run_with_oom_recovery(batches[rank], forward, backward, model.zero_grad, split_backward=False)
+
+    # the gradients are averaged over the whole micro-batches of the ranks
+    reference_model = torch.nn.Linear(3, 1)
+    reference_model.load_state_dict(model.state_dict())
+    for batch in batches:
+        loss = ((reference_model(batch["inputs"]).squeeze(1) - batch["labels"]) ** 2).mean() / 2
+        loss.backward()
+
+    result_queue.put((rank, num_splits, torch.allclose(model.weight.grad, reference_model.weight.grad, atol=1e-6)))
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_run_with_oom_recovery_in_distributed_training(tmpdir):
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_run_distributed_worker, args=(os.path.join(str(tmpdir), "init"), result_queue), nprocs=2, join=True)
+    results = sorted(result_queue.get() for _ in range(2))
+    assert [num_splits for _, num_splits, _ in results] == [2, 0]
+    assert all(grad_equal for _, _, grad_equal in results)
@@ -0,0 +1,15 @@
+import os
+
+import pytest
+
+from luke.utils.distributed import get_local_cpu_ids
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="CPU affinity is not supported")
+def test_get_local_cpu_ids(monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1, 2, 3, 4, 5, 6, 7})
+
+    assert get_local_cpu_ids(0, 2) == [0, 1, 2, 3]
+    assert get_local_cpu_ids(1, 2) == [4, 5, 6, 7]
+    assert get_local_cpu_ids(2, 3) == [4, 5]
+    assert get_local_cpu_ids(0, 16) == list(range(8))
@@ -1,8 +1,17 @@
+import bz2
+import json
 import os
+import pickle
 import pytest
 import tempfile
+from collections import Counter
 
-from luke.utils.entity_vocab import EntityVocab
+import numpy as np
+from click.testing import CliRunner
+
+from luke.utils.entity_vocab import EntityVocab, _reduce_sketch, _union_find, build_multilingual_entity_vocab
+from luke.utils.interwiki_db import InterwikiDB
+from luke.utils.link_index import LinkIndex
 
 ENTITY_VOCAB_FIXTURE_FILE = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "../fixtures/enwiki_20181220_entvocab_100.tsv"
@@ -12,6 +21,10 @@ MULTILINGUAL_ENTITY_VOCAB_FIXTURE_FILE = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "../fixtures/en_ja_multilingual_vocab_test.jsonl"
 )
 
+WIKIDATA_FIXTURE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../fixtures/wikidata_20180423_sitelinks10.json"
+)
+
 
 @pytest.fixture
 def entity_vocab():
@@ -59,3 +72,192 @@ def test_save_and_load(multilingual_entity_vocab):
             assert set(entities1) == set(entities2)
             assert multilingual_entity_vocab.counter[entities1[0]] == entity_vocab2.counter[entities2[0]]
             assert multilingual_entity_vocab.vocab[entities1[0]] == entity_vocab2.vocab[entities2[0]]
+
+
+@pytest.mark.parametrize("vocab_file", [ENTITY_VOCAB_FIXTURE_FILE, MULTILINGUAL_ENTITY_VOCAB_FIXTURE_FILE])
+def test_binary_entity_vocab(vocab_file, tmpdir):
+    entity_vocab = EntityVocab(vocab_file)
+    entity_vocab.save_binary(str(tmpdir))
+    binary_entity_vocab = EntityVocab(str(tmpdir))
+    assert binary_entity_vocab.binary
+    assert not entity_vocab.binary
+
+    assert len(binary_entity_vocab) == len(entity_vocab)
+    assert list(binary_entity_vocab) == list(entity_vocab)
+    for title, language in entity_vocab:
+        assert binary_entity_vocab.contains(title, language)
+        assert binary_entity_vocab.get_id(title, language) == entity_vocab.get_id(title, language)
+        assert binary_entity_vocab.get_count_by_title(title, language) == entity_vocab.get_count_by_title(
+            title, language
+        )
+    for ent_id in range(len(entity_vocab)):
+        for language in ("en", "ja", None):
+            assert binary_entity_vocab.get_title_by_id(ent_id, language) == entity_vocab.get_title_by_id(
+                ent_id, language
+            )
+
+    assert not binary_entity_vocab.contains("Unknown entity")
+    assert binary_entity_vocab.get_id("Unknown entity", default=-1) == -1
+    assert binary_entity_vocab.get_count_by_title("Unknown entity") == 0
+    assert binary_entity_vocab.inv_vocab == entity_vocab.inv_vocab
+
+    # the vocabulary is pickled as its path
+    assert pickle.loads(pickle.dumps(binary_entity_vocab)).get_id(*next(iter(entity_vocab))) == 0
+
+
+def test_binary_entity_vocab_save(entity_vocab, tmpdir):
+    entity_vocab.save_binary(os.path.join(str(tmpdir), "binary"))
+    EntityVocab(os.path.join(str(tmpdir), "binary")).save(os.path.join(str(tmpdir), "entity_vocab.jsonl"))
+    entity_vocab2 = EntityVocab(os.path.join(str(tmpdir), "entity_vocab.jsonl"))
+    assert entity_vocab2.get_id("United States") == 4
+    assert entity_vocab2.get_count_by_title("United States") == 261500
+    assert len(entity_vocab2) == len(entity_vocab)
+
+
+def _count_entities_serially(dump_db):
+    counter = Counter()
+    for title in dump_db.titles():
+        for paragraph in dump_db.get_paragraphs(title):
+            for wiki_link in paragraph.wiki_links:
+                counter[dump_db.resolve_redirect(wiki_link.title)] += 1
+    return counter
+
+
+def _build_entity_vocab(dump_db, out_file, **kwargs):
+    build_kwargs = dict(
+        vocab_size=100, white_list=[], white_list_only=False, pool_size=2, chunk_size=3, language=dump_db.language
+    )
+    build_kwargs.update(kwargs)
+    EntityVocab.build(dump_db, out_file, **build_kwargs)
+    with open(out_file) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_build_entity_vocab(dump_db, tmpdir):
+    counter = _count_entities_serially(dump_db)
+    titles = frozenset(dump_db.titles())
+    expected_titles = sorted(
+        (t for t in counter if t in titles and not t.startswith("Category:")), key=lambda t: (-counter[t], t)
+    )
+
+    items = _build_entity_vocab(dump_db, os.path.join(str(tmpdir), "exact.jsonl"))
+    assert [item["entities"][0][0] for item in items] == ["[PAD]", "[UNK]", "[MASK]"] + expected_titles
+    assert [item["count"] for item in items[3:]] == [counter[t] for t in expected_titles]
+    assert [item["id"] for item in items] == list(range(len(items)))
+
+    # the vocabulary does not depend on the chunking of the pages
+    assert _build_entity_vocab(dump_db, os.path.join(str(tmpdir), "chunk.jsonl"), pool_size=1, chunk_size=100) == items
+
+    # the approximate mode produces the same vocabulary if the sketch is large enough
+    assert _build_entity_vocab(dump_db, os.path.join(str(tmpdir), "approx.jsonl"), approximate=True) == items
+
+    # the entities accounting for more than 1 / (sketch_size + 1) of the links survive in a small sketch, and they
+    # are counted exactly
+    approx_items = _build_entity_vocab(
+        dump_db, os.path.join(str(tmpdir), "small.jsonl"), vocab_size=5, approximate=True, sketch_size=6
+    )
+    assert approx_items == items[:5]
+
+    white_list_items = _build_entity_vocab(
+        dump_db, os.path.join(str(tmpdir), "white_list.jsonl"), white_list=["Lisbon"], white_list_only=True
+    )
+    assert [item["entities"][0][0] for item in white_list_items] == ["[PAD]", "[UNK]", "[MASK]", "Lisbon"]
+
+
+@pytest.mark.parametrize("use_link_index", [False, True])
+def test_merge_entity_vocabs(dump_db, tmpdir, use_link_index):
+    link_index = None
+    if use_link_index:
+        link_index = LinkIndex.build(dump_db, os.path.join(str(tmpdir), "link_index"))
+
+    for kwargs in [dict(vocab_size=5), dict(white_list=["Lisbon", "Spain"], white_list_only=True)]:
+        expected_items = _build_entity_vocab(dump_db, os.path.join(str(tmpdir), "expected.jsonl"), **kwargs)
+
+        vocab_files = [os.path.join(str(tmpdir), f"partial-{i}.jsonl") for i in range(3)]
+        for (shard_index, vocab_file) in enumerate(vocab_files):
+            _build_entity_vocab(
+                dump_db, vocab_file, num_shards=3, shard_index=shard_index, link_index=link_index, **kwargs
+            )
+        merged_file = os.path.join(str(tmpdir), "merged.jsonl")
+        EntityVocab.merge(
+            vocab_files,
+            merged_file,
+            kwargs.get("vocab_size", 100),
+            kwargs.get("white_list", []),
+            kwargs.get("white_list_only", False),
+        )
+        with open(merged_file) as f:
+            assert [json.loads(line) for line in f] == expected_items
+
+    with pytest.raises(ValueError):
+        _build_entity_vocab(dump_db, vocab_files[0], num_shards=3, shard_index=0, approximate=True)
+
+
+def test_reduce_sketch():
+    counter = Counter(a=10, b=5, c=3, d=1)
+    assert _reduce_sketch(counter, 4) is counter
+    assert _reduce_sketch(counter, 2) == Counter(a=7, b=2)
+
+
+def _write_jsonl(out_file, items):
+    with open(out_file, "w") as f:
+        for item in items:
+            json.dump(item, f)
+            f.write("\n")
+
+
+def test_build_multilingual_entity_vocab(tmpdir):
+    wikidata_file = os.path.join(str(tmpdir), "wikidata.json.bz2")
+    with open(WIKIDATA_FIXTURE_FILE, "rb") as f:
+        with open(wikidata_file, "wb") as out_f:
+            out_f.write(bz2.compress(f.read()))
+    interwiki_db_file = os.path.join(str(tmpdir), "interwiki.pkl")
+    InterwikiDB.build(wikidata_file).save(interwiki_db_file)
+
+    def create_special_items(language):
+        return [{"entities": [[title, language]], "count": 0} for title in ("[PAD]", "[UNK]", "[MASK]")]
+
+    en_file = os.path.join(str(tmpdir), "en.jsonl")
+    _write_jsonl(
+        en_file,
+        create_special_items("en")
+        + [
+            {"entities": [["Spain", "en"]], "count": 10},
+            {"entities": [["Berlin", "en"]], "count": 5},
+            {"entities": [["Tokyo", "en"]], "count": 5},
+            {"entities": [["Poland", "en"]], "count": 1},
+        ],
+    )
+    ja_file = os.path.join(str(tmpdir), "ja.jsonl")
+    _write_jsonl(
+        ja_file,
+        create_special_items("ja")
+        + [
+            {"entities": [["スペイン", "ja"]], "count": 3},
+            {"entities": [["ポーランド", "ja"]], "count": 7},
+            {"entities": [["東京", "ja"], ["Tokyo", "de"]], "count": 2},
+        ],
+    )
+
+    out_file = os.path.join(str(tmpdir), "multilingual.jsonl")
+    args = ["-v", en_file, "-v", ja_file, "-i", interwiki_db_file, "-o", out_file, "-s", "8", "--pool-size", "2"]
+    result = CliRunner().invoke(build_multilingual_entity_vocab, args)
+    assert result.exit_code == 0, result.output
+
+    with open(out_file) as f:
+        items = [json.loads(line) for line in f]
+    assert items == [
+        {"id": 0, "entities": [["[PAD]", "en"], ["[PAD]", "ja"]], "count": 0},
+        {"id": 1, "entities": [["[UNK]", "en"], ["[UNK]", "ja"]], "count": 0},
+        {"id": 2, "entities": [["[MASK]", "en"], ["[MASK]", "ja"]], "count": 0},
+        {"id": 3, "entities": [["Spain", "en"], ["スペイン", "ja"]], "count": 13},
+        {"id": 4, "entities": [["Poland", "en"], ["ポーランド", "ja"]], "count": 8},
+        {"id": 5, "entities": [["Berlin", "en"]], "count": 5},
+        {"id": 6, "entities": [["Tokyo", "en"]], "count": 5},
+        {"id": 7, "entities": [["東京", "ja"], ["Tokyo", "de"]], "count": 2},
+    ]
+
+
+def test_union_find():
+    parents = _union_find(6, np.array([5, 3, 4]), np.array([3, 1, 2]))
+    assert parents.tolist() == [0, 1, 2, 1, 2, 1]
@@ -1,9 +1,10 @@
 import bz2
+import gzip
 import os
 import pytest
 import tempfile
 
-from luke.utils.interwiki_db import InterwikiDB
+from luke.utils.interwiki_db import InterwikiDB, _split_dump_file
 
 WIKIDATA_FIXTURE_FILE = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "../fixtures/wikidata_20180423_sitelinks10.json"
@@ -25,3 +26,85 @@ def test_query(db):
     ret = dict([(v, k) for k, v in db.query("Spain", "en")])
     assert ret["ja"] == "スペイン"
     assert ret["zh"] == "西班牙"
+
+
+def test_query_ids(db):
+    item_id = db.item_id("Spain", "en")
+    assert item_id != -1
+    assert db.item_id("スペイン", "ja") == item_id
+    assert db.item_id("Spain", "xx") == -1
+
+    titles = [db.get_title(title_id) for title_id in db.query_ids("Spain", "en")]
+    assert titles == db.query("Spain", "en")
+    assert ("スペイン", "ja") in titles
+    assert len(db.query_ids("Unknown entity", "en")) == 0
+
+
+def test_batch_query(db):
+    item_ids = db.batch_query(["Spain", "スペイン", "Unknown entity", "ベルリン"], ["en", "ja", "en", "ja"])
+    assert item_ids.tolist() == [
+        db.item_id("Spain", "en"),
+        db.item_id("Spain", "en"),
+        -1,
+        db.item_id("Berlin", "en"),
+    ]
+    assert db.batch_query(["Spain", "Berlin"], "en").tolist() == [db.item_id("Spain", "en"), db.item_id("Berlin", "en")]
+    assert db.batch_query(["Spain", "Berlin", "Unknown entity"], "en", use_cache=True).tolist() == [
+        db.item_id("Spain", "en"),
+        db.item_id("Berlin", "en"),
+        -1,
+    ]
+    assert db.get_title_to_item_id("ja")["スペイン"] == db.item_id("Spain", "en")
+
+    # the titles without languages are not found
+    assert db.batch_query(["Spain", "Spain"], ["en", None]).tolist() == [db.item_id("Spain", "en"), -1]
+    assert db.batch_query(["Spain"], None).tolist() == [-1]
+    assert db.item_id("Spain", None) == -1
+    assert db.get_title_to_item_id(None) == {}
+
+
+def _save_db(db, out_file):
+    db.save(out_file)
+    with open(out_file, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("compression", ["bz2", "multistream_bz2", "gzip", "none"])
+def test_build_in_parallel(compression, tmpdir):
+    with open(WIKIDATA_FIXTURE_FILE, "rb") as f:
+        data = f.read()
+
+    if compression == "bz2":
+        dump_file = os.path.join(str(tmpdir), "wikidata.json.bz2")
+        data = bz2.compress(data)
+    elif compression == "multistream_bz2":
+        # each stream contains four lines, so some of the lines span two streams
+        dump_file = os.path.join(str(tmpdir), "wikidata.json.bz2")
+        lines = data.splitlines(keepends=True)
+        data = b"".join(bz2.compress(b"".join(lines[i : i + 4])) for i in range(0, len(lines), 4))
+    elif compression == "gzip":
+        dump_file = os.path.join(str(tmpdir), "wikidata.json.gz")
+        data = gzip.compress(data)
+    else:
+        dump_file = os.path.join(str(tmpdir), "wikidata.json")
+    with open(dump_file, "wb") as f:
+        f.write(data)
+
+    ranges = _split_dump_file(dump_file, 1000)
+    if compression == "multistream_bz2":
+        assert len(ranges) == 3
+    elif compression == "none":
+        assert len(ranges) > 3
+    else:
+        assert ranges is None
+
+    for target_languages in (None, frozenset(["en", "ja"])):
+        expected = _save_db(InterwikiDB.build(dump_file, target_languages), os.path.join(str(tmpdir), "expected.pkl"))
+        parallel_db = InterwikiDB.build(
+            dump_file, target_languages, pool_size=2, chunk_size=3, block_size=1000, spill_dir=str(tmpdir)
+        )
+        assert _save_db(parallel_db, os.path.join(str(tmpdir), "parallel.pkl")) == expected
+        assert parallel_db.query("Spain", "en") == InterwikiDB.build(dump_file, target_languages).query("Spain", "en")
+
+    # the spill files are removed
+    assert sorted(os.listdir(str(tmpdir))) == sorted(["expected.pkl", "parallel.pkl", os.path.basename(dump_file)])
@@ -0,0 +1,81 @@
+import json
+import os
+import pickle
+from collections import Counter
+
+import pytest
+
+from luke.utils.entity_vocab import EntityVocab
+from luke.utils.link_index import LinkIndex
+from luke.utils.wikipedia_scan import LinkCounter, scan_page, scan_wikipedia
+
+
+@pytest.fixture
+def link_index(dump_db, tmpdir):
+    return LinkIndex.build(dump_db, os.path.join(str(tmpdir), "link_index"), pool_size=2, chunk_size=3)
+
+
+def _to_tuples(paragraph_links):
+    return [[(link.title, link.text, link.start, link.end) for link in links] for links in paragraph_links]
+
+
+def _get_links(paragraphs):
+    return _to_tuples(p.wiki_links for p in paragraphs)
+
+
+def test_link_index(dump_db, link_index):
+    assert link_index.metadata["number_of_pages"] == len(list(dump_db.titles()))
+    for title in dump_db.titles():
+        assert title in link_index
+        paragraphs = scan_page(dump_db, title)
+        assert _to_tuples(link_index.get_wiki_links(title)) == _get_links(paragraphs)
+
+        indexed_paragraphs = scan_page(dump_db, title, link_index)
+        assert _get_links(indexed_paragraphs) == _get_links(paragraphs)
+        assert [p.text for p in indexed_paragraphs] == [p.text for p in paragraphs]
+        assert [p.text for p in scan_page(dump_db, title, link_index, with_text=False)] == [""] * len(paragraphs)
+
+    # the redirects are resolved
+    assert "Kingdom of Spain" not in link_index
+    assert link_index.get_wiki_links("Kingdom of Spain") == []
+
+    reloaded = pickle.loads(pickle.dumps(link_index))
+    assert _to_tuples(reloaded.get_wiki_links("Madrid")) == _to_tuples(link_index.get_wiki_links("Madrid"))
+
+
+def test_count_links(dump_db, link_index):
+    counter = link_index.count_links()
+    assert counter["Spain"] == 7
+    assert "Kingdom of Spain" not in counter
+    assert counter == scan_wikipedia(dump_db, [LinkCounter()])["link_counts"]
+
+    titles = list(dump_db.titles())
+    assert sum((link_index.count_links(titles[i::3]) for i in range(3)), Counter()) == counter
+    assert link_index.count_links(["Madrid"]) == Counter(Spain=2)
+    assert link_index.count_links([]) == Counter()
+
+    num_links = sum(count for _, _, count in link_index.count_anchor_targets())
+    assert num_links == sum(counter.values()) == link_index.metadata["number_of_links"]
+
+
+def test_scan_wikipedia_with_link_index(dump_db, link_index, tmpdir):
+    results = scan_wikipedia(dump_db, [LinkCounter()], pool_size=2, chunk_size=3, link_index=link_index)
+    assert results["link_counts"] == link_index.count_links()
+
+    vocab_file = os.path.join(str(tmpdir), "entity_vocab.jsonl")
+    EntityVocab.build(dump_db, vocab_file, 100, [], False, 1, 100, "en", link_index=link_index)
+    expected_vocab_file = os.path.join(str(tmpdir), "expected_entity_vocab.jsonl")
+    EntityVocab.build(dump_db, expected_vocab_file, 100, [], False, 1, 100, "en")
+    with open(vocab_file) as f, open(expected_vocab_file) as expected_f:
+        assert [json.loads(line) for line in f] == [json.loads(line) for line in expected_f]
+
+
+def test_check_dump_db(dump_db, link_index):
+    link_index.check_dump_db(dump_db)
+
+    other_index = LinkIndex(link_index.index_dir)
+    other_index.metadata["dump_db_uuid"] = "other"
+    with pytest.raises(RuntimeError):
+        other_index.check_dump_db(dump_db)
+    with pytest.raises(RuntimeError):
+        scan_wikipedia(dump_db, [LinkCounter()], link_index=other_index)
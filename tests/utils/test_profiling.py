@@ -0,0 +1,104 @@
+import json
+import os
+import signal
+
+import pytest
+import torch
+
+from luke.model import EntityEmbeddings, LukeConfig
+from luke.utils.profiling import StepProfiler, parse_step_range
+from luke.utils.telemetry import TrainingTelemetry
+
+
+def _create_model():
+    config = LukeConfig(
+        vocab_size=30,
+        entity_vocab_size=20,
+        bert_model_name="bert-base-uncased",
+        entity_emb_size=8,
+        hidden_size=16,
+        max_position_embeddings=16,
+        type_vocab_size=2,
+    )
+    return EntityEmbeddings(config)
+
+
+def _train_step(model, optimizer, telemetry):
+    with telemetry.phase("forward"):
+        output = model(torch.tensor([[1, 2]]), torch.tensor([[[1, -1], [2, 3]]]), torch.zeros(1, 2, dtype=torch.long))
+    with telemetry.phase("backward"):
+        output.sum().backward()
+    with telemetry.phase("optimizer"):
+        optimizer.step()
+
+
+def test_parse_step_range():
+    assert parse_step_range("3:5") == (3, 5)
+    assert parse_step_range(None) is None
+    with pytest.raises(ValueError):
+        parse_step_range("5:5")
+
+
+def test_step_profiler(tmpdir):
+    model = _create_model()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    telemetry = TrainingTelemetry(torch.device("cpu"))
+    profiler = StepProfiler(str(tmpdir), model, torch.device("cpu"), profile_steps="1:3")
+
+    profiler.step(0)
+    for global_step in range(1, 5):
+        _train_step(model, optimizer, telemetry)
+        profiler.step(global_step)
+    profiler.close()
+
+    assert sorted(os.listdir(os.path.join(str(tmpdir), "profile"))) == ["summary_step1-3.txt", "trace_step1-3.json"]
+    with open(os.path.join(str(tmpdir), "profile", "trace_step1-3.json")) as f:
+        assert any(event.get("name") == "module::EntityEmbeddings" for event in json.load(f)["traceEvents"])
+    with open(os.path.join(str(tmpdir), "profile", "summary_step1-3.txt")) as f:
+        summary = f.read()
+    for label in ("module::EntityEmbeddings", "phase::forward", "phase::backward", "phase::optimizer"):
+        assert label in summary
+
+    # the forward methods are restored after the window
+    assert "forward" not in model.__dict__
+
+
+def test_step_profiler_with_error(tmpdir):
+    model = _create_model()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    # the phases are labeled even if the telemetry is disabled
+    telemetry = TrainingTelemetry(torch.device("cpu"), enabled=False)
+    profiler = StepProfiler(str(tmpdir), model, torch.device("cpu"), profile_steps="0:2")
+
+    profiler.step(0)
+    with pytest.raises(IndexError):
+        model(torch.tensor([[100]]), torch.tensor([[[1, -1]]]), torch.zeros(1, 1, dtype=torch.long))
+    _train_step(model, optimizer, telemetry)
+    profiler.step(1)
+    _train_step(model, optimizer, telemetry)
+    profiler.step(2)
+
+    with open(os.path.join(str(tmpdir), "profile", "summary_step0-2.txt")) as f:
+        summary = f.read()
+    for label in ("module::EntityEmbeddings", "phase::forward", "phase::backward", "phase::optimizer"):
+        assert label in summary
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR2"), reason="SIGUSR2 is not available")
+def test_step_profiler_on_signal(tmpdir):
+    model = _create_model()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    telemetry = TrainingTelemetry(torch.device("cpu"))
+    previous_handler = signal.getsignal(signal.SIGUSR2)
+    try:
+        profiler = StepProfiler(str(tmpdir), model, torch.device("cpu"), profile_on_signal=True, num_signal_steps=2)
+        for global_step in range(1, 6):
+            if global_step == 2:
+                os.kill(os.getpid(), signal.SIGUSR2)
+            _train_step(model, optimizer, telemetry)
+            profiler.step(global_step)
+        profiler.close()
+    finally:
+        signal.signal(signal.SIGUSR2, previous_handler)
+
+    assert os.path.exists(os.path.join(str(tmpdir), "profile", "trace_step2-4.json"))
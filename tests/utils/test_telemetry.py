@@ -0,0 +1,44 @@
+import json
+import os
+import time
+
+import torch
+
+from luke.utils.telemetry import TrainingTelemetry
+
+
+def test_training_telemetry(tmpdir):
+    log_file = os.path.join(str(tmpdir), "telemetry.jsonl")
+    telemetry = TrainingTelemetry(torch.device("cpu"), log_file)
+
+    def generate_batches():
+        for _ in range(2):
+            time.sleep(0.01)
+            yield dict(word_attention_mask=torch.tensor([[1, 1, 0]]), entity_attention_mask=torch.tensor([[1, 0]]))
+
+    for batch in telemetry.iterate(generate_batches()):
+        telemetry.add_batch(batch)
+        with telemetry.phase("forward"):
+            pass
+    summary = telemetry.end_step(1, queue_size=3)
+    telemetry.close()
+
+    assert summary["data_wait_time"] >= 0.02
+    assert summary["forward_time"] < summary["step_time"]
+    assert summary["words_per_sec"] == 4 / summary["step_time"]
+    assert summary["entities_per_sec"] == 2 / summary["step_time"]
+    assert summary["queue_size"] == 3
+    assert summary["peak_memory_mb"] > 0
+
+    with open(log_file) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]["step"] == 1
+    assert records[0]["words_per_sec"] == summary["words_per_sec"]
+
+
+def test_disabled_training_telemetry():
+    telemetry = TrainingTelemetry(torch.device("cpu"), enabled=False)
+    with telemetry.phase("forward"):
+        telemetry.add_batch(dict(word_attention_mask=torch.ones(1, 3)))
+    assert telemetry.end_step(1) == {}
@@ -0,0 +1,52 @@
+import json
+import os
+import struct
+
+import torch
+
+from luke.utils.tensor_file import load_tensor_file, save_tensor_file
+
+
+def test_save_and_load_optimizer_state(tmpdir):
+    state = dict(
+        state={
+            0: dict(step=3, exp_avg=torch.randn(3, 2), exp_avg_sq=torch.rand(3, 2)),
+            2: dict(step=3, exp_avg=torch.randn(4).to(torch.bfloat16), mask=torch.tensor([True, False])),
+        },
+        param_groups=[dict(lr=0.1, betas=(0.9, 0.999), params=[0, 1, 2], empty=torch.zeros(0, 3))],
+    )
+    path = os.path.join(str(tmpdir), "optimizer.safetensors")
+    save_tensor_file(state, path)
+    loaded_state = load_tensor_file(path)
+
+    assert sorted(loaded_state["state"].keys()) == [0, 2]
+    assert loaded_state["state"][0]["step"] == 3
+    assert torch.equal(loaded_state["state"][0]["exp_avg"], state["state"][0]["exp_avg"])
+    assert torch.equal(loaded_state["state"][2]["exp_avg"], state["state"][2]["exp_avg"])
+    assert torch.equal(loaded_state["state"][2]["mask"], state["state"][2]["mask"])
+    assert loaded_state["param_groups"][0]["betas"] == (0.9, 0.999)
+    assert loaded_state["param_groups"][0]["empty"].shape == (0, 3)
+
+    # the mapped tensors can be updated without modifying the file
+    loaded_state["state"][0]["exp_avg"].add_(1.0)
+    assert torch.equal(load_tensor_file(path)["state"][0]["exp_avg"], state["state"][0]["exp_avg"])
+
+
+def test_save_model_state_dict(tmpdir):
+    model = torch.nn.Linear(3, 2)
+    path = os.path.join(str(tmpdir), "model.safetensors")
+    save_tensor_file(model.state_dict(), path)
+
+    # the file follows the safetensors layout
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        assert header["weight"]["dtype"] == "F32"
+        assert header["weight"]["shape"] == [2, 3]
+        begin, end = header["bias"]["data_offsets"]
+        f.seek(8 + header_size + begin)
+        assert torch.equal(torch.frombuffer(bytearray(f.read(end - begin)), dtype=torch.float32), model.bias.data)
+
+    new_model = torch.nn.Linear(3, 2)
+    new_model.load_state_dict(load_tensor_file(path))
+    assert torch.equal(new_model.weight, model.weight)
@@ -0,0 +1,211 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from luke.pretraining.dataset import MANIFEST_FILE, PretrainingExampleWriter, WikipediaPretrainingDataset
+from luke.utils.entity_vocab import EntityVocab, EntityVocabBuilder
+from luke.utils.sentence_tokenizer import SentenceTokenizer
+from luke.utils.wikipedia_scan import (
+    LinkCounter,
+    PageConsumer,
+    _schedule_consumers,
+    partition_titles,
+    scan_page,
+    scan_wikipedia,
+)
+
+
+class DummyConsumer(PageConsumer):
+    def __init__(self, name, requires=()):
+        self.name = name
+        self.requires = requires
+
+
+def test_scan_page(dump_db):
+    paragraphs = scan_page(dump_db, "Madrid")
+    link_titles = [wiki_link.title for paragraph in paragraphs for wiki_link in paragraph.wiki_links]
+    # the redirect from Kingdom of Spain is resolved
+    assert "Spain" in link_titles
+    assert "Kingdom of Spain" not in link_titles
+    assert [p.text for p in paragraphs] == [p.text for p in dump_db.get_paragraphs("Madrid")]
+
+
+def test_partition_titles(dump_db):
+    titles = list(dump_db.titles())
+    partitions = [partition_titles(titles, 3, i) for i in range(3)]
+    assert sorted(title for partition in partitions for title in partition) == sorted(titles)
+    assert all(partitions)
+    assert partition_titles(reversed(titles), 3, 1) == partitions[1][::-1]
+    assert partition_titles(titles, 1, 0) == titles
+
+    with pytest.raises(ValueError):
+        partition_titles(titles, 3, 3)
+
+
+def test_schedule_consumers():
+    a = DummyConsumer("a")
+    b = DummyConsumer("b", ("a",))
+    c = DummyConsumer("c")
+    d = DummyConsumer("d", ("b", "c"))
+    assert _schedule_consumers([d, c, b, a]) == [[c, a], [b], [d]]
+
+    with pytest.raises(ValueError):
+        _schedule_consumers([DummyConsumer("a", ("b",)), DummyConsumer("b", ("a",))])
+    with pytest.raises(ValueError):
+        _schedule_consumers([DummyConsumer("a", ("x",))])
+
+
+def test_scan_wikipedia(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmpdir):
+    vocab_file = os.path.join(str(tmpdir), "entity_vocab.jsonl")
+    dataset_dir = os.path.join(str(tmpdir), "dataset")
+    os.makedirs(dataset_dir)
+    kwargs = dict(
+        max_seq_length=32,
+        max_entity_length=8,
+        max_mention_length=4,
+        min_sentence_length=2,
+        include_sentences_without_entities=False,
+        include_unk_entities=False,
+    )
+    consumers = [
+        PretrainingExampleWriter(
+            dataset_dir,
+            bert_tokenizer,
+            SentenceTokenizer.from_name("en"),
+            None,
+            language="en",
+            dump_db_uuid=dump_db.uuid,
+            **kwargs,
+        ),
+        EntityVocabBuilder(vocab_file, "en", vocab_size=100),
+        LinkCounter(),
+    ]
+    results = scan_wikipedia(dump_db, consumers, pool_size=2, chunk_size=3)
+
+    expected_vocab_file = os.path.join(str(tmpdir), "expected_entity_vocab.jsonl")
+    EntityVocab.build(dump_db, expected_vocab_file, 100, [], False, 1, 100, "en")
+    with open(vocab_file) as f, open(expected_vocab_file) as expected_f:
+        assert [json.loads(line) for line in f] == [json.loads(line) for line in expected_f]
+    assert results["link_counts"]["Spain"] == 7
+    assert results["entity_vocab"].get_count_by_title("Spain", "en") == 7
+
+    # the dataset is identical to the one built using the same entity vocabulary
+    expected_dataset_dir = os.path.join(str(tmpdir), "expected_dataset")
+    os.makedirs(expected_dataset_dir)
+    WikipediaPretrainingDataset.build(
+        dump_db,
+        bert_tokenizer,
+        SentenceTokenizer.from_name("en"),
+        EntityVocab(vocab_file),
+        expected_dataset_dir,
+        pool_size=1,
+        chunk_size=100,
+        max_num_documents=None,
+        **kwargs,
+    )
+    dataset = WikipediaPretrainingDataset(dataset_dir)
+    expected_dataset = WikipediaPretrainingDataset(expected_dataset_dir)
+    assert results["pretraining_dataset"] == len(dataset) == len(expected_dataset) > 0
+    # the examples of each chunk are written to a shard
+    num_chunks = (len(list(dump_db.titles())) + 2) // 3
+    assert dataset.metadata["dataset_files"] == ["dataset-{:05d}.tf".format(i) for i in range(num_chunks)]
+    assert {k: v for k, v in dataset.metadata.items() if k != "dataset_files"} == {
+        k: v for k, v in expected_dataset.metadata.items() if k != "dataset_files"
+    }
+    assert dataset.entity_vocab.size == expected_dataset.entity_vocab.size
+
+    def read_items(dataset):
+        items = itertools.islice(dataset.create_iterator(shuffle_buffer_size=1), len(dataset))
+        return sorted((item["page_id"], item["word_ids"].tolist(), item["entity_ids"].tolist()) for item in items)
+
+    assert read_items(dataset) == read_items(expected_dataset)
+
+
+def _write_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, output_dir, **kwargs):
+    os.makedirs(output_dir, exist_ok=True)
+    writer = PretrainingExampleWriter(
+        output_dir,
+        bert_tokenizer,
+        SentenceTokenizer.from_name("en"),
+        EntityVocab(synthetic_entity_vocab_file),
+        max_seq_length=32,
+        max_entity_length=8,
+        max_mention_length=4,
+        min_sentence_length=2,
+        include_sentences_without_entities=False,
+        include_unk_entities=False,
+        language="en",
+        dump_db_uuid=dump_db.uuid,
+        **kwargs,
+    )
+    titles = sorted(dump_db.titles())
+    return scan_wikipedia(dump_db, [writer], titles=titles, pool_size=2, chunk_size=3)["pretraining_dataset"]
+
+
+def _read_items(dataset):
+    items = itertools.islice(dataset.create_iterator(shuffle_buffer_size=1), len(dataset))
+    return sorted((item["page_id"], item["word_ids"].tolist(), item["entity_ids"].tolist()) for item in items)
+
+
+def test_pretraining_example_writer_resume(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmpdir):
+    dataset_dir = os.path.join(str(tmpdir), "dataset")
+    _write_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, dataset_dir)
+    expected_items = _read_items(WikipediaPretrainingDataset(dataset_dir))
+
+    # simulate an interrupted scan in which the second shard is not completed
+    manifest_file = os.path.join(dataset_dir, MANIFEST_FILE)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    assert len(manifest["shards"]) > 2
+    manifest["shards"][1]["completed"] = False
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+    with open(os.path.join(dataset_dir, "dataset-00001.tf"), "wb"):
+        pass
+    mtimes = [os.stat(os.path.join(dataset_dir, shard["file"])).st_mtime_ns for shard in manifest["shards"]]
+
+    _write_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, dataset_dir)
+    for (index, shard) in enumerate(manifest["shards"]):
+        mtime = os.stat(os.path.join(dataset_dir, shard["file"])).st_mtime_ns
+        assert (mtime == mtimes[index]) == (index != 1)
+    assert _read_items(WikipediaPretrainingDataset(dataset_dir)) == expected_items
+
+
+def test_pretraining_example_writer_merge_datasets(dump_db, bert_tokenizer, synthetic_entity_vocab_file, tmpdir):
+    dataset_dir = os.path.join(str(tmpdir), "dataset")
+    number_of_items = _write_dataset(dump_db, bert_tokenizer, synthetic_entity_vocab_file, dataset_dir)
+
+    dataset_dirs = [os.path.join(str(tmpdir), f"dataset-{i}") for i in range(3)]
+    for (shard_index, partition_dir) in enumerate(dataset_dirs):
+        _write_dataset(
+            dump_db, bert_tokenizer, synthetic_entity_vocab_file, partition_dir, num_shards=3, shard_index=shard_index
+        )
+    merged_dir = os.path.join(str(tmpdir), "merged")
+    WikipediaPretrainingDataset.merge_datasets(dataset_dirs, merged_dir)
+    merged_dataset = WikipediaPretrainingDataset(merged_dir)
+    assert len(merged_dataset) == number_of_items
+    assert _read_items(merged_dataset) == _read_items(WikipediaPretrainingDataset(dataset_dir))
+
+    # the shards of a scanned dataset are not split at titles
+    os.makedirs(os.path.join(str(tmpdir), "rebuilt"))
+    with pytest.raises(ValueError):
+        WikipediaPretrainingDataset.build(
+            dump_db,
+            bert_tokenizer,
+            SentenceTokenizer.from_name("en"),
+            EntityVocab(synthetic_entity_vocab_file),
+            os.path.join(str(tmpdir), "rebuilt"),
+            max_seq_length=32,
+            max_entity_length=8,
+            max_mention_length=4,
+            min_sentence_length=2,
+            include_sentences_without_entities=False,
+            include_unk_entities=False,
+            pool_size=1,
+            chunk_size=100,
+            max_num_documents=None,
+            previous_dataset_dir=dataset_dir,
+            previous_dump_db=dump_db,
+        )